@@ -0,0 +1,126 @@
+"""
+Read (and write) the columnar backstop cache kept by parse_cmd_load_gen.pl.
+
+Each cached backstop is a file ``<md5 of the backstop real path>.bsc`` in the
+cache directory (``$SKA/data/timelines/backstop_cache`` by default).  The file
+has a fixed 40 byte header followed by the real path of the backstop and
+then one contiguous array per column, so that the columns can be
+memory-mapped without parsing:
+
+=========  ================  ==============================================
+Column     Type              Contents
+=========  ================  ==============================================
+time       float64           command time (Chandra secs)
+obsid      int32             obsid for MP_OBSID commands, otherwise -1
+date       S21               command date
+cmd        S32               backstop command type (e.g. MP_OBSID)
+=========  ================  ==============================================
+
+A cache file is only valid for the backstop with the path, size, and mtime
+recorded in its header.
+"""
+
+import os
+import struct
+import hashlib
+
+import numpy as np
+
+MAGIC = 'TLBSCACH'
+VERSION = 2
+# magic, version, n_cmds, backstop size, backstop mtime, path length, reserved
+HEADER = struct.Struct('<8sIIQqII')
+COLUMNS = (('time', '<f8'),
+           ('obsid', '<i4'),
+           ('date', 'S21'),
+           ('cmd', 'S32'))
+
+
+def cache_file(backstop, cache_dir):
+    """
+    Return the name of the cache file for a backstop
+
+    :param backstop: backstop file name
+    :param cache_dir: backstop cache directory
+    :rtype: cache file name
+    """
+    path = os.path.realpath(backstop)
+    return os.path.join(cache_dir, hashlib.md5(path).hexdigest() + '.bsc')
+
+
+def _padded(length):
+    return 8 * ((length + 7) // 8)
+
+
+def read_cache(filename):
+    """
+    Memory-map the columns of a backstop cache file.
+
+    :param filename: cache file name
+    :rtype: (header dict with path, size, mtime, n_cmds; dict of column arrays)
+    """
+    with open(filename, 'rb') as fh:
+        magic, version, n_cmds, size, mtime, path_len, _ = HEADER.unpack(fh.read(HEADER.size))
+        path = fh.read(path_len)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("%s is not a version %d backstop cache file" % (filename, VERSION))
+    header = dict(path=path, size=size, mtime=mtime, n_cmds=n_cmds)
+
+    cols = {}
+    offset = HEADER.size + _padded(path_len)
+    for name, dtype in COLUMNS:
+        if n_cmds == 0:
+            cols[name] = np.zeros(0, dtype=dtype)
+        else:
+            cols[name] = np.memmap(filename, dtype=dtype, mode='r',
+                                   offset=offset, shape=(n_cmds,))
+        offset += n_cmds * np.dtype(dtype).itemsize
+    return header, cols
+
+
+def get_backstop_columns(backstop, cache_dir):
+    """
+    Return the memory-mapped columns of a backstop from the cache, or None
+    if the backstop is not in the cache or has changed since it was cached.
+
+    :param backstop: backstop file name
+    :param cache_dir: backstop cache directory
+    :rtype: dict of column arrays or None
+    """
+    filename = cache_file(backstop, cache_dir)
+    if not os.path.exists(filename):
+        return None
+    header, cols = read_cache(filename)
+    bs_stat = os.stat(backstop)
+    if (header['path'] != os.path.realpath(backstop)
+            or header['size'] != bs_stat.st_size
+            or header['mtime'] != int(bs_stat.st_mtime)):
+        return None
+    return cols
+
+
+def write_cache(filename, backstop, cols):
+    """
+    Write a backstop cache file for ``backstop`` from a dict of columns
+    (the same layout as written by parse_cmd_load_gen.pl).  The file is
+    written to a temporary name and renamed into place.
+
+    :param filename: cache file name
+    :param backstop: backstop file name (for the path, size, and mtime)
+    :param cols: dict of time, obsid, date, and cmd sequences
+    """
+    cmd_len = np.dtype(dict(COLUMNS)['cmd']).itemsize
+    for cmd in cols['cmd']:
+        if len(cmd) > cmd_len:
+            raise ValueError("backstop command %s is longer than %d characters" % (cmd, cmd_len))
+    path = os.path.realpath(backstop)
+    bs_stat = os.stat(backstop)
+    n_cmds = len(cols['time'])
+    tmp_filename = '%s.tmp.%d' % (filename, os.getpid())
+    with open(tmp_filename, 'wb') as fh:
+        fh.write(HEADER.pack(MAGIC, VERSION, n_cmds, bs_stat.st_size,
+                             int(bs_stat.st_mtime), len(path), 0))
+        fh.write(path.ljust(_padded(len(path)), '\0'))
+        for name, dtype in COLUMNS:
+            fh.write(np.asarray(cols[name], dtype=dtype).tostring())
+    os.rename(tmp_filename, filename)
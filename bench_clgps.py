@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+Benchmark the clgps.py summary parser on a synthetic corpus of processing
+summaries (variants of t/sosa_v2_C276_0906.sum: replans with BCF
+information, single and paired SCS loads, differing dates and counts),
+and check that it gives the same results as parse_clgps in
+parse_cmd_load_gen.pl (via --parse_only) for every summary.
+
+  ./bench_clgps.py --n-files 2000
+"""
+
+import os
+import re
+import json
+import time
+import random
+import shutil
+import tempfile
+import subprocess
+
+import clgps
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        't', 'sosa_v2_C276_0906.sum')
+
+REPLAN = """***************************** CONTINUITY/REPLAN *********************
+
+Continuity: On
+Replan/Reopen: Replan
+Replan Run Directory: /ehs/ofls/build/bin/cm/output/C{rday:03d}:{rhhmm:04d}/
+Continuity Directory: /ehs/ofls/build/bin/cm/output/C{cday:03d}:{chhmm:04d}/
+Continuity Run Planning Period Start Time: 2010:270:04:15:21.884
+
+"""
+
+BCF = """*************** INPUT REPLAN BCF INFORMATION ***************
+
+BCF file: /ehs/ofls/build/bin/cm/output/bcf.dat
+TOTAL NUMBER OF COMMANDS READ = {n_cmds}
+
+"""
+
+
+def get_options():
+    from optparse import OptionParser
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--n-files",
+                      type='int',
+                      default=1000,
+                      help="Number of synthetic summaries")
+    parser.add_option("--repeat",
+                      type='int',
+                      default=3,
+                      help="Number of timed passes over the corpus")
+    parser.add_option("--no-compare",
+                      action="store_true",
+                      help="Do not compare against parse_cmd_load_gen.pl")
+    parser.add_option("--seed",
+                      type='int',
+                      default=0)
+    opt, args = parser.parse_args()
+    return opt, args
+
+
+def make_corpus(outdir, n_files, seed=0):
+    """
+    Write ``n_files`` synthetic summaries to ``outdir`` and return their names.
+    """
+    rand = random.Random(seed)
+    template = open(TEMPLATE).read()
+    files = []
+    for i in range(n_files):
+        text = template
+        # shift the day of year of every date and load name
+        shift = rand.randint(-200, 80)
+        text = re.sub(r'(\d{4}):(\d{3}):',
+                      lambda m: '%s:%03d:' % (m.group(1), int(m.group(2)) + shift), text)
+        text = re.sub(r'C(L?)(\d{3}):',
+                      lambda m: 'C%s%03d:' % (m.group(1), int(m.group(2)) + shift), text)
+        if rand.random() < 0.3:
+            # vehicle-only loads
+            text = re.sub(r'SCS Number:(\s+)(\d{3}) / \d{3}', r'SCS Number:\1\2', text)
+        if rand.random() < 0.3:
+            # a replan, with the BCF information after the processing values
+            section = REPLAN.format(rday=276 + shift, rhhmm=rand.randint(0, 2359),
+                                    cday=270 + shift, chhmm=rand.randint(0, 2359))
+            text = re.sub(r'\*+ CONTINUITY/REPLAN \*+\n.*?\n(?=\*{12})', section, text,
+                          flags=re.DOTALL)
+            text = text.replace('***********************************ODE STATE',
+                                BCF.format(n_cmds=rand.randint(1, 5000))
+                                + '***********************************ODE STATE')
+        filename = os.path.join(outdir, 'C%03d_%04d.sum' % (276 + shift, i))
+        with open(filename, 'w') as fh:
+            fh.write(text)
+        files.append(filename)
+    return files
+
+
+def main():
+    opt, args = get_options()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        files = make_corpus(tmpdir, opt.n_files, opt.seed)
+        n_bytes = sum(os.path.getsize(f) for f in files)
+        print('Synthetic corpus: %d summaries (%.1f MB)' % (len(files), n_bytes / 1e6))
+
+        parse_time = None
+        for _ in range(opt.repeat):
+            t0 = time.time()
+            parsed = [clgps.parse_clgps(f) for f in files]
+            dt = time.time() - t0
+            parse_time = dt if parse_time is None else min(parse_time, dt)
+        print('clgps.py:              %8.3f s  %8.1f MB/s  %8.0f files/s'
+              % (parse_time, n_bytes / 1e6 / parse_time, len(files) / parse_time))
+
+        if not opt.no_compare:
+            script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'parse_cmd_load_gen.pl')
+            t0 = time.time()
+            out = subprocess.check_output(['perl', script, '--parse_only'] + files)
+            perl_time = time.time() - t0
+            print('parse_cmd_load_gen.pl: %8.3f s  %8.1f MB/s  %8.0f files/s (includes startup)'
+                  % (perl_time, n_bytes / 1e6 / perl_time, len(files) / perl_time))
+            perl_parsed = json.loads(out)
+            for (week, loads), perl in zip(parsed, perl_parsed):
+                if week != perl['week'] or loads != perl['loads']:
+                    raise ValueError('clgps.py and parse_clgps differ for %s' % perl['file'])
+            print('%d summaries match parse_clgps' % len(files))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
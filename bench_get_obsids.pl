@@ -0,0 +1,142 @@
+#!/usr/bin/env perl
+#
+# Benchmark get_obsids from parse_cmd_load_gen.pl against the original
+# per-load scan of the full backstop, using a large synthetic backstop
+# with many loads (like a replan week), and check that both give the
+# same obsids for every load.  get_obsids is timed once with an empty
+# backstop cache (parse and cache write) and then with the cache.
+#
+#   ./bench_get_obsids.pl --n_cmds 200000 --n_loads 40
+
+use strict;
+use warnings;
+use FindBin;
+use File::Temp qw( tempdir );
+use Getopt::Long;
+use POSIX qw( strftime floor );
+use Time::HiRes qw( time );
+use Ska::Convert qw( date2time );
+
+# keep the backstop cache of parse_cmd_load_gen.pl in a temporary $SKA
+my $dir = tempdir( CLEANUP => 1 );
+$ENV{SKA} = $dir;
+require "$FindBin::Bin/parse_cmd_load_gen.pl";
+load_modules();
+
+my %opt = ( n_cmds => 200000,
+	    n_loads => 40,
+	    obsid_every => 50,
+	    repeat => 3,
+    );
+
+GetOptions(\%opt,
+	   'n_cmds=i',
+	   'n_loads=i',
+	   'obsid_every=i',
+	   'repeat=i',
+    );
+
+# one week of commands starting at 2010:276:00:00:00 UTC
+my $unix_start = 1285891200;
+my $span = 7 * 86400;
+
+my $backstop = "${dir}/CR276_0000.backstop";
+open(my $fh, '>', $backstop) or die("Could not write $backstop: $!");
+for my $i (0 .. $opt{n_cmds} - 1){
+    my $secs = $unix_start + $span * $i / $opt{n_cmds};
+    my $date = strftime("%Y:%j:%H:%M:%S", gmtime(floor($secs)))
+	. sprintf(".%03d", 1000 * ($secs - floor($secs)));
+    if ($i % $opt{obsid_every} == 0){
+	printf $fh ("%s | %8d 0 | MP_OBSID         | ID= %5d, SCS= 131, STEP= %d\n",
+		    $date, $i, 10000 + $i / $opt{obsid_every}, $i);
+    }
+    else{
+	printf $fh ("%s | %8d 0 | COMMAND_SW       | TLMSID= AONMMODE, HEX= 8030402, MSID= AONMMODE, SCS= 131, STEP= %d\n",
+		    $date, $i, $i);
+    }
+}
+close($fh);
+
+# loads that evenly split the week, overlapping by an hour
+my @loads;
+for my $i (0 .. $opt{n_loads} - 1){
+    my $start = $unix_start + $span * $i / $opt{n_loads};
+    my $stop = $unix_start + $span * ($i + 1) / $opt{n_loads} + 3600;
+    my $name = strftime("CL%j:%H%M", gmtime($start));
+    push @loads, { year => 2010,
+		   load_segment => $name,
+		   first_cmd_time => strftime("%Y:%j:%H:%M:%S.000", gmtime($start)),
+		   last_cmd_time => strftime("%Y:%j:%H:%M:%S.000", gmtime($stop)) };
+}
+
+printf("Synthetic backstop: %d commands (%.1f MB), %d loads\n",
+       $opt{n_cmds}, (-s $backstop) / 1e6, $opt{n_loads});
+
+my ($scan_obsids, $fast_obsids, $cached_obsids);
+my ($parse_time, $scan_time, $cached_time) = (0, 0, 0);
+
+my $t0 = time();
+$fast_obsids = get_obsids($dir, \@loads);
+my $fast_time = time() - $t0;
+
+for my $rep (1 .. $opt{repeat}){
+    my $t1 = time();
+    my @bs = Ska::Parse_CM_File::backstop( $backstop );
+    my $t2 = time();
+    $scan_obsids = get_obsids_scan($dir, \@loads);
+    my $t3 = time();
+    $cached_obsids = get_obsids($dir, \@loads);
+    my $t4 = time();
+    $parse_time += $t2 - $t1;
+    $scan_time += $t3 - $t2;
+    $cached_time += $t4 - $t3;
+}
+$parse_time /= $opt{repeat};
+$scan_time /= $opt{repeat};
+$cached_time /= $opt{repeat};
+
+my $n_obsids = 0;
+for my $id (keys %{$scan_obsids}){
+    my @scan = map { "$_->{date} $_->{obsid}" } @{$scan_obsids->{$id}};
+    my @fast = map { "$_->{date} $_->{obsid}" } @{$fast_obsids->{$id}};
+    my @cached = map { "$_->{date} $_->{obsid}" } @{$cached_obsids->{$id}};
+    die("Mismatch in obsids for $id") unless ("@scan" eq "@fast" and "@scan" eq "@cached");
+    $n_obsids += @scan;
+}
+die("Mismatch in loads") unless (keys %{$scan_obsids} == keys %{$fast_obsids});
+
+printf("%d tl_obsids rows match\n", $n_obsids);
+# both include one parse of the backstop
+printf("backstop parse:  %8.3f s\n", $parse_time);
+printf("per-load scan:   %8.3f s  (%.3f s excluding parse)\n",
+       $scan_time, $scan_time - $parse_time);
+printf("get_obsids:      %8.3f s  (%.3f s excluding parse, includes cache write)\n",
+       $fast_time, $fast_time - $parse_time);
+printf("get_obsids, cached: %5.3f s\n", $cached_time);
+
+
+sub get_obsids_scan{
+    my $dir = shift;
+    my $loads = shift;
+
+    # the original get_obsids, for reference
+    my @bs_list = glob("${dir}/*.backstop");
+    my $backstop = $bs_list[0];
+    my @bs = Ska::Parse_CM_File::backstop( $backstop);
+    my %obsids_per_load;
+    for my $load (@{$loads}){
+	my @obsids;
+	my $tstart = date2time($load->{first_cmd_time});
+	my $tstop = date2time($load->{last_cmd_time});
+	for my $entry (@bs){
+	    next unless ( $entry->{time} > $tstart );
+	    next unless ( $entry->{cmd} =~ /MP_OBSID/ );
+	    my %bs_params = Ska::Parse_CM_File::parse_params($entry->{params});
+	    push @obsids, { date => $entry->{date}, obsid => $bs_params{ID}};
+	    last if ( $entry->{time} > $tstop );
+	}
+	my $id = $load->{year} . "__" . $load->{load_segment};
+	$obsids_per_load{$id} = \@obsids;
+    }
+    return \%obsids_per_load;
+}
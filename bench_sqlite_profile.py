@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""
+Benchmark the latency of readers of a sqlite database while it is being
+updated, with the default sqlite settings and with the shared connection
+profile (sqlite_profile.sql) with WAL journaling.
+
+A writer process repeatedly replaces the last rows of a timelines-like
+table in long transactions (like update_load_seg_db.py without
+--in_memory), while reader processes (with plain connections, like the
+cmd_states tools) run small range queries and time them.  The latency
+percentiles and the number of "database is locked" errors are reported for
+each configuration.
+
+  ./bench_sqlite_profile.py --duration 20 --readers 4
+"""
+
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+import sqlite_profile
+
+
+def get_options():
+    from optparse import OptionParser
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--n-rows",
+                      type='int',
+                      default=200000,
+                      help="Number of rows in the table")
+    parser.add_option("--n-update",
+                      type='int',
+                      default=20000,
+                      help="Number of rows replaced by each update")
+    parser.add_option("--hold",
+                      type='float',
+                      default=0.5,
+                      help="Seconds of computation within each update transaction")
+    parser.add_option("--duration",
+                      type='float',
+                      default=10,
+                      help="Seconds to run each configuration")
+    parser.add_option("--readers",
+                      type='int',
+                      default=2,
+                      help="Number of reader processes")
+    parser.add_option("--reader-timeout",
+                      type='float',
+                      default=5.0,
+                      help="sqlite timeout (seconds) of the reader connections")
+    parser.add_option("--profile",
+                      default=sqlite_profile.PROFILE_FILE,
+                      help="Connection profile to compare with the defaults")
+    opt, args = parser.parse_args()
+    return opt, args
+
+
+def make_db(filename, n_rows, statements):
+    conn = sqlite3.connect(filename)
+    for stmt in statements:
+        conn.execute(stmt)
+    conn.execute("""CREATE TABLE timelines (id int not null primary key,
+                    load_segment_id int not null, dir varchar(20),
+                    datestart varchar(21) not null, datestop varchar(21) not null)""")
+    conn.execute("CREATE INDEX timelines_datestart ON timelines (datestart)")
+    conn.executemany("INSERT INTO timelines VALUES (?, ?, ?, ?, ?)",
+                     (row(id) for id in range(n_rows)))
+    conn.commit()
+    conn.close()
+
+
+def row(id):
+    secs = 1000 * id
+    date = '%04d:%03d:%02d:%02d:%02d.000' % (2000 + secs // 31536000, secs // 86400 % 365 + 1,
+                                             secs // 3600 % 24, secs // 60 % 60, secs % 60)
+    return (id, id // 10, '/2010/JAN0110/oflsa/', date, date)
+
+
+def writer(filename, statements, opt, stop):
+    conn = sqlite3.connect(filename, timeout=60, isolation_level=None)
+    for stmt in statements:
+        conn.execute(stmt)
+    while not stop.is_set():
+        conn.execute("BEGIN")
+        conn.execute("DELETE FROM timelines WHERE id >= ?", (opt.n_rows - opt.n_update,))
+        time.sleep(opt.hold)
+        conn.executemany("INSERT INTO timelines VALUES (?, ?, ?, ?, ?)",
+                         (row(id) for id in range(opt.n_rows - opt.n_update, opt.n_rows)))
+        conn.execute("COMMIT")
+        time.sleep(0.05)
+    conn.close()
+
+
+def reader(filename, opt, stop, results):
+    conn = sqlite3.connect(filename, timeout=opt.reader_timeout)
+    latencies = []
+    errors = 0
+    rand = np.random.RandomState(os.getpid())
+    while not stop.is_set():
+        date = row(rand.randint(opt.n_rows))[3]
+        t0 = time.time()
+        try:
+            conn.execute("""SELECT count(*), max(datestop) FROM timelines
+                            WHERE datestart >= ? AND datestart < ?""",
+                         (date, date[:8] + '~')).fetchall()
+        except sqlite3.OperationalError:
+            errors += 1
+            continue
+        latencies.append(time.time() - t0)
+    conn.close()
+    results.put((latencies, errors))
+
+
+def run(name, statements, opt):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'bench.db3')
+        make_db(filename, opt.n_rows, statements)
+        stop = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        readers = [multiprocessing.Process(target=reader, args=(filename, opt, stop, results))
+                   for i in range(opt.readers)]
+        for proc in readers:
+            proc.start()
+        write_proc = multiprocessing.Process(target=writer, args=(filename, statements, opt, stop))
+        write_proc.start()
+        time.sleep(opt.duration)
+        stop.set()
+        latencies = []
+        errors = 0
+        for proc in readers:
+            proc_latencies, proc_errors = results.get()
+            latencies.extend(proc_latencies)
+            errors += proc_errors
+        for proc in readers + [write_proc]:
+            proc.join()
+    finally:
+        shutil.rmtree(tmpdir)
+    latencies = np.array(latencies) * 1000
+    print('%-10s %8d %8d %9.2f %9.2f %9.2f %9.1f'
+          % (name, len(latencies), errors,
+             np.percentile(latencies, 50), np.percentile(latencies, 95),
+             np.percentile(latencies, 99), latencies.max()))
+
+
+def main():
+    opt, args = get_options()
+    print('Reader latency (ms) with %d readers during updates of %d of %d rows'
+          % (opt.readers, opt.n_update, opt.n_rows))
+    print('%-10s %8s %8s %9s %9s %9s %9s' % ('config', 'queries', 'locked', 'p50', 'p95', 'p99',
+                                             'max'))
+    run('default', [], opt)
+    # (the benchmark databases are in a local temporary directory)
+    run('profile', sqlite_profile.read_profile(opt.profile, journal_mode='WAL'), opt)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""
+Vectorized conversions of Chandra date strings (``YYYY:DOY:HH:MM:SS.sss``,
+UTC) to Chandra seconds (TT seconds since 1998.0) and years.
+
+These give the same values as ``Chandra.Time.DateTime(date).secs`` for
+full-format date strings, but convert a whole array of dates in one numpy
+pass instead of one DateTime object per date.  Scalar conversions are kept
+in a small LRU memo, as the same dates (load and timeline boundaries) are
+converted repeatedly.  Dates that are not in the full format are handed to
+DateTime.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+# TAI - UTC (leap seconds) from each UTC (year, month)
+LEAP_SECONDS = ((1972, 1, 10), (1972, 7, 11), (1973, 1, 12), (1974, 1, 13),
+                (1975, 1, 14), (1976, 1, 15), (1977, 1, 16), (1978, 1, 17),
+                (1979, 1, 18), (1980, 1, 19), (1981, 7, 20), (1982, 7, 21),
+                (1983, 7, 22), (1985, 7, 23), (1988, 1, 24), (1990, 1, 25),
+                (1991, 1, 26), (1992, 7, 27), (1993, 7, 28), (1994, 7, 29),
+                (1996, 1, 30), (1997, 7, 31), (1999, 1, 32), (2006, 1, 33),
+                (2009, 1, 34), (2012, 7, 35), (2015, 7, 36), (2017, 1, 37))
+# TT - TAI
+TT_TAI = 32.184
+MEMO_SIZE = 4096
+DATE_LEN = 21
+
+_memo = OrderedDict()
+
+
+def _days_before_year(year):
+    """
+    Days from 1998:001 to the start of ``year`` (array or scalar)
+    """
+    prev = year - 1
+    return (365 * (year - 1998) + (prev // 4 - prev // 100 + prev // 400)
+            - (1997 // 4 - 1997 // 100 + 1997 // 400))
+
+
+def _leap_table():
+    starts = []
+    for year, month, leap in LEAP_SECONDS:
+        doy = 1 if month == 1 else 182 + (1 if year % 4 == 0 else 0)
+        starts.append((_days_before_year(year) + doy - 1) * 86400.0)
+    return np.array(starts), np.array([leap for year, month, leap in LEAP_SECONDS], dtype=float)
+
+LEAP_STARTS, LEAP_TAI_UTC = _leap_table()
+
+
+def _parse(dates):
+    """
+    Parse an array of full-format date strings into (year, UTC seconds
+    since 1998:001 without leap seconds), and a mask of the dates that are
+    not in the full format.
+    """
+    chars = np.asarray(dates, dtype='S%d' % DATE_LEN)
+    # (longer strings would be silently truncated)
+    too_long = np.char.str_len(np.asarray(dates)) > DATE_LEN
+    n = len(chars)
+    raw = chars.view(np.uint8).reshape(n, DATE_LEN).astype(np.int64)
+    digits = raw - ord('0')
+
+    def number(start, stop):
+        value = np.zeros(n, dtype=np.int64)
+        for col in range(start, stop):
+            value = value * 10 + digits[:, col]
+        return value
+
+    # the separators must be in place and the fields must be digits
+    # (the fractional seconds may be short, e.g. 2010:001:00:00:00.5)
+    bad = too_long.copy()
+    for col in (4, 8, 11, 14):
+        bad |= raw[:, col] != ord(':')
+    bad |= raw[:, 17] != ord('.')
+    for col in (0, 1, 2, 3, 5, 6, 7, 9, 10, 12, 13, 15, 16, 18):
+        bad |= (digits[:, col] < 0) | (digits[:, col] > 9)
+    frac_digits = digits[:, 18:DATE_LEN]
+    present = raw[:, 18:DATE_LEN] != 0
+    bad |= np.any(present & ((frac_digits < 0) | (frac_digits > 9)), axis=1)
+    # no characters after a missing fractional digit
+    bad |= np.any(~present[:, :-1] & present[:, 1:], axis=1)
+
+    year = number(0, 4)
+    frac = np.where(present, frac_digits, 0).dot(np.array([0.1, 0.01, 0.001]))
+    utc = ((_days_before_year(year) + number(5, 8) - 1) * 86400.0
+           + number(9, 11) * 3600.0 + number(12, 14) * 60.0 + number(15, 17) + frac)
+    return year, utc, bad
+
+
+def date2secs(dates):
+    """
+    Convert Chandra date strings to Chandra seconds.
+
+    :param dates: date string or sequence/array of date strings
+    :rtype: float (for a scalar date) or numpy array of floats
+    """
+    if isinstance(dates, (str, bytes)) or np.ndim(dates) == 0:
+        return _scalar_date2secs(dates)
+    dates = np.asarray(dates)
+    if len(dates) == 0:
+        return np.zeros(0)
+    year, utc, bad = _parse(dates)
+    tai_utc = LEAP_TAI_UTC[np.searchsorted(LEAP_STARTS, utc, side='right') - 1]
+    secs = utc + tai_utc + TT_TAI
+    if np.any(bad):
+        from Chandra.Time import DateTime
+        secs[bad] = DateTime(dates[bad]).secs
+    return secs
+
+
+def _scalar_date2secs(date):
+    if date in _memo:
+        secs = _memo.pop(date)
+    else:
+        secs = float(date2secs([date])[0])
+        if len(_memo) >= MEMO_SIZE:
+            _memo.popitem(last=False)
+    _memo[date] = secs
+    return secs
+
+
+def sql_date2secs(column):
+    """
+    SQL (sqlite) expression converting a full-format date column to Chandra
+    seconds, with the same LEAP_SECONDS as date2secs (NULL for a date that
+    is not in the full format).  Used by the migrate_db.py triggers that
+    keep the tstart and tstop columns in step with datestart and datestop.
+
+    :param column: column name (e.g. NEW.datestart)
+    :rtype: SQL expression string
+    """
+    tai_utc = ' '.join("WHEN %s >= '%04d:%03d' THEN %d"
+                       % (column, year,
+                          1 if month == 1 else 182 + (1 if year % 4 == 0 else 0), leap)
+                       for year, month, leap in reversed(LEAP_SECONDS))
+    return ("""(CASE WHEN %(col)s GLOB '[0-9][0-9][0-9][0-9]:[0-9][0-9][0-9]:[0-9][0-9]:[0-9][0-9]:[0-9][0-9].[0-9][0-9][0-9]'
+      THEN (julianday(substr(%(col)s, 1, 4) || '-01-01') - julianday('1998-01-01')
+            + substr(%(col)s, 6, 3) - 1) * 86400.0
+           + substr(%(col)s, 10, 2) * 3600.0 + substr(%(col)s, 13, 2) * 60.0
+           + substr(%(col)s, 16, 6)
+           + (CASE %(tai_utc)s ELSE %(first)d END) + %(tt_tai)r
+      END)""" % dict(col=column, tai_utc=tai_utc, first=LEAP_SECONDS[0][2] - 1, tt_tai=TT_TAI))
+
+
+def row_times(rows):
+    """
+    Start and stop (Chandra seconds) of load segment or timeline rows: the
+    tstart and tstop columns, or the converted datestart and datestop for
+    rows without the numeric times (e.g. before migrate_db.py version 3).
+
+    :param rows: recarray with datestart, datestop and maybe tstart, tstop
+    :rtype: (tstart array, tstop array)
+    """
+    if 'tstart' in rows.dtype.names and 'tstop' in rows.dtype.names:
+        try:
+            tstart = np.asarray(rows['tstart'], dtype=float)
+            tstop = np.asarray(rows['tstop'], dtype=float)
+        except (TypeError, ValueError):
+            pass
+        else:
+            if not (np.any(np.isnan(tstart)) or np.any(np.isnan(tstop))):
+                return tstart, tstop
+    return date2secs(rows['datestart']), date2secs(rows['datestop'])
+
+
+def date2year(dates):
+    """
+    Calendar year(s) of Chandra date strings.
+
+    :param dates: date string or sequence/array of date strings
+    :rtype: int (for a scalar date) or numpy array of ints
+    """
+    if isinstance(dates, (str, bytes)) or np.ndim(dates) == 0:
+        return int(dates[:4])
+    dates = np.asarray(dates, dtype='S%d' % DATE_LEN)
+    return np.asarray(dates, dtype='S4').astype(int)
+
+
+def durations(datestarts, datestops):
+    """
+    Seconds from each of ``datestarts`` to the corresponding ``datestops``.
+
+    :param datestarts: date string(s)
+    :param datestops: date string(s)
+    :rtype: float or numpy array of floats
+    """
+    return date2secs(datestops) - date2secs(datestarts)
@@ -0,0 +1,170 @@
+"""
+Parse command load generation processing summaries (CLGPS, the ``C*.sum``
+files in the mission planning directories).
+
+This is a single-pass version of ``parse_clgps`` in parse_cmd_load_gen.pl.
+The summary is split into sections on the asterisk separator lines as
+before, and each section is searched for the section headers with the same
+(unanchored and independent) checks as ``parse_clgps``, so that a header
+after other text, or more than one header in a section, is handled the
+same way; only the fields of the sections found are then searched for, in
+one pass over the summary.  The results are field-for-field the same as
+``parse_clgps``: a dict of the processing values for the week and a list of
+dicts of the loads, with the values as strings (except for the integer
+``replan``), and a load on a pair of SCS slots (e.g. ``128 / 131``) split
+into one load per slot.
+
+With a ``cache_dir``, the results are kept in the same content-addressed
+parse cache as parse_cmd_load_gen.pl (``--parse_cache``): JSON files named
+by the md5 digest of the summary contents.
+"""
+
+import os
+import re
+import json
+import hashlib
+
+SEPARATOR = re.compile(r'\n\*{12}')
+CONTINUITY_HEADER = re.compile(r'\*+\sCONTINUITY/REPLAN\s\*+')
+PROCESSING_HEADER = re.compile(r'\*+PROCESSING\sVALUES\*+')
+BCF_HEADER = re.compile(r'\*+\sINPUT\sREPLAN\sBCF\sINFORMATION\s\*+')
+PLANNING_HEADER = re.compile(r'\*+\sACTUAL\sPLANNING\sPERIOD\sSTART/STOP\sTIMES\s\*+')
+LOAD_HEADER = re.compile(r'\*+LOAD\sGENERATED\*+')
+
+# fields of each section as (key, regex) with the value in the first group
+CONTINUITY_FIELDS = (('replan_cmds', re.compile(r'Run\sDirectory:\s\S+/(C\d{3}:\d{4})/')),
+                     ('continuity_cmds', re.compile(r'Continuity\sDirectory:\s\S+/(C\d{3}:\d{4})/')))
+CONTINUITY_RUN_FIELDS = (('continuity_cmds',
+                          re.compile(r'Continuity\sRun\sDirectory:\s\S+/(C\d{3}:\d{4})/')),)
+PROCESSING_FIELDS = (('execution_tstart', re.compile(r'EXECUTION\sBEGIN\sTIME:(\S+)')),
+                     ('processing_tstart', re.compile(r'START\sTIME:\s+(\S+)')),
+                     ('processing_tstop', re.compile(r'STOP\sTIME:\s+(\S+)')))
+BCF_FIELDS = (('bcf_cmd_count', re.compile(r'TOTAL\sNUMBER\sOF\sCOMMANDS\sREAD\s=\s(\d+)')),)
+PLANNING_FIELDS = (('planning_tstart', re.compile(r'ACTUAL\sSTART\sTIME:\s(\S+)')),
+                   ('planning_tstop', re.compile(r'ACTUAL\sSTOP\s\sTIME:\s(\S+)')))
+LOAD_FIELDS = (('load_segment', re.compile(r'Load\sname:\s+(CL\d{3}:\d{4})')),
+               ('load_scs', re.compile(r'SCS\sNumber:\s+(\d{3}(\s*/\s*\d{3})?)')),
+               ('first_cmd_time', re.compile(r'First\sCommand\sTime:\s+(\S+)')),
+               ('last_cmd_time', re.compile(r'Last\sCommand\sTime:\s+(\S+)')))
+YEAR = re.compile(r'^(\d{4})')
+SCS_PAIR = re.compile(r'^(\d{3})\s*/\s*(\d{3})$')
+PARSE_CACHE_VERSION = 1
+
+
+def _get_fields(piece, fields, values):
+    for key, regex in fields:
+        match = regex.search(piece)
+        if match:
+            values[key] = match.group(1)
+
+
+def parse_clgps_text(text):
+    """
+    Parse the text of a processing summary.
+
+    :param text: contents of the summary
+    :rtype: (dict of processing values for the week, list of load dicts)
+    """
+    # assume this isn't a replan
+    week = {'replan': 0}
+    rawloads = []
+
+    for piece in SEPARATOR.split(text):
+        # (a section has no header unless it has an asterisk)
+        if '*' not in piece:
+            continue
+        if CONTINUITY_HEADER.search(piece):
+            if 'Replan/Reopen' in piece:
+                week['replan'] = 1
+                _get_fields(piece, CONTINUITY_FIELDS, week)
+            else:
+                _get_fields(piece, CONTINUITY_RUN_FIELDS, week)
+        if PROCESSING_HEADER.search(piece):
+            _get_fields(piece, PROCESSING_FIELDS, week)
+        if BCF_HEADER.search(piece):
+            _get_fields(piece, BCF_FIELDS, week)
+        if PLANNING_HEADER.search(piece):
+            _get_fields(piece, PLANNING_FIELDS, week)
+            if 'planning_tstart' in week:
+                match = YEAR.match(week['planning_tstart'])
+                if match:
+                    week['year'] = match.group(1)
+        if LOAD_HEADER.search(piece):
+            load = {}
+            _get_fields(piece, LOAD_FIELDS, load)
+            match = YEAR.match(load.get('first_cmd_time', ''))
+            if match:
+                load['year'] = match.group(1)
+            rawloads.append(load)
+
+    loads = []
+    for load in rawloads:
+        match = SCS_PAIR.match(load.get('load_scs', ''))
+        if match:
+            for scs in match.groups():
+                scs_load = dict(load)
+                scs_load['load_scs'] = scs
+                loads.append(scs_load)
+        else:
+            loads.append(load)
+
+    return week, loads
+
+
+def read_parse_cache(cache_file):
+    """
+    Read a parse cache file.
+
+    :param cache_file: parse cache file name
+    :rtype: (week dict, list of load dicts) or None if missing or unreadable
+    """
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with open(cache_file) as fh:
+            cached = json.load(fh)
+    except ValueError:
+        return None
+    if not isinstance(cached, dict) or cached.get('version') != PARSE_CACHE_VERSION:
+        return None
+    return cached['week'], cached['loads']
+
+
+def write_parse_cache(cache_file, week, loads):
+    """
+    Write a parse cache file (via a temporary file and a rename).
+
+    :param cache_file: parse cache file name
+    :param week: dict of processing values for the week
+    :param loads: list of load dicts
+    """
+    cache_dir = os.path.dirname(cache_file)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_file = '%s.tmp.%d' % (cache_file, os.getpid())
+    with open(tmp_file, 'w') as fh:
+        json.dump({'version': PARSE_CACHE_VERSION, 'week': week, 'loads': loads}, fh,
+                  sort_keys=True, separators=(',', ':'))
+    os.rename(tmp_file, cache_file)
+
+
+def parse_clgps(filename, cache_dir=None):
+    """
+    Parse a command load generation processing summary file.
+
+    :param filename: summary file name
+    :param cache_dir: parse cache directory (optional)
+    :rtype: (dict of processing values for the week, list of load dicts)
+    """
+    with open(filename, 'rb') as fh:
+        content = fh.read()
+    if cache_dir is None:
+        return parse_clgps_text(content.decode('latin-1'))
+
+    cache_file = os.path.join(cache_dir, hashlib.md5(content).hexdigest() + '.json')
+    cached = read_parse_cache(cache_file)
+    if cached is not None:
+        return cached
+    week, loads = parse_clgps_text(content.decode('latin-1'))
+    write_parse_cache(cache_file, week, loads)
+    return week, loads
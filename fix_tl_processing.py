@@ -32,9 +32,9 @@ def repair( dbh ):
     dbh.verbose = True
     #dbh.execute("delete from tl_processing where dir = '/2008/FEB1808/oflsb/'")
     #dbh.execute("""insert into tl_processing
-    #( year, dir, file )
+    #( year, dir, file, file_key )
     #values 
-    #(2008, '/2008/FEB1808/oflsb/', 'C048_0802.sum')
+    #(2008, '/2008/FEB1808/oflsb/', 'C048_0802.sum', '048:0802')
     #""")
     dbh.verbose = False
 
@@ -6,6 +6,10 @@ CREATE TABLE load_segments (
  datestop        varchar(21)  not null,
  load_scs        int          not null,
  fixed_by_hand   bit          not null,
+ tstart          float        null,
+ tstop           float        null,
  CONSTRAINT pk_load_segments_id PRIMARY KEY (id)
-)
+);
 
+CREATE INDEX load_segments_datestart ON load_segments (datestart, load_scs);
+CREATE INDEX load_segments_tstart ON load_segments (tstart)
@@ -0,0 +1,207 @@
+"""
+Fingerprint of the last iFOT load segment rdb file processed by
+update_load_seg_db.py.
+
+The fingerprint is a small JSON file with the md5 digest of the rdb file
+contents, an md5 digest, start date and load segment name for each row of
+the rdb table, and a
+summary of the state of the database tables that the update reads and
+writes (row counts, high-water marks, and a digest of the contents of the
+load segments and timelines from the start of the rdb).  When the newest rdb file has the same contents and the database is
+in the same state as after the last update, there is nothing to do.  When
+only the rdb has changed, the row digests give the first changed load
+segment without querying the database.
+
+The module needs just the standard library, so that an unchanged rdb and
+sqlite database can be found (sqlite_db_state) without importing numpy or
+Ska.DBI, or connecting to the database with the connection profile.
+"""
+
+import os
+import json
+import hashlib
+import sqlite3
+from itertools import izip
+
+VERSION = 2
+# the repair scripts that update_load_seg_db.py applies to the tables
+FIX_SCRIPTS = ('fix_tl_processing', 'fix_load_segments')
+# row counts and max ids or modification times of the tables that
+# determine the load segments and timelines (and of tl_obsids, which is
+# mirrored with them by update_load_seg_db.py --h5file)
+DB_STATE_QUERY = """select
+    (select count(*) from load_segments) as n_load_segments,
+    (select max(id) from load_segments) as max_load_segment_id,
+    (select count(*) from timelines) as n_timelines,
+    (select max(id) from timelines) as max_timeline_id,
+    (select count(*) from tl_processing) as n_processing,
+    (select max(sumfile_modtime) from tl_processing) as max_processing_modtime,
+    (select count(*) from tl_built_loads) as n_built_loads,
+    (select max(sumfile_modtime) from tl_built_loads) as max_built_modtime,
+    (select count(*) from tl_obsids) as n_obsids,
+    (select max(date) from tl_obsids) as max_obsid_date"""
+# the load_segments and timelines rows (from the start of the rdb window)
+# whose contents are digested in the state, so that an edit in place of a
+# row is also a change
+WINDOW_QUERIES = (('load_segments', "select * from load_segments where datestart >= '%s'"),
+                  ('timelines', "select * from timelines where datestop >= '%s'"))
+
+
+def content_digest(filename):
+    """
+    md5 digest of the contents of a file
+
+    :param filename: file name
+    :rtype: hex digest string
+    """
+    with open(filename, 'rb') as fh:
+        return hashlib.md5(fh.read()).hexdigest()
+
+
+def _text(value):
+    if value is None:
+        return u'NULL'
+    if isinstance(value, float):
+        return repr(value)
+    return u'%s' % value
+
+
+def rows_digest(rows):
+    """
+    md5 digest of the contents of database rows (in any order)
+
+    :param rows: iterable of dicts of column values
+    :rtype: hex digest string
+    """
+    lines = sorted(u'\t'.join(_text(row[name]) for name in sorted(row)) for row in rows)
+    return hashlib.md5(u'\n'.join(lines).encode('utf-8')).hexdigest()
+
+
+def window_start(rows):
+    """
+    Start of the rdb window (the first start date of the row digests)
+
+    :param rows: row digests (as from row_digests())
+    :rtype: date string, or None if there are no rows
+    """
+    return min(row[1] for row in rows) if rows else None
+
+
+def db_state(row, script_dir, window_digests=()):
+    """
+    State of the database (from the DB_STATE_QUERY row and the digests of
+    the WINDOW_QUERIES rows) and of the repair scripts, as recorded in the
+    fingerprint
+
+    :param row: dict of the DB_STATE_QUERY columns
+    :param script_dir: directory of the FIX_SCRIPTS
+    :param window_digests: list of (table, rows_digest) of the WINDOW_QUERIES
+    :rtype: list of [name, value] lists
+    """
+    state = [[key, row[key]] for key in sorted(row)]
+    state.extend([['%s_rows' % table, digest] for table, digest in window_digests])
+    for script in FIX_SCRIPTS:
+        state.append([script, content_digest(os.path.join(script_dir, script + '.py'))])
+    return state
+
+
+def sqlite_db_state(server, script_dir, datestart=None):
+    """
+    db_state of a sqlite database file, read with just the sqlite3 module
+
+    :param server: sqlite database file name
+    :param script_dir: directory of the FIX_SCRIPTS
+    :param datestart: start of the rows digested (default=all rows)
+    :rtype: list of [name, value] lists, or None if the database is missing
+            or cannot be read
+    """
+    # (sqlite3.connect would make an empty database)
+    if not os.path.exists(server):
+        return None
+    try:
+        conn = sqlite3.connect(server)
+        try:
+            cursor = conn.execute(DB_STATE_QUERY)
+            values = cursor.fetchone()
+            row = dict(izip([column[0] for column in cursor.description], values))
+            window_digests = []
+            for table, query in WINDOW_QUERIES:
+                cursor = conn.execute(query % (datestart or ''))
+                names = [column[0] for column in cursor.description]
+                window_digests.append(
+                    (table, rows_digest(dict(izip(names, values)) for values in cursor)))
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    return db_state(row, script_dir, window_digests)
+
+
+def row_digests(rdb_loads, datecol='TStart (GMT)', namecol='LOADSEG.NAME'):
+    """
+    Digest, start date and load segment name of each row of the rdb table of
+    load segments
+
+    :param rdb_loads: recarray of the rdb table
+    :param datecol: start date column
+    :param namecol: load segment name column
+    :rtype: list of [digest, datestart, load_segment] lists
+    """
+    rows = []
+    for row in rdb_loads:
+        text = '\t'.join(str(value) for value in row)
+        rows.append([hashlib.md5(text).hexdigest(), str(row[datecol]), str(row[namecol])])
+    return rows
+
+
+def first_changed_date(old_rows, new_rows):
+    """
+    Earliest start date of the rows that differ between two lists of row
+    digests (as from row_digests()), matched by (datestart, load_segment).
+    The iFOT rdb is a sliding window, so the old rows before the first new
+    row have just dropped out of it, and are not changes.
+
+    :param old_rows: row digests of the previous rdb
+    :param new_rows: row digests of the new rdb
+    :rtype: date string, or None if the rows are the same
+    """
+    if new_rows:
+        window_start = min(row[1] for row in new_rows)
+        old_rows = [row for row in old_rows if row[1] >= window_start]
+    old = set(tuple(row) for row in old_rows)
+    new = set(tuple(row) for row in new_rows)
+    changed = [row[1] for row in old ^ new]
+    return min(changed) if changed else None
+
+
+def read_fingerprint(filename):
+    """
+    Read a fingerprint file.
+
+    :param filename: fingerprint file name
+    :rtype: fingerprint dict, or None if missing, unreadable or an old version
+    """
+    if filename is None or not os.path.exists(filename):
+        return None
+    try:
+        with open(filename) as fh:
+            fingerprint = json.load(fh)
+    except ValueError:
+        return None
+    if not isinstance(fingerprint, dict) or fingerprint.get('version') != VERSION:
+        return None
+    return fingerprint
+
+
+def write_fingerprint(filename, fingerprint):
+    """
+    Write a fingerprint file (via a temporary file and a rename).
+
+    :param filename: fingerprint file name
+    :param fingerprint: dict of rdb_file, digest, rows, and db_state
+    """
+    fingerprint = dict(fingerprint, version=VERSION)
+    tmp_file = '%s.tmp.%d' % (filename, os.getpid())
+    with open(tmp_file, 'w') as fh:
+        json.dump(fingerprint, fh, sort_keys=True)
+    os.rename(tmp_file, filename)
@@ -9,6 +9,8 @@ import time
 import Ska.DBI
 from Chandra.Time import DateTime
 
+import migrate_db
+
 SKA = os.environ['SKA']
 
 def get_options():
@@ -79,7 +81,8 @@ def main():
                  'TABLE cmd_states',
                  'TABLE cmd_intpars', 'TABLE cmd_fltpars', 'TABLE cmds',
                  'TABLE timelines', 'TABLE load_segments',
-                 'TABLE tl_processing', 'TABLE tl_built_loads', 'TABLE tl_obsids'):
+                 'TABLE tl_processing', 'TABLE tl_built_loads', 'TABLE tl_obsids',
+                 'TABLE schema_version'):
 
         try:
             db.execute('DROP %s' % drop)
@@ -107,7 +110,9 @@ def main():
     from Ska.Shell import bash
     if (opt.dbi == 'sqlite'):
         bash("sqlite3 %s < sqlite_triggers.sql" % opt.server, )
-    
+
+    # bring the new tables up to the current schema version
+    migrate_db.migrate(db)
 
     if not opt.tstart:
         # Nothing more to do
@@ -150,6 +155,11 @@ def main():
 
         db.commit()
 
+    # set the lookup keys and times of any copied rows that did not have them
+    if opt.tl_processing:
+        migrate_db.backfill_lookup_keys(db)
+    migrate_db.backfill_times(db)
+
 
 if __name__ == '__main__':
     main()
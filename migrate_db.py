@@ -0,0 +1,494 @@
+#!/usr/bin/env python
+"""
+Versioned schema migrations for the timelines tables.
+
+Each migration upgrades the schema (and backfills any new columns) by one
+version.  The versions that have been applied to a database are recorded in
+its schema_version table, so running this script applies just the
+migrations that are missing, in order.  make_new_tables.py runs the
+migrations on the tables it creates.
+
+With sqlite, each migration and its schema_version row are applied in one
+transaction, so a failed migration leaves the schema as it was.  The
+migrations also skip the columns and indexes that a database already has
+(e.g. after a failed sybase migration, where DDL is not transactional), so
+they can be run again, and so that they only record the version of tables
+made from the current *_def.sql files (which have the columns and indexes
+of the latest migration).
+"""
+
+import os
+import re
+import time
+import logging
+from itertools import izip
+
+import Ska.DBI
+
+import sqlite_profile
+import chandra_dates
+
+log = logging.getLogger()
+log.setLevel(logging.DEBUG)
+
+# registered migrations, as (version, description, function)
+MIGRATIONS = []
+
+# the *_def.sql files, which have the schema of the latest migration
+SQL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# the lookups made by update_load_seg_db.py (and the sqlite_triggers.sql
+# foreign key checks), with representative values, for EXPLAIN QUERY PLAN
+HOT_QUERIES = (
+    ('built load', """select * from tl_built_loads where load_segment = 'CL001:0101'
+                      and year = 2010 order by sumfile_modtime desc"""),
+    ('built load by key', """select * from tl_built_loads where load_key = '001:0101'
+                             and year = 2010 order by sumfile_modtime desc"""),
+    ('processing', """select * from tl_processing where file = 'C001_0101.sum'
+                      and sumfile_modtime = 0 order by dir desc"""),
+    ('replan dir', """select * from tl_processing where file_key = '001:0101'
+                      and processing_tstart > '2010:001:00:00:00.000'
+                      order by year, processing_tstop desc"""),
+    ('replan rows', """select * from tl_processing where processing_tstart > '2010:001:00:00:00.000'
+                       order by year, processing_tstop desc"""),
+    ('ref timelines', """select * from timelines where datestart <= '2010:001:00:00:00.000'
+                         order by datestart desc"""),
+    ('db timelines', """select * from timelines where datestop >= '2010:001:00:00:00.000'
+                        order by datestart, load_segment_id"""),
+    ('defunct timelines', """select id from timelines where datestart > '2010:001:00:00:00.000'
+                             and fixed_by_hand = 0 and datestart <= datestop"""),
+    ('load timelines', "select * from timelines where load_segment_id in (1, 2)"),
+    ('db loads', """select * from load_segments where datestart >= '2010:001:00:00:00.000'
+                    order by datestart, load_scs"""),
+    ('clear cmds', "select timeline_id from cmds where timeline_id in (1, 2)"),
+    ('clear cmd_intpars', "select timeline_id from cmd_intpars where timeline_id in (1, 2)"),
+    ('clear cmd_fltpars', "select timeline_id from cmd_fltpars where timeline_id in (1, 2)"),
+    ('trigger cmd_intpars', "select cmd_id from cmd_intpars where cmd_id = 1"),
+    ('trigger cmd_fltpars', "select cmd_id from cmd_fltpars where cmd_id = 1"),
+    )
+
+
+def get_options():
+    from optparse import OptionParser
+    parser = OptionParser(usage='migrate_db.py [options]')
+    parser.set_defaults()
+    parser.add_option("--dbi",
+                      default='sqlite',
+                      help="Database interface (sqlite|sybase)")
+    parser.add_option("--server",
+                      default='db_base.db3',
+                      help="DBI server (<filename>|sybase)")
+    parser.add_option("--user",
+                      help="sybase user (default=Ska.DBI default)")
+    parser.add_option("--database",
+                      help="sybase database (default=Ska.DBI default)")
+    parser.add_option("--list",
+                      action='store_true',
+                      help="List the migrations and whether they have been applied")
+    parser.add_option("--journal_mode",
+                      help="sqlite journal mode to set, which persists in the database "
+                      + "(DELETE, TRUNCATE, PERSIST or WAL; WAL only on a local filesystem) "
+                      + "(default=leave it unchanged)")
+    parser.add_option("--explain",
+                      action='store_true',
+                      help="Show the query plans of the update_load_seg_db.py lookups (sqlite)")
+    parser.add_option("--backfill",
+                      action='store_true',
+                      help="Set any missing lookup keys and tstart/tstop times (e.g. of rows "
+                      + "added by hand)")
+    parser.add_option("--dryrun",
+                      action='store_true',
+                      help="Show the migrations that would be applied")
+    parser.add_option("--verbose",
+                      action='store_true',
+                      help="verbose")
+    (opt, args) = parser.parse_args()
+    return opt, args
+
+
+def migration(version, description):
+    """
+    Decorator to register a migration function ``func(dbh)`` as schema
+    ``version``
+    """
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort()
+        return func
+    return register
+
+
+def load_key(load_segment):
+    """
+    Normalized lookup key 'ddd:hhmm' of a load segment name, the part that
+    the CLddd:hhmm name match in get_built_load uses
+
+    :param load_segment: load segment name (e.g. CL276:0906)
+    :rtype: key string or None
+    """
+    match = re.search(r'CL(\d{3}):(\d{4})', load_segment, re.IGNORECASE)
+    if match is None:
+        return None
+    return '%s:%s' % match.groups()
+
+
+def file_key(filename):
+    """
+    Normalized lookup key 'ddd:hhmm' of a processing summary file name, the
+    part that the Cddd*hhmm.sum file match in get_replan_dir uses
+
+    :param filename: summary file name (e.g. C276_0906.sum)
+    :rtype: key string or None
+    """
+    match = re.search(r'^C(\d{3}).*(\d{4})\.sum$', filename, re.IGNORECASE | re.DOTALL)
+    if match is None:
+        return None
+    return '%s:%s' % match.groups()
+
+
+def has_column(dbh, table, column):
+    """
+    Return True if a table has a column
+    """
+    if dbh.dbi == 'sybase':
+        query = ("""select c.name from syscolumns c, sysobjects o
+                    where c.id = o.id and o.name = '%s' and c.name = '%s'""" % (table, column))
+        return len(dbh.fetchall(query)) > 0
+    return column in [row['name'] for row in dbh.fetchall("PRAGMA table_info(%s)" % table)]
+
+
+def add_column(dbh, table, column, coltype):
+    """
+    Add a column to a table, unless the table already has it.
+    """
+    if has_column(dbh, table, column):
+        log.info("MIGRATE INFO: %s already has column %s" % (table, column))
+        return
+    if dbh.dbi == 'sybase':
+        dbh.execute("ALTER TABLE %s ADD %s %s NULL" % (table, column, coltype), commit=False)
+    else:
+        dbh.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, coltype), commit=False)
+
+
+def table_exists(dbh, table):
+    if dbh.dbi == 'sybase':
+        query = "select name from sysobjects where name = '%s' and type = 'U'" % table
+    else:
+        query = "select name from sqlite_master where name = '%s' and type = 'table'" % table
+    return len(dbh.fetchall(query)) > 0
+
+
+def has_index(dbh, table, columns):
+    """
+    Return True if a sqlite table has an index (including a primary key)
+    with ``columns`` as its leading columns (always False for sybase)
+    """
+    if dbh.dbi == 'sybase':
+        return False
+    for index in dbh.fetchall("PRAGMA index_list(%s)" % table):
+        index_cols = [row['name'] for row in dbh.fetchall("PRAGMA index_info(%s)" % index['name'])]
+        if index_cols[:len(columns)] == list(columns):
+            return True
+    return False
+
+
+def add_index(dbh, name, table, columns):
+    """
+    Index ``columns`` of a table, unless the table is missing or (sqlite)
+    there is already an index on those columns.
+    """
+    if not table_exists(dbh, table):
+        log.info("MIGRATE INFO: no %s table, not adding index %s" % (table, name))
+        return
+    if has_index(dbh, table, columns):
+        log.info("MIGRATE INFO: %s (%s) already indexed" % (table, ', '.join(columns)))
+        return
+    log.info("MIGRATE INFO: adding index %s" % name)
+    dbh.execute("CREATE INDEX %s ON %s (%s)" % (name, table, ', '.join(columns)), commit=False)
+
+
+def explain(dbh):
+    """
+    EXPLAIN QUERY PLAN for each of the HOT_QUERIES (sqlite only)
+
+    :param dbh: database handle
+    :rtype: list of (query name, list of plan details)
+    """
+    plans = []
+    if dbh.dbi != 'sqlite':
+        return plans
+    for name, query in HOT_QUERIES:
+        try:
+            plan = [row['detail'] for row in dbh.fetchall("EXPLAIN QUERY PLAN " + query)]
+        except Exception as error:
+            plan = ['(%s)' % error]
+        plans.append((name, plan))
+    return plans
+
+
+def log_plans(plans, label):
+    for name, plan in plans:
+        log.info("MIGRATE INFO: %s query plan %s: %s" % (label, name, '; '.join(plan)))
+
+
+def backfill_lookup_keys(dbh, commit=True):
+    """
+    Set the load_key of tl_built_loads and the file_key of tl_processing
+    rows where they are not set (e.g. rows copied from a database without
+    the keys).
+
+    :param dbh: database handle
+    :param commit: commit the updates (otherwise left to the caller)
+    """
+    for table, column, namecol, keyfunc in (
+            ('tl_built_loads', 'load_key', 'load_segment', load_key),
+            ('tl_processing', 'file_key', 'file', file_key)):
+        names = dbh.fetchall("select distinct %s as name from %s where %s is null"
+                             % (namecol, table, column))
+        for row in names:
+            key = keyfunc(row['name'])
+            if key is None:
+                continue
+            dbh.execute("update %s set %s = '%s' where %s = '%s' and %s is null"
+                        % (table, column, key, namecol, row['name'], column),
+                        commit=False)
+        log.debug("MIGRATE DEBUG: backfilled %s.%s for %d names" % (table, column, len(names)))
+    if commit:
+        dbh.commit()
+
+
+def backfill_times(dbh, commit=True):
+    """
+    Set the tstart and tstop (Chandra seconds) of load_segments and
+    timelines rows from their datestart and datestop where they are not set
+    (e.g. rows copied from a database without the columns).
+
+    :param dbh: database handle
+    :param commit: commit the updates (otherwise left to the caller)
+    """
+    for table in ('load_segments', 'timelines'):
+        rows = dbh.fetchall("select id, datestart, datestop from %s "
+                            "where tstart is null or tstop is null" % table)
+        if len(rows):
+            tstarts = chandra_dates.date2secs([row['datestart'] for row in rows]).tolist()
+            tstops = chandra_dates.date2secs([row['datestop'] for row in rows]).tolist()
+            ids = [int(row['id']) for row in rows]
+            if dbh.dbi == 'sqlite':
+                dbh.conn.cursor().executemany(
+                    "update %s set tstart = ?, tstop = ? where id = ?" % table,
+                    izip(tstarts, tstops, ids))
+            else:
+                for tstart, tstop, id in izip(tstarts, tstops, ids):
+                    dbh.execute("update %s set tstart = %r, tstop = %r where id = %d"
+                                % (table, tstart, tstop, id), commit=False)
+        log.debug("MIGRATE DEBUG: backfilled %s.tstart/tstop for %d rows" % (table, len(rows)))
+    if commit:
+        dbh.commit()
+
+
+@migration(1, 'Add indexed load_key and file_key lookup columns')
+def add_lookup_keys(dbh):
+    add_column(dbh, 'tl_built_loads', 'load_key', 'varchar(8)')
+    add_column(dbh, 'tl_processing', 'file_key', 'varchar(8)')
+    add_index(dbh, 'tl_built_loads_load_key', 'tl_built_loads', ('year', 'load_key'))
+    add_index(dbh, 'tl_processing_file_key', 'tl_processing', ('file_key',))
+    backfill_lookup_keys(dbh, commit=False)
+
+
+@migration(2, 'Index the load segment, timeline, tl_* and cmds lookup columns')
+def add_lookup_indexes(dbh):
+    # (tl_built_loads lookups by (year, load_segment) use the primary key)
+    before = explain(dbh)
+    for name, table, columns in (
+            ('load_segments_datestart', 'load_segments', ('datestart', 'load_scs')),
+            ('timelines_datestart', 'timelines', ('datestart',)),
+            ('timelines_datestop', 'timelines', ('datestop',)),
+            ('timelines_load_segment_id', 'timelines', ('load_segment_id',)),
+            ('tl_processing_file', 'tl_processing', ('file', 'sumfile_modtime')),
+            ('tl_processing_processing_tstart', 'tl_processing', ('processing_tstart',)),
+            ('cmds_timeline_id', 'cmds', ('timeline_id',)),
+            ('cmd_intpars_timeline_id', 'cmd_intpars', ('timeline_id',)),
+            ('cmd_fltpars_timeline_id', 'cmd_fltpars', ('timeline_id',)),
+            ('cmd_intpars_cmd_id', 'cmd_intpars', ('cmd_id',)),
+            ('cmd_fltpars_cmd_id', 'cmd_fltpars', ('cmd_id',))):
+        add_index(dbh, name, table, columns)
+    log_plans(before, 'before')
+    log_plans(explain(dbh), 'after')
+
+
+@migration(3, 'Add numeric tstart and tstop columns to load_segments and timelines')
+def add_times(dbh):
+    for table in ('load_segments', 'timelines'):
+        add_column(dbh, table, 'tstart', 'float')
+        add_column(dbh, table, 'tstop', 'float')
+    backfill_times(dbh, commit=False)
+    add_index(dbh, 'load_segments_tstart', 'load_segments', ('tstart',))
+    add_index(dbh, 'timelines_tstart', 'timelines', ('tstart',))
+    add_index(dbh, 'timelines_tstop', 'timelines', ('tstop',))
+    try:
+        dbh.execute("DROP VIEW timeline_loads", commit=False)
+    except Exception:
+        log.info("MIGRATE INFO: no timeline_loads view to replace")
+    view = open(os.path.join(SQL_DIR, 'timeline_loads_def.sql')).read()
+    dbh.execute(view.strip().rstrip(';'), commit=False)
+
+
+# keep tstart and tstop in step with hand edits of datestart and datestop
+# (and fill them for rows inserted without them), for sqlite
+TIME_TRIGGERS = (
+    ('%(table)s_times_insert', """CREATE TRIGGER %(table)s_times_insert
+ AFTER INSERT ON %(table)s
+ FOR EACH ROW WHEN NEW.tstart IS NULL OR NEW.tstop IS NULL BEGIN
+  UPDATE %(table)s SET tstart = coalesce(NEW.tstart, %(tstart)s),
+                       tstop = coalesce(NEW.tstop, %(tstop)s)
+   WHERE id = NEW.id;
+ END"""),
+    ('%(table)s_times_update', """CREATE TRIGGER %(table)s_times_update
+ AFTER UPDATE OF datestart, datestop ON %(table)s
+ FOR EACH ROW BEGIN
+  UPDATE %(table)s SET tstart = %(tstart)s, tstop = %(tstop)s
+   WHERE id = NEW.id;
+ END"""),
+    )
+
+
+@migration(4, 'Recompute tstart and tstop when datestart or datestop change (sqlite triggers)')
+def add_time_triggers(dbh):
+    if dbh.dbi != 'sqlite':
+        log.info("MIGRATE INFO: time triggers are only made for sqlite")
+        return
+    for table in ('load_segments', 'timelines'):
+        values = dict(table=table, tstart=chandra_dates.sql_date2secs('NEW.datestart'),
+                      tstop=chandra_dates.sql_date2secs('NEW.datestop'))
+        for name, sql in TIME_TRIGGERS:
+            dbh.execute("DROP TRIGGER IF EXISTS %s" % (name % values), commit=False)
+            dbh.execute(sql % values, commit=False)
+    # and recompute the times of rows edited by hand before the triggers
+    for table in ('load_segments', 'timelines'):
+        dbh.execute("UPDATE %s SET tstart = coalesce(%s, tstart), tstop = coalesce(%s, tstop)"
+                    % (table, chandra_dates.sql_date2secs('datestart'),
+                       chandra_dates.sql_date2secs('datestop')), commit=False)
+
+
+def get_applied(dbh):
+    """
+    Return the list of applied migration versions, making the schema_version
+    table if needed
+    """
+    try:
+        rows = dbh.fetchall("select version from schema_version")
+    except Exception:
+        dbh.execute("""CREATE TABLE schema_version
+                       ( version int not null,
+                         description varchar(100),
+                         applied varchar(21) not null,
+                         CONSTRAINT pk_schema_version PRIMARY KEY (version) )""")
+        rows = []
+    return sorted(row['version'] for row in rows)
+
+
+def check_schema(dbh, server=None):
+    """
+    Raise a ValueError if a database does not have all of the migrations
+    (i.e. migrate_db.py has not been run on it since the scripts were
+    updated).
+
+    :param dbh: database handle
+    :param server: database name for the message
+    """
+    try:
+        applied = [row['version'] for row in dbh.fetchall("select version from schema_version")]
+    except Exception:
+        applied = []
+    missing = [version for version, description, func in MIGRATIONS if version not in applied]
+    if missing:
+        raise ValueError("Database %s is missing schema migration(s) %s; run migrate_db.py "
+                         "--server %s before this script"
+                         % (server or '', ', '.join(str(version) for version in missing),
+                            server or '<server>'))
+
+
+def apply_migration(dbh, version, description, func):
+    """
+    Apply one migration and record it in the schema_version table, in one
+    transaction for sqlite (whose DDL is transactional).
+
+    :param dbh: database handle
+    :param version: schema version
+    :param description: migration description
+    :param func: migration function
+    """
+    row = dict(version=version, description=description,
+               applied=time.strftime('%Y:%j:%H:%M:%S.000', time.gmtime()))
+    if dbh.dbi != 'sqlite':
+        func(dbh)
+        dbh.insert(row, 'schema_version', commit=True)
+        return
+    # (with the sqlite3 module's implicit transactions, each DDL statement
+    # would first commit the statements before it)
+    isolation_level = dbh.conn.isolation_level
+    dbh.conn.isolation_level = None
+    try:
+        dbh.conn.execute("BEGIN IMMEDIATE")
+        try:
+            func(dbh)
+            dbh.insert(row, 'schema_version', commit=False)
+            dbh.conn.execute("COMMIT")
+        except:
+            dbh.conn.execute("ROLLBACK")
+            raise
+    finally:
+        dbh.conn.isolation_level = isolation_level
+
+
+def migrate(dbh, dryrun=False):
+    """
+    Apply the migrations that have not yet been applied to a database.
+
+    :param dbh: database handle
+    :param dryrun: only log the migrations that would be applied
+    :rtype: list of the versions applied
+    """
+    applied = get_applied(dbh)
+    todo = []
+    for version, description, func in MIGRATIONS:
+        if version in applied:
+            continue
+        log.info("MIGRATE INFO: %s version %d: %s" % ('Would apply' if dryrun else 'Applying',
+                                                      version, description))
+        if not dryrun:
+            apply_migration(dbh, version, description, func)
+        todo.append(version)
+    if not todo:
+        log.info("MIGRATE INFO: No migrations required")
+    return todo
+
+
+def main():
+    (opt, args) = get_options()
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    if opt.verbose:
+        ch.setLevel(logging.DEBUG)
+    log.addHandler(ch)
+    dbh = Ska.DBI.DBI(dbi=opt.dbi, server=opt.server, user=opt.user, database=opt.database,
+                      verbose=opt.verbose)
+    sqlite_profile.apply_profile(dbh, journal_mode=opt.journal_mode)
+    if opt.explain:
+        log_plans(explain(dbh), 'current')
+        return
+    if opt.list:
+        applied = get_applied(dbh)
+        for version, description, func in MIGRATIONS:
+            log.info("%3d %-8s %s" % (version, 'applied' if version in applied else 'pending',
+                                      description))
+        return
+    migrate(dbh, dryrun=opt.dryrun)
+    if opt.backfill and not opt.dryrun:
+        backfill_lookup_keys(dbh)
+        backfill_times(dbh)
+    log.removeHandler(ch)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,8 +4,12 @@
 # and parse into a database to find the timeline of loads and
 # related mission panning directories
 #
-# A touch file is used to find summaries that are "newer" than the last
-# file processed by the tool
+# A manifest of every summary seen (path, size, mtime, md5 digest) is used
+# to find summaries that are new or changed since the last run.  The touch
+# file is still updated to the newest summary processed, and is used to
+# seed the manifest if there is no manifest yet.  When there are no new or
+# changed summaries the database is not opened (and the database and
+# parsing modules are not loaded).
 
 
 use strict;
@@ -13,13 +17,17 @@ use warnings;
 use IO::All;
 use File::stat;
 use File::Basename;
+use Digest::MD5;
+use Cwd;
+use POSIX qw( strftime );
+use IO::Select;
+use Storable qw( nfreeze thaw );
+use Time::HiRes;
+use JSON::PP;
+use FindBin;
 
 use Getopt::Long;
-use Ska::Parse_CM_File;
-use Ska::Convert qw( date2time );
 use Ska::Run;
-use Ska::DatabaseUtil qw( sql_insert_hash sql_connect sql_do );
-use Chandra::Time;
 
 use Data::Dumper;
 
@@ -30,113 +38,211 @@ my $MP_DIR = "/data/mpcrit1/mplogs/";
 
 my %opt = ( touch_file => "${SKA_DATA}/sum_files.touch",
 	    mp_dir => $MP_DIR,
+	    full_scan => 0,
+	    backstop_cache => "${SKA_DATA}/backstop_cache",
+	    parse_cache => "${SKA_DATA}/parse_cache",
+	    jobs => undef,
+	    batch_size => 50,
 	    dryrun => 0,
 	    dbi => 'sqlite',
 	    server => 'db_base.db3',
+	    sqlite_profile => "$FindBin::Bin/sqlite_profile.sql",
+	    busy_timeout => undef,
+	    journal_mode => undef,
     );
 
-GetOptions(\%opt,
-	   'verbose!',
-	   'touch_file=s',
-	   'mp_dir=s',
-	   'dryrun!',
-	   'dbi=s',
-	   'server=s',
-           'database=s',
-           'user=s',
-    );
+# the mp_dir and database handle are shared with the subroutines below
+my $mp_dir;
+my $load_handle;
+# content digests (from the manifest scan) of the summaries to ingest
+my %summary_digests;
 
-my $mp_dir = $opt{mp_dir};
-my $touch_file_dir = dirname($opt{touch_file});
-my $dir_status = run("mkdir -p $touch_file_dir") unless (-d $touch_file_dir);
-die("Error making touch_file directory $touch_file_dir") if $dir_status;
+# run as a script, or just load the subroutines if required by another
+# script (e.g. a benchmark)
+main() unless caller();
 
-# define a global that has the file status of the "touch file" (for modification times)
-my $touch_stat;
-if ($opt{verbose}){
-    print "Updating clgps tables with files newer than ", $opt{touch_file}, "\n";
-}
 
-if (-e $opt{touch_file}){    
-    $touch_stat = stat($opt{touch_file});
-}
+sub main{
+    GetOptions(\%opt,
+	       'verbose!',
+	       'touch_file=s',
+	       'manifest=s',
+	       'full_scan!',
+	       'backstop_cache=s',
+	       'parse_cache=s',
+	       'jobs=i',
+	       'batch_size=i',
+	       'mp_dir=s',
+	       'dryrun!',
+	       'dbi=s',
+	       'server=s',
+	       'database=s',
+	       'user=s',
+	       'parse_only!',
+	       'cache_only!',
+	       'rebuild!',
+	       'sqlite_profile=s',
+	       'busy_timeout=i',
+	       'journal_mode=s',
+	);
 
+    # just dump the parse_clgps output for the summaries on the command line
+    # (to compare against other parsers, e.g. clgps.py)
+    if ($opt{parse_only}){
+	load_modules();
+	my @parsed;
+	for my $file (@ARGV){
+	    my ( $week, $loads ) = parse_clgps( $file );
+	    push @parsed, { file => $file, week => $week, loads => $loads };
+	}
+	print JSON::PP->new->canonical->pretty->encode(\@parsed);
+	return;
+    }
 
-my $load_arg;
-if ($opt{dbi} eq 'sybase'){
-    my $user = defined $opt{user} ? $opt{user}
-              :      $opt{dryrun} ? 'aca_read' 
-                                  : 'aca_ops';
-    my $database = defined $opt{database}      ? $opt{database} 
-                 : defined $ENV{SKA_DATABASE}  ? $ENV{SKA_DATABASE}
-                                               : 'aca';
-    $load_arg = sprintf("%s-%s-%s", 'sybase', $database, $user);
-}
-else{
-    $load_arg = { database  => $opt{server},
-                     type => 'array',
-                     raise_error => 1,  
-                     print_error => 1,  
-                     DBI_module => 'dbi:SQLite', 
-                };
-}
+    # just write the backstops on the command line to the backstop cache
+    # (e.g. to check the cache layout against backstop_cache.py)
+    if ($opt{cache_only}){
+	die("--cache_only needs --backstop_cache\n") unless $opt{backstop_cache};
+	load_modules();
+	for my $backstop (@ARGV){
+	    my $cols = backstop_columns( $backstop );
+	    printf("%s: %d commands in %s\n", $backstop, scalar(@{$cols->{cmd}}),
+		   backstop_cache_file( $backstop ));
+	}
+	return;
+    }
 
-my $load_handle = sql_connect($load_arg);
+    $mp_dir = $opt{mp_dir};
 
-my @files;
+    # a rebuild parses every summary, so by default use all the cores
+    $opt{jobs} = $opt{rebuild} ? n_cpus() : 1 unless defined $opt{jobs};
+    if ($opt{rebuild} and $opt{dbi} ne 'sqlite'){
+	die("--rebuild is only supported with --dbi sqlite\n");
+    }
 
-my $max_touch_file;
-my $max_touch_time = 0;
+    # by default keep the manifest of seen summaries next to the touch file
+    if (not defined $opt{manifest}){
+	($opt{manifest} = $opt{touch_file}) =~ s/\.touch$//;
+	$opt{manifest} .= '.manifest';
+    }
+    my $touch_file_dir = dirname($opt{touch_file});
+    my $dir_status = run("mkdir -p $touch_file_dir") unless (-d $touch_file_dir);
+    die("Error making touch_file directory $touch_file_dir") if $dir_status;
 
-# find command load processing summaries newer than the touch file
-use POSIX qw( strftime );
-my $curr_year = strftime "%Y", gmtime(time());
-my $week_glob = '[A-Z][A-Z][A-Z][0-9][0-9][0-9][0-9]';
-my $sum_glob = 'C[0-9][0-9][0-9]?[0-9][0-9][0-9][0-9].sum';
-YEAR:
-for ( my $year = 1999; $year <= $curr_year; $year++){
-    my $cmd = "find -L ${mp_dir}/${year}/${week_glob}/ofls?/mps/ "
-	. " -maxdepth 1 -wholename \"*/ofls?/mps/${sum_glob}\" ";
-    if (defined $touch_stat){
-	$cmd .= " -newer $opt{touch_file}";
-	my $touch_year = strftime "%Y", gmtime($touch_stat->mtime());
-       next YEAR if $year < $touch_year-1;
-    }
-    print "$cmd \n" if $opt{verbose};
-    my ($status, @run_files) = run("$cmd");
-    next YEAR if $status;
-    map {chomp $_} @run_files;
-    for my $file (@run_files){
-	my $mtime = update_for_file( $file );
+    # file status of the "touch file" (for modification times)
+    my $touch_stat;
+    if ($opt{verbose}){
+	print "Updating clgps tables with summaries not yet in ", $opt{manifest}, "\n";
+    }
+
+    if (-e $opt{touch_file}){    
+	$touch_stat = stat($opt{touch_file});
+    }
+
+    # find new and changed command load processing summaries by comparing the
+    # mp_dir tree against the manifest of summaries seen on previous runs
+    # (or, for a rebuild, against an empty manifest to find all of them)
+    my $manifest = $opt{rebuild}
+	? { bootstrap => 1, files => {}, dirs => {}, children => {} }
+	: read_manifest( $opt{manifest}, $mp_dir );
+    my $scan = scan_summaries( $mp_dir, $manifest, $opt{rebuild} ? undef : $touch_stat );
+    if ($opt{verbose}){
+	printf("Summary scan of %s: %d new, %d changed, %d removed (%d directories read)\n",
+	       $mp_dir, scalar(@{$scan->{new}}), scalar(@{$scan->{changed}}),
+	       scalar(@{$scan->{removed}}), $scan->{n_dirs_read});
+	print "Removed summary ${mp_dir}/$_ \n" for @{$scan->{removed}};
+    }
+
+    my @ingest_files = map { "${mp_dir}/$_" } sort(@{$scan->{new}}, @{$scan->{changed}});
+    if (not @ingest_files and not $opt{rebuild}){
+	print "No new or changed summaries in ${mp_dir}, skipping the database update\n"
+	    if $opt{verbose};
+	write_manifest( $opt{manifest}, $mp_dir, $scan );
+	return;
+    }
+    load_modules();
+
+    my $load_arg;
+    if ($opt{dbi} eq 'sybase'){
+	my $user = defined $opt{user} ? $opt{user}
+		  :      $opt{dryrun} ? 'aca_read' 
+				      : 'aca_ops';
+	my $database = defined $opt{database}      ? $opt{database} 
+		     : defined $ENV{SKA_DATABASE}  ? $ENV{SKA_DATABASE}
+						   : 'aca';
+	$load_arg = sprintf("%s-%s-%s", 'sybase', $database, $user);
+    }
+    else{
+	$load_arg = { database  => $opt{server},
+			 type => 'array',
+			 raise_error => 1,  
+			 print_error => 1,  
+			 DBI_module => 'dbi:SQLite', 
+		    };
+    }
+
+    $load_handle = sql_connect($load_arg);
+    apply_sqlite_profile( $load_handle ) if ($opt{dbi} eq 'sqlite');
+    check_schema_version( $load_handle );
+
+    my $max_touch_file;
+    my $max_touch_time = 0;
+
+    %summary_digests = map { ("${mp_dir}/$_" => $scan->{files}->{$_}->{digest}) }
+			   (@{$scan->{new}}, @{$scan->{changed}});
+    my $ingested;
+    if ($opt{rebuild}){
+	# parse into a fresh database so that the live tables stay usable,
+	# and then swap the new rows in
+	my $rebuild_file = "$opt{server}.rebuild";
+	my $live_handle = $load_handle;
+	$load_handle = create_rebuild_db( $live_handle, $rebuild_file );
+	$ingested = ingest_files( \@ingest_files );
+	$load_handle->disconnect();
+	$load_handle = $live_handle;
+	swap_rebuild_db( $rebuild_file );
+    }
+    else{
+	$ingested = ingest_files( \@ingest_files );
+    }
+    for my $file (sort keys %{$ingested}){
+	my $mtime = $ingested->{$file};
 	if ($max_touch_time < $mtime){
 	    $max_touch_time = $mtime;
 	    $max_touch_file = $file;
-	}    
+	}
     }
-}
-
 
-# if the touch_stat is earlier than the file time or not defined, update the "touch file"
-if ( (defined $max_touch_file) and ($max_touch_time > 0)){
-    if ( ((defined $touch_stat) and ($touch_stat->mtime < $max_touch_time) )
-	 or ( not defined $touch_stat )) {
-	my ($t_status) = run("touch -r $max_touch_file $opt{touch_file}");
-	die("Error touching $opt{touch_file}") if $t_status;
-    }
-}
+    # only record the summaries in the manifest after they have all been ingested
+    write_manifest( $opt{manifest}, $mp_dir, $scan );
 
 
+    # if the touch_stat is earlier than the file time or not defined, update the "touch file"
+    if ( (defined $max_touch_file) and ($max_touch_time > 0)){
+	if ( ((defined $touch_stat) and ($touch_stat->mtime < $max_touch_time) )
+	     or ( not defined $touch_stat )) {
+	    my ($t_status) = run("touch -r $max_touch_file $opt{touch_file}");
+	    die("Error touching $opt{touch_file}") if $t_status;
+	}
+    }
 
+    # fold the WAL back into the database without waiting for readers
+    $load_handle->do("PRAGMA wal_checkpoint(PASSIVE)") if ($opt{dbi} eq 'sqlite');
+}
 
 
-sub update_for_file{
+sub parse_summary{
     my $file = shift;
 
+    # Parse a summary and the obsids in its backstop into the rows for
+    # tl_built_loads, tl_processing, and tl_obsids.  This does not touch
+    # the database, so it may be run in a parse worker.
+
     print "Parsing $file" if $opt{verbose};
 	
     my $file_stat = stat("$file");
 	
-    my ( $week, $loads ) = parse_clgps( $file );
+    my ( $week, $loads ) = cached_parse_clgps( $file, $summary_digests{$file} );
     my ( $dir, $filename);
     if ($file =~ /${mp_dir}(\/\d{4}\/\w{3}\d{4}\/ofls\w?\/)mps\/(C.*\.sum)/){
 	$dir = $1;
@@ -146,54 +252,297 @@ sub update_for_file{
     # exclude what appear to be weird testing directories
     if ($dir =~ /.*ofls(t|x)/) {
 	print "Skipping \n" if $opt{verbose};
-	return undef;
+	return { file => $file, skipped => 1 };
     }
 
+    my %parsed = ( file => $file,
+		   mtime => $file_stat->mtime,
+		   built_loads => [],
+		   processing => undef,
+		   obsids => [] );
+
     if (defined $dir and defined $filename){
 	$week->{dir} = $dir;
 	$week->{file} = $filename;
 	$week->{sumfile_modtime} = $file_stat->mtime; 
+	$week->{file_key} = file_key( $filename );
 	for my $load_ref (@{$loads}){
 	    $load_ref->{file} = $filename;
 	    $load_ref->{sumfile_modtime} = $week->{sumfile_modtime};
-	    my $delete = qq( delete from tl_built_loads where year = $load_ref->{year} 
-			     and load_segment = "$load_ref->{load_segment}" 
-			     and file = "$filename"
-                             and load_scs = $load_ref->{load_scs}
-			     and sumfile_modtime = $week->{sumfile_modtime} );
-	    sql_do( $load_handle, $delete);
-	    sql_insert_hash( $load_handle, 'tl_built_loads', $load_ref );
+	    $load_ref->{load_key} = load_key( $load_ref->{load_segment} );
+	    push @{$parsed{built_loads}}, $load_ref;
 	}
 	
 	# only bother to store if it has loads
-	sql_do( $load_handle, qq( delete from tl_processing where dir = "$dir" and file = "$filename"));
-	sql_insert_hash( $load_handle, 'tl_processing', $week );
+	$parsed{processing} = $week;
 	
 	my $obsids = get_obsids("${mp_dir}/${dir}", $loads);
 	for my $obs_load (keys %{$obsids}){
 	    for my $obs_entry (@{$obsids->{$obs_load}}){
 		my @ids = split('__', $obs_load);
-		my %obs_hash = (
+		push @{$parsed{obsids}}, {
 				dir => $dir,
 				year => $ids[0],
 				load_segment => $ids[1],
 				obsid => $obs_entry->{obsid},
 				date => $obs_entry->{date},
-				); 
-		my $obs_delete = qq( delete from tl_obsids where dir = "$dir"
-				     and year = $ids[0]
-				     and load_segment = "$ids[1]"
-				     and obsid = $obs_entry->{obsid}
-				     and date = "$obs_entry->{date}");
-		sql_do( $load_handle, $obs_delete );
-		sql_insert_hash( $load_handle, 'tl_obsids', \%obs_hash );
+				}; 
 	    }
 	}
     }
     
     print " ... Done \n" if $opt{verbose};
-    return $file_stat->mtime;
+    return \%parsed;
+
+}
 
+
+sub load_key{
+    my $load_segment = shift;
+
+    # normalized 'ddd:hhmm' lookup key of a CLddd:hhmm load segment name
+    # (see migrate_db.py)
+    return undef unless (defined $load_segment and $load_segment =~ /CL(\d{3}):(\d{4})/i);
+    return "$1:$2";
+}
+
+
+sub file_key{
+    my $file = shift;
+
+    # normalized 'ddd:hhmm' lookup key of a Cddd_hhmm.sum summary name
+    return undef unless (defined $file and $file =~ /^C(\d{3}).*(\d{4})\.sum$/is);
+    return "$1:$2";
+}
+
+
+# columns written to the tl_* tables, and their primary keys
+use constant TL_COLUMNS => {
+    tl_built_loads => [qw( year load_segment file first_cmd_time last_cmd_time
+			   load_scs sumfile_modtime load_key )],
+    tl_processing => [qw( year dir file replan continuity_cmds replan_cmds bcf_cmd_count
+			  planning_tstart planning_tstop processing_tstart processing_tstop
+			  execution_tstart sumfile_modtime file_key )],
+    tl_obsids => [qw( year load_segment dir obsid date )],
+};
+# schema version (see migrate_db.py) that adds the load_key and file_key columns
+use constant SCHEMA_VERSION => 1;
+use constant TL_KEYS => {
+    tl_built_loads => [qw( year load_segment file load_scs sumfile_modtime )],
+    tl_processing => [qw( dir file )],
+    tl_obsids => [qw( year dir load_segment obsid date )],
+};
+
+
+sub upsert_rows{
+    my $table = shift;
+    my $rows = shift;
+
+    # Insert or replace (on the primary key) a list of row hashes with
+    # prepared statements.  SQLite has native upsert; for other databases
+    # each row is deleted by primary key and then inserted.
+
+    my @cols = @{TL_COLUMNS->{$table}};
+    my $insert = sprintf("INSERT %s INTO %s (%s) VALUES (%s)",
+			 ($opt{dbi} eq 'sqlite') ? 'OR REPLACE' : '',
+			 $table, join(', ', @cols), join(', ', ('?') x @cols));
+    my $insert_sth = $load_handle->prepare_cached($insert);
+    if ($opt{dbi} eq 'sqlite'){
+	$insert_sth->execute(@{$_}{@cols}) for @{$rows};
+    }
+    else{
+	my @keys = @{TL_KEYS->{$table}};
+	my $delete_sth = $load_handle->prepare_cached(
+	    sprintf("DELETE FROM %s WHERE %s", $table, join(' AND ', map { "$_ = ?" } @keys)));
+	for my $row (@{$rows}){
+	    $delete_sth->execute(@{$row}{@keys});
+	    $insert_sth->execute(@{$row}{@cols});
+	}
+    }
+    return scalar(@{$rows});
+}
+
+
+sub write_summaries{
+    my $batch = shift;
+
+    # Replace the rows from a list of parsed summaries in the tl_* tables in
+    # a single transaction (rolled back on any error).  Returns the number
+    # of rows written.
+
+    my @built_loads = map { @{$_->{built_loads}} } @{$batch};
+    my @processing = grep { defined $_ } map { $_->{processing} } @{$batch};
+    my @obsids = map { @{$_->{obsids}} } @{$batch};
+
+    my $n_rows = 0;
+    $load_handle->begin_work();
+    my $ok = eval {
+	$n_rows += upsert_rows('tl_built_loads', \@built_loads);
+	$n_rows += upsert_rows('tl_processing', \@processing);
+	$n_rows += upsert_rows('tl_obsids', \@obsids);
+	$load_handle->commit();
+	1;
+    };
+    if (not $ok){
+	my $error = $@;
+	eval { $load_handle->rollback() };
+	die("Error writing " . scalar(@{$batch}) . " summaries (rolled back): $error");
+    }
+    return $n_rows;
+}
+
+
+sub ingest_files{
+    my $files = shift;
+
+    # Parse and store a list of summaries, writing --batch_size summaries
+    # per transaction.  With --jobs > 1, the summaries and backstops are
+    # parsed by a pool of forked workers and this process is the single
+    # writer.  Returns a hash of the modification times of the stored
+    # summaries.
+
+    my %mtimes;
+    my @batch;
+    my ($n_rows, $n_summaries, $write_time) = (0, 0, 0);
+    my $progress;
+    $progress = Progress->new( $files ) if $opt{rebuild};
+    my $write_batch = sub {
+	return unless @batch;
+	my $t0 = Time::HiRes::time();
+	$n_rows += write_summaries( \@batch );
+	$write_time += Time::HiRes::time() - $t0;
+	$n_summaries += @batch;
+	$mtimes{$_->{file}} = $_->{mtime} for @batch;
+	@batch = ();
+    };
+    my $store = sub {
+	my $parsed = shift;
+	$progress->update( $parsed->{file} ) if $progress;
+	return if $parsed->{skipped};
+	push @batch, $parsed;
+	$write_batch->() if (@batch >= $opt{batch_size});
+    };
+
+    if ($opt{jobs} <= 1 or @{$files} <= 1){
+	$store->( parse_summary( $_ ) ) for @{$files};
+    }
+    else{
+	run_parse_workers( $files, $opt{jobs}, $store );
+    }
+    $write_batch->();
+    $progress->report() if $progress;
+
+    if ($opt{verbose} and $n_summaries){
+	printf("Wrote %d rows from %d summaries in %.2f s (%.0f rows/s)\n",
+	       $n_rows, $n_summaries, $write_time,
+	       $write_time > 0 ? $n_rows / $write_time : 0);
+    }
+    return \%mtimes;
+}
+
+
+sub run_parse_workers{
+    my $files = shift;
+    my $n_jobs = shift;
+    my $callback = shift;
+
+    # Fork $n_jobs workers that each run parse_summary on an interleaved
+    # slice of @{$files} and send the results back over a pipe as
+    # length-prefixed Storable records.  $callback is called in this
+    # process with each parsed summary as it arrives.
+
+    my $select = IO::Select->new();
+    my %worker_pids;
+    for my $job (0 .. $n_jobs - 1){
+	my @job_files = map { $files->[$_] } grep { $_ % $n_jobs == $job } (0 .. $#{$files});
+	next unless @job_files;
+	pipe(my $reader, my $writer) or die("Could not make pipe for parse worker: $!");
+	my $pid = fork();
+	die("Could not fork parse worker: $!") unless defined $pid;
+	if ($pid == 0){
+	    # worker: leave the parent's database handle alone
+	    close($reader);
+	    $| = 1;
+	    $load_handle->{InactiveDestroy} = 1;
+	    binmode($writer);
+	    my $status = 0;
+	    for my $file (@job_files){
+		my $parsed = eval { parse_summary( $file ) };
+		my $message = defined $parsed ? { parsed => $parsed }
+		                              : { error => "Error parsing $file: $@" };
+		my $frozen = nfreeze($message);
+		print $writer pack('N', length($frozen)), $frozen;
+		if (not defined $parsed){
+		    $status = 1;
+		    last;
+		}
+	    }
+	    close($writer);
+	    POSIX::_exit($status);
+	}
+	close($writer);
+	binmode($reader);
+	$select->add($reader);
+	$worker_pids{$pid} = 1;
+    }
+
+    # a worker error, a truncated message, or an error from $callback (the
+    # database writer) stops the workers, and they are always reaped
+    my $error;
+    eval {
+      WORKERS:
+	while ($select->count()){
+	    for my $reader ($select->can_read()){
+		my $header = read_bytes($reader, 4);
+		if (not defined $header){
+		    $select->remove($reader);
+		    close($reader);
+		    next;
+		}
+		my $frozen = read_bytes($reader, unpack('N', $header));
+		die("Truncated message from parse worker\n") unless defined $frozen;
+		my $message = thaw($frozen);
+		if (defined $message->{error}){
+		    $error = $message->{error};
+		    last WORKERS;
+		}
+		$callback->( $message->{parsed} );
+	    }
+	}
+	1;
+    } or do {
+	$error = $@ || "Unknown error reading parse workers";
+    };
+
+    if (defined $error){
+	kill('TERM', keys %worker_pids);
+	# (so that no worker blocks on a full pipe)
+	for my $reader ($select->handles()){
+	    $select->remove($reader);
+	    close($reader);
+	}
+    }
+    for my $pid (keys %worker_pids){
+	waitpid($pid, 0);
+	$error = "Parse worker $pid exited with status " . ($? >> 8)
+	    if ($? and not defined $error);
+    }
+    die($error) if defined $error;
+}
+
+
+sub read_bytes{
+    my $fh = shift;
+    my $n_bytes = shift;
+
+    # read exactly $n_bytes from $fh, or return undef at end-of-file
+    my $buffer = '';
+    while (length($buffer) < $n_bytes){
+	my $n_read = sysread($fh, $buffer, $n_bytes - length($buffer), length($buffer));
+	die("Error reading from parse worker: $!") unless defined $n_read;
+	return undef if $n_read == 0;
+    }
+    return $buffer;
 }
 
 
@@ -209,19 +558,35 @@ sub get_obsids{
     my @bs_list = glob("${dir}/*.backstop");
     my $backstop = $bs_list[0];
 
-
-    my @bs = Ska::Parse_CM_File::backstop( $backstop);
+    # For each load, the obsids are the MP_OBSID commands after the first
+    # command time of the load, up to and including the first one after the
+    # last command time.  The backstop is parsed once into columns of the
+    # MP_OBSID commands, which are sliced for each load with a binary search
+    # (or scanned in order if the commands are not sorted by time).
+    my $obs = backstop_obsid_columns( $backstop );
+    my $times = $obs->{time};
     my %obsids_per_load;
     for my $load (@{$loads}){
 	my @obsids;
 	my $tstart = date2time($load->{first_cmd_time});
 	my $tstop = date2time($load->{last_cmd_time});
-	for my $entry (@bs){
-	    next unless ( $entry->{time} > $tstart );
-	    next unless ( $entry->{cmd} =~ /MP_OBSID/ );
-	    my %bs_params = Ska::Parse_CM_File::parse_params($entry->{params});
-	    push @obsids, { date => $entry->{date}, obsid => $bs_params{ID}};
-	    last if ( $entry->{time} > $tstop );
+	my @idx;
+	if ($obs->{sorted}){
+	    my $first = first_index_after($times, $tstart);
+	    my $last = first_index_after($times, $tstop);
+	    $last = $first if $last < $first;
+	    $last = $#{$times} if $last > $#{$times};
+	    @idx = ($first .. $last);
+	}
+	else{
+	    for my $i (0 .. $#{$times}){
+		next unless ( $times->[$i] > $tstart );
+		push @idx, $i;
+		last if ( $times->[$i] > $tstop );
+	    }
+	}
+	for my $i (@idx){
+	    push @obsids, { date => $obs->{date}->[$i], obsid => $obs->{obsid}->[$i] };
 	}
 	my $id = $load->{year} . "__" . $load->{load_segment};
 	$obsids_per_load{$id} = \@obsids;
@@ -230,6 +595,198 @@ sub get_obsids{
 }
 
 
+sub backstop_obsid_columns{
+    my $backstop = shift;
+
+    # Select the time, date, and obsid of the MP_OBSID commands (in
+    # backstop order) from the columns of a backstop
+
+    my $cols = backstop_columns( $backstop );
+    my %obs = ( time => [], date => [], obsid => [], sorted => 1 );
+    for my $i (0 .. $#{$cols->{cmd}}){
+	next unless ( $cols->{cmd}->[$i] =~ /MP_OBSID/ );
+	my $time = $cols->{time}->[$i];
+	$obs{sorted} = 0 if (@{$obs{time}} and $time < $obs{time}->[-1]);
+	push @{$obs{time}}, $time;
+	push @{$obs{date}}, $cols->{date}->[$i];
+	push @{$obs{obsid}}, ($cols->{obsid}->[$i] == -1 ? undef : $cols->{obsid}->[$i]);
+    }
+    return \%obs;
+}
+
+
+sub backstop_columns{
+    my $backstop = shift;
+
+    # Parse a backstop into parallel arrays of the time, date, cmd, and
+    # obsid (-1 for commands other than MP_OBSID) of each command.  If
+    # --backstop_cache is set, the columns are read from the cache when
+    # the backstop has the same path, size, and mtime as when it was
+    # cached, and otherwise the backstop is parsed and the cache updated.
+
+    my $cache_file;
+    if ($opt{backstop_cache} and defined $backstop){
+	$cache_file = backstop_cache_file( $backstop );
+	my $cols = read_backstop_cache( $cache_file, $backstop );
+	return $cols if defined $cols;
+    }
+
+    my %cols = ( time => [], date => [], cmd => [], obsid => [] );
+    for my $entry (Ska::Parse_CM_File::backstop( $backstop )){
+	my $obsid = -1;
+	if ( $entry->{cmd} =~ /MP_OBSID/ ){
+	    my %bs_params = Ska::Parse_CM_File::parse_params($entry->{params});
+	    $obsid = $bs_params{ID} if defined $bs_params{ID};
+	}
+	push @{$cols{time}}, $entry->{time};
+	push @{$cols{date}}, $entry->{date};
+	push @{$cols{cmd}}, $entry->{cmd};
+	push @{$cols{obsid}}, $obsid;
+    }
+    write_backstop_cache( $cache_file, $backstop, \%cols ) if defined $cache_file;
+    return \%cols;
+}
+
+
+###############################################################
+# Backstop cache
+#
+# Each cached backstop is a file <md5 of backstop real path>.bsc in the
+# cache directory, laid out so that it can be memory-mapped (see
+# backstop_cache.py for the reader):
+#
+#   header (40 bytes, little-endian):
+#     magic 'TLBSCACH', version uint32, n_cmds uint32,
+#     backstop size uint64, backstop mtime int64,
+#     path length uint32, reserved uint32
+#   backstop real path, null-padded to a multiple of 8 bytes
+#   time   float64[n_cmds]  (Chandra secs)
+#   obsid  int32[n_cmds]    (-1 if not an MP_OBSID command)
+#   date   char[21][n_cmds]
+#   cmd    char[32][n_cmds] (null padded)
+###############################################################
+
+# constants (rather than lexicals) so that they are set before main() runs
+use constant BACKSTOP_CACHE_MAGIC => 'TLBSCACH';
+use constant BACKSTOP_CACHE_VERSION => 2;
+use constant BACKSTOP_CACHE_HEADER => 'a8 V V Q< q< V V';
+use constant BACKSTOP_CACHE_HEADER_SIZE => 40;
+use constant BACKSTOP_CACHE_CMD_SIZE => 32;
+
+
+sub backstop_cache_file{
+    my $backstop = shift;
+    my $path = Cwd::abs_path($backstop);
+    return "$opt{backstop_cache}/" . Digest::MD5::md5_hex($path) . ".bsc";
+}
+
+
+sub read_backstop_cache{
+    my $cache_file = shift;
+    my $backstop = shift;
+
+    # return the cached columns, or undef if there is no cache entry
+    # for the current version of the backstop
+    return undef unless (-e $cache_file);
+    my @bs_stat = CORE::stat($backstop);
+    return undef unless @bs_stat;
+    my $path = Cwd::abs_path($backstop);
+
+    open(my $fh, '<', $cache_file) or return undef;
+    binmode($fh);
+    local $/;
+    my $data = <$fh>;
+    close($fh);
+    return undef if length($data) < BACKSTOP_CACHE_HEADER_SIZE;
+
+    my ($magic, $version, $n_cmds, $size, $mtime, $path_len)
+	= unpack(BACKSTOP_CACHE_HEADER, $data);
+    return undef unless ($magic eq BACKSTOP_CACHE_MAGIC
+			 and $version == BACKSTOP_CACHE_VERSION
+			 and $size == $bs_stat[7]
+			 and $mtime == $bs_stat[9]
+			 and substr($data, BACKSTOP_CACHE_HEADER_SIZE, $path_len) eq $path);
+
+    my $offset = BACKSTOP_CACHE_HEADER_SIZE + 8 * int(($path_len + 7) / 8);
+    return undef if length($data) != $offset + $n_cmds * (8 + 4 + 21 + BACKSTOP_CACHE_CMD_SIZE);
+    my %cols;
+    $cols{time} = [ unpack("d<${n_cmds}", substr($data, $offset, 8 * $n_cmds)) ];
+    $offset += 8 * $n_cmds;
+    $cols{obsid} = [ unpack("l<${n_cmds}", substr($data, $offset, 4 * $n_cmds)) ];
+    $offset += 4 * $n_cmds;
+    $cols{date} = [ unpack("(A21)${n_cmds}", substr($data, $offset, 21 * $n_cmds)) ];
+    $offset += 21 * $n_cmds;
+    $cols{cmd} = [ unpack(sprintf("(A%d)%d", BACKSTOP_CACHE_CMD_SIZE, $n_cmds),
+			  substr($data, $offset, BACKSTOP_CACHE_CMD_SIZE * $n_cmds)) ];
+    return \%cols;
+}
+
+
+sub write_backstop_cache{
+    my $cache_file = shift;
+    my $backstop = shift;
+    my $cols = shift;
+
+    # Write the columns of a backstop to its cache file (via a temporary
+    # file and a rename).  A failure to write the cache is not fatal.
+    my @bs_stat = CORE::stat($backstop);
+    return unless @bs_stat;
+    # (a longer command would be truncated in the cache)
+    my @long_cmds = grep { length($_) > BACKSTOP_CACHE_CMD_SIZE } @{$cols->{cmd}};
+    if (@long_cmds){
+	print STDERR "Not caching $backstop: command $long_cmds[0] is longer than ",
+	    BACKSTOP_CACHE_CMD_SIZE, " characters\n";
+	return;
+    }
+    my $path = Cwd::abs_path($backstop);
+    my $n_cmds = scalar(@{$cols->{time}});
+    my $path_pad = 8 * int((length($path) + 7) / 8);
+    my $data = pack(BACKSTOP_CACHE_HEADER, BACKSTOP_CACHE_MAGIC, BACKSTOP_CACHE_VERSION,
+		    $n_cmds, $bs_stat[7], $bs_stat[9], length($path), 0)
+	. pack("a${path_pad}", $path)
+	. pack("d<${n_cmds}", @{$cols->{time}})
+	. pack("l<${n_cmds}", @{$cols->{obsid}})
+	. pack("(a21)${n_cmds}", @{$cols->{date}})
+	. pack(sprintf("(a%d)%d", BACKSTOP_CACHE_CMD_SIZE, $n_cmds), @{$cols->{cmd}});
+
+    my $cache_dir = dirname($cache_file);
+    if (not -d $cache_dir){
+	my ($status) = run("mkdir -p $cache_dir");
+    }
+    my $tmp_file = "${cache_file}.tmp.$$";
+    my $fh;
+    my $ok = (open($fh, '>', $tmp_file)
+	      and binmode($fh)
+	      and print($fh $data)
+	      and close($fh)
+	      and rename($tmp_file, $cache_file));
+    if (not $ok){
+	print STDERR "Could not write backstop cache $cache_file for $backstop: $!\n";
+	unlink($tmp_file);
+    }
+}
+
+
+sub first_index_after{
+    my $times = shift;
+    my $time = shift;
+
+    # binary search for the index of the first element of the sorted
+    # array @{$times} that is greater than $time (or the array length)
+    my ($low, $high) = (0, scalar(@{$times}));
+    while ($low < $high){
+	my $mid = int(($low + $high) / 2);
+	if ($times->[$mid] > $time){
+	    $high = $mid;
+	}
+	else{
+	    $low = $mid + 1;
+	}
+    }
+    return $low;
+}
+
+
 sub parse_clgps {
     my $gps = shift;
 
@@ -335,6 +892,65 @@ sub parse_clgps {
 
 
 
+###############################################################
+# Parse cache
+#
+# The week and loads from parse_clgps for each summary are kept as JSON
+# in <parse_cache>/<md5 of the summary contents>.json, so a summary is
+# only parsed once however often it is touched, copied, or rebuilt.
+# clgps.py reads and writes the same files.
+###############################################################
+
+use constant PARSE_CACHE_VERSION => 1;
+
+
+sub cached_parse_clgps{
+    my $file = shift;
+    my $digest = shift;
+
+    return parse_clgps( $file ) unless $opt{parse_cache};
+    $digest = file_digest( $file ) unless defined $digest;
+    my $cache_file = "$opt{parse_cache}/${digest}.json";
+    if (-e $cache_file){
+	my $cached = eval { JSON::PP->new->decode( io($cache_file)->slurp ) };
+	if (defined $cached and ref($cached) eq 'HASH'
+	    and ($cached->{version} || 0) == PARSE_CACHE_VERSION){
+	    return ( $cached->{week}, $cached->{loads} );
+	}
+    }
+    my ( $week, $loads ) = parse_clgps( $file );
+    write_parse_cache( $cache_file, $week, $loads );
+    return ( $week, $loads );
+}
+
+
+sub write_parse_cache{
+    my $cache_file = shift;
+    my $week = shift;
+    my $loads = shift;
+
+    # write via a temporary file and a rename; a failure is not fatal
+    my $data = JSON::PP->new->canonical->encode({ version => PARSE_CACHE_VERSION,
+						  week => $week,
+						  loads => $loads });
+    my $cache_dir = dirname($cache_file);
+    if (not -d $cache_dir){
+	my ($status) = run("mkdir -p $cache_dir");
+    }
+    my $tmp_file = "${cache_file}.tmp.$$";
+    my $fh;
+    my $ok = (open($fh, '>', $tmp_file)
+	      and print($fh $data)
+	      and close($fh)
+	      and rename($tmp_file, $cache_file));
+    if (not $ok){
+	print STDERR "Could not write parse cache $cache_file: $!\n";
+	unlink($tmp_file);
+    }
+}
+
+
+
 ###############################################################
 sub obsids_in_segments{
 ###############################################################
@@ -360,3 +976,463 @@ sub obsids_in_segments{
 
     return @segment_times;
 }
+
+
+
+###############################################################
+sub load_modules{
+###############################################################
+
+# Load the summary parsing and database modules (only needed when there
+# are summaries to parse, so that a run with nothing new starts quickly)
+
+    require Ska::Parse_CM_File;
+    require Ska::Convert;
+    Ska::Convert->import('date2time');
+    require Ska::DatabaseUtil;
+    Ska::DatabaseUtil->import('sql_connect');
+    require Chandra::Time;
+}
+
+
+###############################################################
+sub n_cpus{
+###############################################################
+
+# number of online processors, for the default --jobs of a rebuild
+
+    my $n_cpus = `nproc 2>/dev/null`;
+    chomp $n_cpus if defined $n_cpus;
+    return (defined $n_cpus and $n_cpus =~ /^\d+$/ and $n_cpus > 0) ? $n_cpus : 1;
+}
+
+
+###############################################################
+sub apply_sqlite_profile{
+###############################################################
+
+# Apply the PRAGMAs of the shared sqlite connection profile
+# (sqlite_profile.sql, also used by the python scripts) to a
+# database handle, with --busy_timeout instead of the profile
+# busy_timeout if given, and set the --journal_mode if given (it
+# is persistent, so otherwise it is left as it is, and WAL is
+# refused on a network filesystem, as in sqlite_profile.py).
+
+    my $handle = shift;
+
+    my $journal_mode = defined $opt{journal_mode} ? uc($opt{journal_mode}) : undef;
+    die("Unknown --journal_mode $opt{journal_mode}\n")
+	if (defined $journal_mode and $journal_mode !~ /^(DELETE|TRUNCATE|PERSIST|WAL)$/);
+    if (defined $journal_mode and $journal_mode eq 'WAL'){
+	my $fstype = filesystem_type( $opt{server} );
+	die("$opt{server} is on a $fstype filesystem; WAL journaling needs a local filesystem\n")
+	    if (defined $fstype
+		and grep { $_ eq $fstype } qw( nfs nfs4 cifs smbfs smb3 afs lustre gpfs fuse.sshfs ));
+    }
+
+    if (defined $opt{sqlite_profile} and $opt{sqlite_profile} ne ''){
+	my $profile = io($opt{sqlite_profile})->slurp;
+	$profile =~ s/--[^\n]*//g;
+	for my $statement (split(/;/, $profile)){
+	    $statement =~ s/^\s+|\s+$//g;
+	    next if ($statement eq '');
+	    next if (defined $opt{busy_timeout} and $statement =~ /^PRAGMA\s+busy_timeout\b/i);
+	    $handle->do($statement);
+	}
+	print "Applied sqlite profile $opt{sqlite_profile} \n" if $opt{verbose};
+    }
+    $handle->do("PRAGMA busy_timeout = $opt{busy_timeout}") if (defined $opt{busy_timeout});
+    $handle->do("PRAGMA journal_mode = $journal_mode") if (defined $journal_mode);
+    # with WAL, NORMAL is still safe against corruption (and synchronous
+    # is not persistent, so it is set again for a WAL database)
+    my ($current_mode) = $handle->selectrow_array("PRAGMA journal_mode");
+    $handle->do("PRAGMA synchronous = NORMAL") if (uc($current_mode) eq 'WAL');
+}
+
+
+###############################################################
+sub filesystem_type{
+###############################################################
+
+# Type of the filesystem (from /proc/mounts) that a file is on, or
+# undef if it is not known.
+
+    my $file = shift;
+
+    return undef unless (-e '/proc/mounts');
+    my $path = Cwd::abs_path( -e $file ? $file : dirname($file) );
+    return undef unless defined $path;
+    my ($fstype, $mount_len) = (undef, -1);
+    open(my $mounts, '<', '/proc/mounts') or return undef;
+    while (my $line = <$mounts>){
+	my (undef, $mount, $type) = split(' ', $line);
+	next unless defined $type;
+	$mount =~ s/\\([0-7]{3})/chr(oct($1))/ge;
+	(my $prefix = $mount) =~ s{/$}{};
+	if (($path eq $mount or index($path, "$prefix/") == 0) and length($mount) > $mount_len){
+	    ($fstype, $mount_len) = ($type, length($mount));
+	}
+    }
+    close($mounts);
+    return $fstype;
+}
+
+
+###############################################################
+sub check_schema_version{
+###############################################################
+
+# Die with a clear message if the database has not been migrated (with
+# migrate_db.py) to the schema version that these tl_* columns need.
+
+    my $handle = shift;
+
+    my $versions = eval { $handle->selectcol_arrayref("SELECT version FROM schema_version") };
+    my %applied = map { ($_ => 1) } @{$versions || []};
+    my @missing = grep { not $applied{$_} } (1 .. SCHEMA_VERSION);
+    if (@missing){
+	die(sprintf("Database %s is missing schema migration(s) %s; "
+		    . "run migrate_db.py --server %s before this script\n",
+		    $opt{server}, join(', ', @missing), $opt{server}));
+    }
+}
+
+
+###############################################################
+sub create_rebuild_db{
+###############################################################
+
+# Make a fresh sqlite database file for a rebuild with the same tl_*
+# table and index definitions as the live database, and return a
+# handle to it.
+
+    my $live_handle = shift;
+    my $rebuild_file = shift;
+
+    unlink($rebuild_file) if (-e $rebuild_file);
+    my $rebuild_handle = sql_connect({ database  => $rebuild_file,
+				       type => 'array',
+				       raise_error => 1,
+				       print_error => 1,
+				       DBI_module => 'dbi:SQLite',
+				     });
+    my $tables = join(', ', map { "'$_'" } sort keys %{TL_COLUMNS()});
+    my $schema = $live_handle->selectcol_arrayref(
+	"SELECT sql FROM sqlite_master WHERE tbl_name IN ($tables) "
+	. "AND type IN ('table', 'index') AND sql IS NOT NULL "
+	. "ORDER BY type = 'index', name");
+    die("No tl_* tables found in $opt{server}\n") unless @{$schema};
+    # the rebuild file is just scratch until it is swapped in
+    $rebuild_handle->do("PRAGMA synchronous = OFF");
+    $rebuild_handle->do("PRAGMA journal_mode = OFF");
+    $rebuild_handle->do($_) for @{$schema};
+    print "Rebuilding tl_* tables in $rebuild_file \n" if $opt{verbose};
+    return $rebuild_handle;
+}
+
+
+###############################################################
+sub swap_rebuild_db{
+###############################################################
+
+# Replace the contents of the live tl_* tables with the rebuilt ones
+# in a single transaction, so readers see either the old or the new
+# tables, and remove the rebuild file.  (The live tables share their
+# database file with the timelines and cmd_states tables, so the file
+# itself can not just be renamed into place.)
+
+    my $rebuild_file = shift;
+
+    $load_handle->do("ATTACH DATABASE ? AS rebuild", undef, $rebuild_file);
+    $load_handle->begin_work();
+    my $ok = eval {
+	for my $table (sort keys %{TL_COLUMNS()}){
+	    $load_handle->do("DELETE FROM main.${table}");
+	    $load_handle->do("INSERT INTO main.${table} SELECT * FROM rebuild.${table}");
+	}
+	$load_handle->commit();
+	1;
+    };
+    if (not $ok){
+	my $error = $@;
+	eval { $load_handle->rollback() };
+	$load_handle->do("DETACH DATABASE rebuild");
+	die("Error swapping in rebuilt tables from $rebuild_file (rolled back): $error");
+    }
+    $load_handle->do("DETACH DATABASE rebuild");
+    unlink($rebuild_file);
+    print "Swapped rebuilt tl_* tables into $opt{server} \n" if $opt{verbose};
+}
+
+
+###############################################################
+sub read_manifest{
+###############################################################
+
+# Read the manifest of previously seen summaries.  Paths are stored
+# relative to the mp_dir recorded in the manifest header, and the
+# directory mtimes are kept so that unchanged directories do not
+# need to be re-read.  If the manifest is missing or was made for a
+# different mp_dir, an empty "bootstrap" manifest is returned.
+
+    my $manifest_file = shift;
+    my $mp_dir = shift;
+
+    my %manifest = ( bootstrap => 1, files => {}, dirs => {}, children => {} );
+    return \%manifest unless (-e $manifest_file);
+
+    open(my $fh, '<', $manifest_file)
+	or die("Could not open manifest $manifest_file: $!");
+    while (my $line = <$fh>){
+	chomp $line;
+	next if ($line =~ /^#/ or $line eq '');
+	my @fields = split("\t", $line);
+	if ($fields[0] eq 'mp_dir'){
+	    if ($fields[1] ne $mp_dir){
+		print "Manifest $manifest_file is for $fields[1], rescanning $mp_dir \n"
+		    if $opt{verbose};
+		close($fh);
+		return { bootstrap => 1, files => {}, dirs => {}, children => {} };
+	    }
+	    $manifest{bootstrap} = 0;
+	}
+	elsif ($fields[0] eq 'D'){
+	    $manifest{dirs}->{$fields[1]} = $fields[2];
+	}
+	elsif ($fields[0] eq 'F'){
+	    $manifest{files}->{$fields[1]} = { size => $fields[2],
+					       mtime => $fields[3],
+					       digest => $fields[4] };
+	}
+	else{
+	    die("Unexpected line in manifest $manifest_file: $line");
+	}
+	# keep track of the names in each directory for unchanged directories
+	if ($fields[0] eq 'D' or $fields[0] eq 'F'){
+	    my ($name, $parent) = fileparse($fields[1]);
+	    $parent =~ s/\/$//;
+	    push @{$manifest{children}->{$parent}}, $name;
+	}
+    }
+    close($fh);
+    return \%manifest;
+}
+
+
+###############################################################
+sub scan_summaries{
+###############################################################
+
+# Walk the YYYY/WEEK/ofls?/mps/ tree under mp_dir and compare the
+# summaries found with the manifest.  Directories are only re-read
+# if their mtime has changed since the last scan, summaries are only
+# digested if their size or mtime has changed (and are only changed if
+# their digest has changed), and years more than
+# one year older than the newest summary seen are carried forward
+# from the manifest without being visited (unless --full_scan).
+#
+# Returns a hash with new, changed, and removed lists of paths
+# relative to mp_dir, and the dirs and files to store in the manifest.
+
+    my $mp_dir = shift;
+    my $manifest = shift;
+    my $touch_stat = shift;
+
+    my %scan = ( new => [], changed => [], removed => [],
+		 dirs => {}, files => {}, n_dirs_read => 0,
+		 manifest => $manifest, mp_dir => $mp_dir,
+		 # when bootstrapping a manifest, use the touch file to
+		 # decide which of the summaries have already been processed
+		 seen_before => ($manifest->{bootstrap} and defined $touch_stat)
+		                ? $touch_stat->mtime : undef,
+	);
+
+    my $curr_year = strftime "%Y", gmtime(time());
+    my $first_year = 1999;
+    if (not $manifest->{bootstrap} and not $opt{full_scan}){
+	my $max_mtime = 0;
+	for my $entry (values %{$manifest->{files}}){
+	    $max_mtime = $entry->{mtime} if $entry->{mtime} > $max_mtime;
+	}
+	if ($max_mtime > 0){
+	    my $newest_year = strftime "%Y", gmtime($max_mtime);
+	    $first_year = $newest_year - 1;
+	}
+    }
+
+    # carry forward the entries for the years that are not scanned
+    for my $type ('dirs', 'files'){
+	for my $rel (keys %{$manifest->{$type}}){
+	    my ($year) = ($rel =~ /^(\d{4})/);
+	    if (defined $year and $year < $first_year){
+		$scan{$type}->{$rel} = $manifest->{$type}->{$rel};
+	    }
+	}
+    }
+
+    for my $year ($first_year .. $curr_year){
+	walk_summary_dir(\%scan, $year, 0);
+    }
+
+    for my $rel (sort keys %{$manifest->{files}}){
+	push @{$scan{removed}}, $rel unless defined $scan{files}->{$rel};
+    }
+
+    return \%scan;
+}
+
+
+###############################################################
+sub walk_summary_dir{
+###############################################################
+
+# Recursive helper for scan_summaries for the directory $rel at
+# depth $level below a year directory
+
+    my $scan = shift;
+    my $rel = shift;
+    my $level = shift;
+
+    # week directories, ofls directories, the mps directory and the summaries
+    my @level_patterns = ( qr/^[A-Z]{3}\d{4}$/,
+			   qr/^ofls.$/,
+			   qr/^mps$/,
+			   qr/^C\d{3}.\d{4}\.sum$/ );
+
+    my $path = "$scan->{mp_dir}/${rel}";
+    my @dir_stat = CORE::stat($path);
+    return unless (@dir_stat and -d _);
+    my $dir_mtime = $dir_stat[9];
+    $scan->{dirs}->{$rel} = $dir_mtime;
+
+    my $manifest = $scan->{manifest};
+    my @names;
+    my $prev_mtime = $manifest->{dirs}->{$rel};
+    if (defined $prev_mtime and $prev_mtime == $dir_mtime){
+	@names = @{$manifest->{children}->{$rel} || []};
+    }
+    else{
+	opendir(my $dh, $path) or return;
+	@names = grep { $_ =~ $level_patterns[$level] } readdir($dh);
+	closedir($dh);
+	$scan->{n_dirs_read}++;
+    }
+
+    for my $name (sort @names){
+	my $child = "${rel}/${name}";
+	if ($level < $#level_patterns){
+	    walk_summary_dir($scan, $child, $level + 1);
+	    next;
+	}
+	my @file_stat = CORE::stat("$scan->{mp_dir}/${child}");
+	next unless (@file_stat and -f _);
+	my ($size, $mtime) = @file_stat[7, 9];
+	my $prev = $manifest->{files}->{$child};
+	if (defined $prev and $prev->{size} == $size and $prev->{mtime} == $mtime){
+	    $scan->{files}->{$child} = $prev;
+	    next;
+	}
+	my $digest = file_digest("$scan->{mp_dir}/${child}");
+	$scan->{files}->{$child} = { size => $size,
+				     mtime => $mtime,
+				     digest => $digest };
+	if (defined $prev){
+	    # a summary that was only touched or copied again keeps its rows,
+	    # and just gets its new size and mtime in the manifest
+	    push @{$scan->{changed}}, $child if ($prev->{digest} ne $digest);
+	}
+	# a summary with the same mtime as the touch file may not have been
+	# processed; ingesting it again is harmless (the rows are upserted)
+	elsif (not (defined $scan->{seen_before} and $mtime < $scan->{seen_before})){
+	    push @{$scan->{new}}, $child;
+	}
+    }
+}
+
+
+###############################################################
+sub file_digest{
+###############################################################
+    my $file = shift;
+    open(my $fh, '<', $file) or die("Could not open $file: $!");
+    binmode($fh);
+    my $digest = Digest::MD5->new->addfile($fh)->hexdigest;
+    close($fh);
+    return $digest;
+}
+
+
+###############################################################
+sub write_manifest{
+###############################################################
+
+# Write the directories and summaries from a scan to the manifest file.
+# The file is written to a temporary name and renamed into place.
+
+    my $manifest_file = shift;
+    my $mp_dir = shift;
+    my $scan = shift;
+
+    my $tmp_file = "${manifest_file}.tmp.$$";
+    open(my $fh, '>', $tmp_file)
+	or die("Could not write manifest $tmp_file: $!");
+    print $fh "# command load generation processing summary manifest\n";
+    print $fh "mp_dir\t${mp_dir}\n";
+    for my $rel (sort keys %{$scan->{dirs}}){
+	print $fh join("\t", 'D', $rel, $scan->{dirs}->{$rel}), "\n";
+    }
+    for my $rel (sort keys %{$scan->{files}}){
+	my $entry = $scan->{files}->{$rel};
+	print $fh join("\t", 'F', $rel, $entry->{size}, $entry->{mtime}, $entry->{digest}), "\n";
+    }
+    close($fh) or die("Error writing manifest $tmp_file: $!");
+    rename($tmp_file, $manifest_file)
+	or die("Could not rename $tmp_file to $manifest_file: $!");
+}
+
+
+###############################################################
+package Progress;
+###############################################################
+
+# Progress (summaries, bytes, rate, and ETA) of parsing a list of
+# summaries, printed at most every REPORT_INTERVAL seconds.
+
+use constant REPORT_INTERVAL => 10;
+
+sub new{
+    my ($class, $files) = @_;
+    my $total_bytes = 0;
+    $total_bytes += (-s $_ || 0) for @{$files};
+    return bless { n_files => scalar(@{$files}), total_bytes => $total_bytes,
+		   done_files => 0, done_bytes => 0,
+		   start => Time::HiRes::time(), last_report => Time::HiRes::time() }, $class;
+}
+
+sub update{
+    my ($self, $file) = @_;
+    $self->{done_files}++;
+    $self->{done_bytes} += (-s $file || 0);
+    $self->report() if (Time::HiRes::time() - $self->{last_report} >= REPORT_INTERVAL);
+}
+
+sub report{
+    my $self = shift;
+    my $elapsed = Time::HiRes::time() - $self->{start};
+    my $rate = $elapsed > 0 ? $self->{done_bytes} / $elapsed : 0;
+    my $eta = $rate > 0 ? ($self->{total_bytes} - $self->{done_bytes}) / $rate : 0;
+    printf("Progress: %d/%d summaries, %.1f/%.1f MB, %.1f summaries/s, %.2f MB/s, "
+	   . "elapsed %s, ETA %s\n",
+	   $self->{done_files}, $self->{n_files},
+	   $self->{done_bytes} / 1e6, $self->{total_bytes} / 1e6,
+	   $elapsed > 0 ? $self->{done_files} / $elapsed : 0, $rate / 1e6,
+	   hms($elapsed), hms($eta));
+    $self->{last_report} = Time::HiRes::time();
+}
+
+sub hms{
+    my $secs = int(shift() + 0.5);
+    return sprintf("%d:%02d:%02d", $secs / 3600, ($secs % 3600) / 60, $secs % 60);
+}
+
+1;
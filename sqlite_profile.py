@@ -0,0 +1,130 @@
+"""
+Apply the shared sqlite connection profile (sqlite_profile.sql: busy
+timeout, mmap and cache sizes, WAL autocheckpoint) and a journal mode to a
+database handle.  parse_cmd_load_gen.pl reads the same file.
+
+The journal mode is persistent, so it is only set when a script is given
+its explicit option (otherwise the mode of the database is left as it
+is, so that WAL set once stays in effect).  WAL is refused for a database on a network
+filesystem, where the processes do not share the WAL index memory.
+"""
+
+import os
+import re
+
+PROFILE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sqlite_profile.sql')
+JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'WAL')
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afs', 'lustre', 'gpfs',
+                       'fuse.sshfs')
+MOUNTS_FILE = '/proc/mounts'
+
+
+def filesystem_type(filename, mounts_file=MOUNTS_FILE):
+    """
+    Type of the filesystem (from /proc/mounts) that a file is on.
+
+    :param filename: file name
+    :param mounts_file: mount table
+    :rtype: filesystem type, or None if it is not known
+    """
+    if not os.path.exists(mounts_file):
+        return None
+    path = os.path.realpath(filename)
+    fstype = None
+    mount_len = -1
+    for line in open(mounts_file):
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        # (spaces etc. in mount points are octal escapes)
+        mount = re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), fields[1])
+        if ((path == mount or path.startswith(mount.rstrip('/') + '/'))
+                and len(mount) > mount_len):
+            fstype = fields[2]
+            mount_len = len(mount)
+    return fstype
+
+
+def check_journal_mode(filename, journal_mode, mounts_file=MOUNTS_FILE):
+    """
+    Raise a ValueError for an unknown journal mode, or for WAL on a
+    network filesystem.
+
+    :param filename: database file name
+    :param journal_mode: journal mode
+    :param mounts_file: mount table
+    :rtype: None
+    """
+    if journal_mode.upper() not in JOURNAL_MODES:
+        raise ValueError("journal mode %s is not one of %s" % (journal_mode, ', '.join(JOURNAL_MODES)))
+    if journal_mode.upper() == 'WAL':
+        fstype = filesystem_type(filename, mounts_file)
+        if fstype in NETWORK_FILESYSTEMS:
+            raise ValueError("%s is on a %s filesystem; WAL journaling needs a local filesystem"
+                             % (filename, fstype))
+
+
+def read_profile(profile_file=None, busy_timeout=None, journal_mode=None):
+    """
+    Read the PRAGMA statements of a connection profile.
+
+    :param profile_file: profile file (default=sqlite_profile.sql next to this module)
+    :param busy_timeout: busy timeout (ms) to use instead of the profile value
+    :param journal_mode: journal mode to set (default=leave it unchanged)
+    :rtype: list of statements
+    """
+    if profile_file is None:
+        profile_file = PROFILE_FILE
+    text = re.sub(r'--[^\n]*', '', open(profile_file).read())
+    statements = [stmt.strip() for stmt in text.split(';') if stmt.strip()]
+    if busy_timeout is not None:
+        statements = [stmt for stmt in statements
+                      if not re.match(r'PRAGMA\s+busy_timeout\b', stmt, re.IGNORECASE)]
+        statements.append('PRAGMA busy_timeout = %d' % busy_timeout)
+    if journal_mode is not None:
+        statements.append('PRAGMA journal_mode = %s' % journal_mode.upper())
+        # with WAL, NORMAL is still safe against corruption (a power loss
+        # may only lose the last commits)
+        if journal_mode.upper() == 'WAL':
+            statements.append('PRAGMA synchronous = NORMAL')
+    return statements
+
+
+def apply_profile(dbh, profile_file=None, busy_timeout=None, journal_mode=None):
+    """
+    Apply the connection profile and a journal mode to a Ska.DBI handle (if
+    it is sqlite).
+
+    :param dbh: database handle
+    :param profile_file: profile file (default=sqlite_profile.sql)
+    :param busy_timeout: busy timeout (ms) to use instead of the profile value
+    :param journal_mode: journal mode to set (DELETE, TRUNCATE, PERSIST or WAL;
+                         WAL is refused on a network filesystem) (default=leave
+                         it unchanged)
+    :rtype: None
+    """
+    if dbh.dbi != 'sqlite':
+        return
+    if journal_mode is not None:
+        filename = [row['file'] for row in dbh.fetchall('PRAGMA database_list')
+                    if row['name'] == 'main'][0]
+        if filename:
+            check_journal_mode(filename, journal_mode)
+    for stmt in read_profile(profile_file, busy_timeout, journal_mode):
+        dbh.execute(stmt)
+    # (synchronous is not persistent, so set it again for a WAL database)
+    if (journal_mode is None
+            and dbh.fetchone('PRAGMA journal_mode')['journal_mode'].upper() == 'WAL'):
+        dbh.execute('PRAGMA synchronous = NORMAL')
+
+
+def checkpoint(dbh):
+    """
+    Checkpoint the WAL of a sqlite database, without waiting for readers.
+
+    :param dbh: database handle
+    :rtype: None
+    """
+    if dbh.dbi != 'sqlite':
+        return
+    dbh.execute('PRAGMA wal_checkpoint(PASSIVE)')
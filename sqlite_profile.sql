@@ -0,0 +1,23 @@
+-- Connection profile for the sqlite timelines / cmd_states databases.
+--
+-- These PRAGMAs are applied to each connection that update_load_seg_db.py,
+-- parse_cmd_load_gen.pl and migrate_db.py make to a sqlite database, so
+-- that readers (the cmd_states tools, dashboards) are not locked out
+-- while the tables are updated.
+--
+-- The journal mode is not set here: it is persistent (it changes the
+-- database file for every later connection), so each script sets it from
+-- its --journal_mode option, which is DELETE unless WAL is asked for.  WAL
+-- journaling lets readers keep reading the last committed data while a
+-- writer is active, but it needs shared memory between the processes using
+-- the database, so it is refused for a database on a network filesystem.
+--
+-- milliseconds to wait for a lock before "database is locked"
+-- (--busy_timeout overrides this)
+PRAGMA busy_timeout = 30000;
+-- memory-map up to 256 MB of the database file
+PRAGMA mmap_size = 268435456;
+-- 64 MB page cache (negative values are in KiB)
+PRAGMA cache_size = -65536;
+-- with WAL, checkpoint the WAL into the database every 1000 pages
+PRAGMA wal_autocheckpoint = 1000;
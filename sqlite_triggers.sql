@@ -1,3 +1,6 @@
+-- (the triggers that keep load_segments and timelines tstart / tstop in
+-- step with datestart / datestop are made by migrate_db.py, version 4)
+
 CREATE TRIGGER fkd_load_segment_id 
 BEFORE DELETE on load_segments
 FOR EACH ROW BEGIN
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""
+Run the update stage of the timelines cron task (update_load_seg_db.py)
+only if its inputs have changed.
+
+The inputs are fingerprinted with just the standard library (no numpy,
+Ska.DBI or Chandra.Time): the newest iFOT load segment rdb file, and the
+database state that update_load_seg_db.py records in its own fingerprint
+(loadseg_fingerprint.sqlite_db_state: the row counts and max modification
+times or ids of the tl_* tables and of load_segments and timelines, a
+digest of the load_segments and timelines rows, and the fix_*.py repair
+scripts).  The fingerprint of the last successful run
+of each stage is kept in a JSON checkpoint file.
+
+The parse stage (parse_cmd_load_gen.pl) is not wrapped: it compares the
+mp_dir tree with its summary manifest itself, and exits without loading
+the database and parsing modules when there is nothing new.
+
+The stage command follows ``--``, and is looked up next to this script if
+it is not a path::
+
+  stage_checkpoint.py --checkpoint stages.json --server cmd_states.db3 \\
+      update -- update_load_seg_db.py --server cmd_states.db3 --verbose
+
+A stage is also run if one of its ``--output`` files is missing, or with
+``--force``.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import logging
+import subprocess
+
+import loadseg_fingerprint
+
+log = logging.getLogger()
+log.setLevel(logging.DEBUG)
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+VERSION = 1
+STAGES = ('update',)
+
+
+def get_options():
+    from optparse import OptionParser
+    parser = OptionParser(usage='stage_checkpoint.py [options] update -- <command> [args]')
+    parser.disable_interspersed_args()
+    parser.add_option("--checkpoint",
+                      default=os.path.join(os.environ.get('SKA', '/proj/sot/ska'),
+                                           'data', 'timelines', 'stage_checkpoint.json'),
+                      help="checkpoint file of the stage input fingerprints")
+    parser.add_option("--server",
+                      default='db_base.db3',
+                      help="sqlite database file")
+    parser.add_option("--loadseg_rdb_dir",
+                      default=os.path.join(os.environ.get('SKA', '/proj/sot/ska'), 'data', 'arc',
+                                           'iFOT_events', 'load_segment'),
+                      help="directory containing iFOT rdb files of load segments")
+    parser.add_option("--output",
+                      action='append',
+                      default=[],
+                      help="file made by the stage; the stage is run if it is missing "
+                      + "(may be repeated)")
+    parser.add_option("--force",
+                      action='store_true',
+                      help="run the stage even if its inputs are unchanged")
+    parser.add_option("--verbose",
+                      action='store_true',
+                      help="verbose")
+    (opt, args) = parser.parse_args()
+    if args and args[0] in STAGES and len(args) > 1 and args[1] == '--':
+        args = [args[0]] + args[2:]
+    if len(args) < 2 or args[0] not in STAGES:
+        parser.error("give a stage (%s) and its command" % ', '.join(STAGES))
+    return opt, args
+
+
+def update_inputs(opt):
+    """
+    Fingerprint of the inputs of the update stage
+
+    :param opt: options
+    :rtype: dict, or None if the database is missing or cannot be read
+    """
+    db_state = loadseg_fingerprint.sqlite_db_state(opt.server, BIN_DIR)
+    if db_state is None:
+        log.info("TIMELINES INFO: update inputs unknown: cannot read %s" % opt.server)
+        return None
+    inputs = dict(db_state)
+    rdb_files = glob.glob(os.path.join(opt.loadseg_rdb_dir, '*'))
+    if rdb_files:
+        rdb_file = max(rdb_files)
+        stat = os.stat(rdb_file)
+        inputs['rdb'] = [rdb_file, stat.st_size, int(stat.st_mtime)]
+    return inputs
+
+
+def read_checkpoint(filename):
+    """
+    Read the checkpoint file.
+
+    :param filename: checkpoint file name
+    :rtype: dict of stage dicts (empty if missing, unreadable or an old version)
+    """
+    if not os.path.exists(filename):
+        return {}
+    try:
+        with open(filename) as fh:
+            checkpoint = json.load(fh)
+    except ValueError:
+        return {}
+    if not isinstance(checkpoint, dict) or checkpoint.get('version') != VERSION:
+        return {}
+    return checkpoint.get('stages', {})
+
+
+def write_checkpoint(filename, stages):
+    """
+    Write the checkpoint file (via a temporary file and a rename).
+
+    :param filename: checkpoint file name
+    :param stages: dict of stage dicts
+    """
+    tmp_file = '%s.tmp.%d' % (filename, os.getpid())
+    with open(tmp_file, 'w') as fh:
+        json.dump(dict(version=VERSION, stages=stages), fh, sort_keys=True, indent=1)
+    os.rename(tmp_file, filename)
+
+
+def run_stage(opt, stage, cmd):
+    """
+    Run the command of a stage unless its inputs are unchanged since the
+    last successful run, and record the inputs after a successful run.
+
+    :param opt: options
+    :param stage: stage name (update)
+    :param cmd: command list
+    :rtype: exit status (0 if skipped)
+    """
+    stages = read_checkpoint(opt.checkpoint)
+    last = stages.get(stage)
+    inputs = update_inputs(opt)
+    missing = [output for output in opt.output if not os.path.exists(output)]
+    if opt.force:
+        log.info("TIMELINES INFO: running %s (forced)" % stage)
+    elif missing:
+        log.info("TIMELINES INFO: running %s: %s missing" % (stage, ', '.join(missing)))
+    elif last is None:
+        log.info("TIMELINES INFO: running %s: no checkpoint in %s" % (stage, opt.checkpoint))
+    elif inputs is not None and inputs == last['inputs']:
+        log.info("TIMELINES INFO: skipping %s: inputs unchanged since %s"
+                 % (stage, last['date']))
+        return 0
+    elif inputs is not None:
+        changed = sorted(key for key in set(inputs) | set(last['inputs'])
+                         if inputs.get(key) != last['inputs'].get(key))
+        log.info("TIMELINES INFO: running %s: changed %s" % (stage, ', '.join(changed)))
+
+    if not os.path.dirname(cmd[0]) and os.path.exists(os.path.join(BIN_DIR, cmd[0])):
+        cmd = [os.path.join(BIN_DIR, cmd[0])] + cmd[1:]
+    log.debug("TIMELINES DEBUG: Running %s" % ' '.join(cmd))
+    sys.stdout.flush()
+    status = subprocess.call(cmd)
+    if status != 0:
+        log.warn("TIMELINES WARN: %s exited with status %d" % (cmd[0], status))
+        return status
+
+    inputs = update_inputs(opt)
+    if inputs is None:
+        log.info("TIMELINES INFO: %s inputs unknown after the run, not recorded" % stage)
+        stages.pop(stage, None)
+    else:
+        stages[stage] = dict(inputs=inputs,
+                             date=time.strftime('%Y:%j:%H:%M:%S', time.gmtime()))
+    write_checkpoint(opt.checkpoint, stages)
+    return 0
+
+
+def main():
+    (opt, args) = get_options()
+    ch = logging.StreamHandler(sys.stdout)
+    ch.setLevel(logging.INFO)
+    if opt.verbose:
+        ch.setLevel(logging.DEBUG)
+    log.addHandler(ch)
+    status = run_stage(opt, args[0], args[1:])
+    log.removeHandler(ch)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+"""
+Answer "which timeline (or mission planning directory) covers time t"
+questions from an in-memory index of the timeline_loads view.
+
+The timelines are read once, sorted by start time, into numpy arrays, and
+each lookup is a ``searchsorted`` over those arrays, so a whole array of
+times (e.g. every command time of a backstop) is mapped to timelines in
+one vectorized pass instead of one query per time::
+
+  from timeline_index import TimelineIndex
+  index = TimelineIndex(dbh)
+  index.dir_for_time('2010:150:02:00:00.000')
+  ids = index.timeline_for_time(cmds['time'])
+
+Times may be Chandra seconds or date strings.  The index is re-read when
+the max id of the timelines table changes (which it does on every update
+by update_load_seg_db.py), at most every ``refresh_interval`` seconds.
+
+Timelines of different SCS slots can overlap; a time covered by more than
+one timeline maps to the covering timeline that starts last.
+"""
+
+import time
+
+import numpy as np
+
+import chandra_dates
+
+
+class TimelineIndex(object):
+    """
+    Sorted interval index of the timeline_loads view.
+
+    :param dbh: database handle (Ska.DBI, numpy=True)
+    :param refresh_interval: minimum seconds between checks for new timelines
+    """
+    def __init__(self, dbh, refresh_interval=0):
+        self.dbh = dbh
+        self.refresh_interval = refresh_interval
+        self.max_id = None
+        self.last_check = None
+        self.timelines = None
+        self.refresh()
+
+    def _max_id(self):
+        return self.dbh.fetchone('SELECT max(id) AS max_id FROM timelines')['max_id']
+
+    def refresh(self, force=False):
+        """
+        Re-read the timelines if the max timelines id has changed (or if
+        ``force``).
+
+        :rtype: True if the timelines were re-read
+        """
+        now = time.time()
+        if (not force and self.last_check is not None
+                and now - self.last_check < self.refresh_interval):
+            return False
+        self.last_check = now
+        max_id = self._max_id()
+        if not force and self.timelines is not None and max_id == self.max_id:
+            return False
+        self.max_id = max_id
+        self.load()
+        return True
+
+    def load(self):
+        timelines = self.dbh.fetchall('SELECT * FROM timeline_loads ORDER BY datestart, id')
+        self.timelines = timelines
+        if len(timelines) == 0:
+            self.tstart = self.tstop = self.stop_max = np.zeros(0)
+            return
+        tstart, tstop = chandra_dates.row_times(timelines)
+        order = np.argsort(tstart, kind='mergesort')
+        self.timelines = timelines[order]
+        self.tstart = tstart[order]
+        self.tstop = tstop[order]
+        # latest stop of the timelines up to each index, to skip the
+        # timelines that have ended
+        self.stop_max = np.maximum.accumulate(self.tstop)
+
+    def _secs(self, times):
+        times = np.asarray(times)
+        if times.dtype.kind in ('S', 'U'):
+            if times.ndim == 0:
+                return np.asarray(chandra_dates.date2secs(times.item()))
+            return chandra_dates.date2secs(times)
+        return times.astype(float)
+
+    def index_for_time(self, times):
+        """
+        Index (into ``self.timelines``) of the timeline covering each time,
+        or -1 where no timeline covers the time.
+
+        :param times: time or array of times (Chandra secs or dates)
+        :rtype: int or numpy array of ints
+        """
+        self.refresh()
+        secs = self._secs(times)
+        scalar = secs.ndim == 0
+        secs = np.atleast_1d(secs)
+        if len(self.tstart) == 0:
+            return -1 if scalar else np.repeat(-1, len(secs))
+        idx = np.searchsorted(self.tstart, secs, side='right') - 1
+        valid = idx >= 0
+        covered = np.zeros(len(secs), dtype=bool)
+        covered[valid] = self.tstop[idx[valid]] > secs[valid]
+        # an earlier, longer timeline may cover a time after the last one
+        # that started has ended
+        for i in np.flatnonzero(valid & ~covered & (self.stop_max[np.maximum(idx, 0)] > secs)):
+            j = idx[i]
+            while self.tstop[j] <= secs[i]:
+                j -= 1
+            idx[i] = j
+            covered[i] = True
+        idx[~covered] = -1
+        return int(idx[0]) if scalar else idx
+
+    def timeline_for_time(self, times):
+        """
+        Id of the timeline covering each time, or -1 where there is none.
+
+        :param times: time or array of times (Chandra secs or dates)
+        :rtype: int or numpy array of ints
+        """
+        idx = self.index_for_time(times)
+        if np.ndim(idx) == 0:
+            return int(self.timelines['id'][idx]) if idx >= 0 else -1
+        if len(self.timelines) == 0:
+            return np.repeat(-1, len(idx))
+        return np.where(idx >= 0, self.timelines['id'][idx], -1)
+
+    def dir_for_time(self, times):
+        """
+        Mission planning directory of the timeline covering each time.
+
+        :param times: time or array of times (Chandra secs or dates)
+        :rtype: directory (or None) or numpy array of directories ('' for none)
+        """
+        idx = self.index_for_time(times)
+        if np.ndim(idx) == 0:
+            return self.timelines['mp_dir'][idx] if idx >= 0 else None
+        if len(self.timelines) == 0:
+            return np.repeat('', len(idx))
+        return np.where(idx >= 0, self.timelines['mp_dir'][idx], '')
+
+    def loads_between(self, t0, t1):
+        """
+        Timelines (rows of timeline_loads) overlapping the interval t0 to t1.
+
+        :param t0: start time (Chandra secs or date)
+        :param t1: stop time (Chandra secs or date)
+        :rtype: recarray of timeline_loads rows, sorted by start time
+        """
+        self.refresh()
+        t0 = float(self._secs(t0))
+        t1 = float(self._secs(t1))
+        i0 = np.searchsorted(self.stop_max, t0, side='right')
+        i1 = np.searchsorted(self.tstart, t1, side='left')
+        if i1 <= i0:
+            return self.timelines[0:0]
+        overlap = self.tstop[i0:i1] > t0
+        return self.timelines[i0:i1][overlap]
@@ -6,6 +6,8 @@ CREATE VIEW timeline_loads AS
   ls.year          as year,
   tl.datestart     as datestart,
   tl.datestop      as datestop,
+  tl.tstart        as tstart,
+  tl.tstop         as tstop,
   ls.load_scs      as scs,
   tl.dir           as mp_dir,
   tl.replan        as replan,
@@ -0,0 +1,136 @@
+"""
+Write (and memory-map) the binary snapshot of the timeline_loads view that
+update_load_seg_db.py publishes after each update (``--timeline_snapshot``).
+
+Read-only tools can map the snapshot instead of opening the database and
+running the timeline_loads join.  The file has a fixed 40 byte header
+followed by one contiguous array per column, sorted by timeline start time,
+and then the table of mission planning directories:
+
+===============  ========  ==================================================
+Column           Type      Contents
+===============  ========  ==================================================
+tstart           float64   timeline start (Chandra secs)
+tstop            float64   timeline stop (Chandra secs)
+id               int64     timeline id
+load_segment_id  int64     load segment id
+scs              int32     load segment SCS slot
+dir_index        int32     index of the timeline mp_dir in the directories
+flags            uint8     REPLAN | PREDICTED | FIXED_BY_HAND bits
+===============  ========  ==================================================
+
+The file is written to a temporary name and renamed into place, so a
+reader always maps a complete snapshot (and keeps the one it has mapped
+when a new one is published).
+"""
+
+import os
+import time
+import struct
+
+import numpy as np
+
+import chandra_dates
+
+MAGIC = 'TLSNAPSH'
+VERSION = 1
+# magic, version, n_rows, n_dirs, dir length, max timelines id, write time
+HEADER = struct.Struct('<8sIIIIqd')
+COLUMNS = (('tstart', '<f8'),
+           ('tstop', '<f8'),
+           ('id', '<i8'),
+           ('load_segment_id', '<i8'),
+           ('scs', '<i4'),
+           ('dir_index', '<i4'),
+           ('flags', 'u1'))
+REPLAN = 1
+PREDICTED = 2
+FIXED_BY_HAND = 4
+
+
+def _padded(length):
+    return 8 * ((length + 7) // 8)
+
+
+def get_columns(dbh):
+    """
+    Read the timeline_loads view into the snapshot columns.
+
+    :param dbh: database handle (Ska.DBI, numpy=True)
+    :rtype: (dict of column arrays, array of mp_dirs)
+    """
+    rows = dbh.fetchall('SELECT * FROM timeline_loads ORDER BY datestart, id')
+    if len(rows) == 0:
+        return (dict((name, np.zeros(0, dtype=dtype)) for name, dtype in COLUMNS),
+                np.zeros(0, dtype='S1'))
+    tstart, tstop = chandra_dates.row_times(rows)
+    order = np.argsort(tstart, kind='mergesort')
+    rows = rows[order]
+    dirs, dir_index = np.unique(np.asarray(rows['mp_dir'], dtype='S'), return_inverse=True)
+    flags = (np.where(rows['replan'] == 1, REPLAN, 0)
+             | np.where(rows['predicted'] == 1, PREDICTED, 0)
+             | np.where(rows['fixed_by_hand'] == 1, FIXED_BY_HAND, 0))
+    cols = dict(tstart=tstart[order], tstop=tstop[order], id=rows['id'],
+                load_segment_id=rows['load_segment_id'], scs=rows['scs'],
+                dir_index=dir_index, flags=flags)
+    return cols, dirs
+
+
+def write_snapshot(dbh, filename):
+    """
+    Write a snapshot of the timeline_loads view (via a temporary file and a
+    rename).
+
+    :param dbh: database handle (Ska.DBI, numpy=True)
+    :param filename: snapshot file name
+    :rtype: number of timelines written
+    """
+    cols, dirs = get_columns(dbh)
+    n_rows = len(cols['id'])
+    dir_len = max(dirs.dtype.itemsize, 1)
+    max_id = int(cols['id'].max()) if n_rows else 0
+    tmp_filename = '%s.tmp.%d' % (filename, os.getpid())
+    with open(tmp_filename, 'wb') as fh:
+        fh.write(HEADER.pack(MAGIC, VERSION, n_rows, len(dirs), dir_len, max_id, time.time()))
+        size = 0
+        for name, dtype in COLUMNS:
+            data = np.asarray(cols[name], dtype=dtype).tostring()
+            fh.write(data)
+            size += len(data)
+        fh.write('\0' * (_padded(size) - size))
+        fh.write(np.asarray(dirs, dtype='S%d' % dir_len).tostring())
+    os.rename(tmp_filename, filename)
+    return n_rows
+
+
+def read_snapshot(filename):
+    """
+    Memory-map the columns of a timeline_loads snapshot.
+
+    :param filename: snapshot file name
+    :rtype: (header dict with n_rows, max_id, time and the dirs array;
+             dict of column arrays)
+    """
+    with open(filename, 'rb') as fh:
+        magic, version, n_rows, n_dirs, dir_len, max_id, write_time = \
+            HEADER.unpack(fh.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("%s is not a version %d timeline snapshot file" % (filename, VERSION))
+
+    cols = {}
+    offset = HEADER.size
+    for name, dtype in COLUMNS:
+        if n_rows == 0:
+            cols[name] = np.zeros(0, dtype=dtype)
+        else:
+            cols[name] = np.memmap(filename, dtype=dtype, mode='r',
+                                   offset=offset, shape=(n_rows,))
+        offset += n_rows * np.dtype(dtype).itemsize
+    offset = HEADER.size + _padded(offset - HEADER.size)
+    if n_dirs == 0:
+        dirs = np.zeros(0, dtype='S%d' % dir_len)
+    else:
+        dirs = np.memmap(filename, dtype='S%d' % dir_len, mode='r',
+                         offset=offset, shape=(n_dirs,))
+    header = dict(n_rows=n_rows, max_id=max_id, time=write_time, dirs=dirs)
+    return header, cols
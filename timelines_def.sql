@@ -7,7 +7,14 @@ CREATE TABLE timelines (
   replan          bit not null,
   incomplete      bit not null,
   fixed_by_hand   bit not null,
+  tstart          float null,
+  tstop           float null,
   CONSTRAINT pk_timelines_id PRIMARY KEY (id),
   CONSTRAINT fk_timelines_load_segments_id FOREIGN KEY (load_segment_id) REFERENCES load_segments (id)
-) 
+);
 
+CREATE INDEX timelines_datestart ON timelines (datestart);
+CREATE INDEX timelines_datestop ON timelines (datestop);
+CREATE INDEX timelines_load_segment_id ON timelines (load_segment_id);
+CREATE INDEX timelines_tstart ON timelines (tstart);
+CREATE INDEX timelines_tstop ON timelines (tstop)
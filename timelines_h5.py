@@ -0,0 +1,238 @@
+"""
+Keep an HDF5 mirror of the load_segments, timelines and tl_obsids tables
+(updated by update_load_seg_db.py --h5file).
+
+Each table is an HDF5 table (``/load_segments``, ``/timelines`` and
+``/tl_obsids``) with fixed-width columns, zlib-compressed and chunked, with
+the rows sorted by date, so that bulk analyses can read just the columns
+and date range they need::
+
+  import timelines_h5
+  cols = timelines_h5.read_columns('timelines.h5', 'timelines', ['tstart', 'dir'],
+                                   datestart='2010:001:00:00:00.000')
+
+An update compares the mirror with the database from a start date,
+truncates the mirror at the first row that differs, and appends the
+database rows from there.  The start date of load_segments and timelines
+is the first load segment that update_load_seg_db.py may have changed;
+tl_obsids (written by parse_cmd_load_gen.pl) is compared from the last
+date in the mirror.  A change before the start date (found with one
+checksum query of the row count and the sums of the integer columns and
+of the whole seconds of the times) rewrites the table from its first row.
+"""
+
+import numpy as np
+import tables
+
+import chandra_dates
+
+# table: (date column, SQL ordering, column types)
+TABLES = (
+    ('load_segments', 'datestart', 'datestart, id',
+     [('id', 'i4'), ('load_segment', 'S15'), ('year', 'i4'),
+      ('datestart', 'S21'), ('datestop', 'S21'), ('load_scs', 'i4'),
+      ('fixed_by_hand', 'i1'), ('tstart', 'f8'), ('tstop', 'f8')]),
+    ('timelines', 'datestart', 'datestart, id',
+     [('id', 'i4'), ('load_segment_id', 'i4'), ('dir', 'S20'),
+      ('datestart', 'S21'), ('datestop', 'S21'), ('replan', 'i1'),
+      ('incomplete', 'i1'), ('fixed_by_hand', 'i1'), ('tstart', 'f8'), ('tstop', 'f8')]),
+    ('tl_obsids', 'date', 'date, year, dir, load_segment, obsid',
+     [('year', 'i4'), ('load_segment', 'S10'), ('dir', 'S20'),
+      ('obsid', 'i4'), ('date', 'S22')]),
+    )
+# the tables written by update_load_seg_db.py (which are compared from its
+# start date)
+SINCE_TABLES = ('load_segments', 'timelines')
+# columns summed (as integers) in the checksum of the rows before the start date
+CHECKSUM_COLUMNS = dict(load_segments=('id', 'load_scs', 'fixed_by_hand', 'tstart', 'tstop'),
+                        timelines=('id', 'load_segment_id', 'replan', 'incomplete',
+                                   'fixed_by_hand', 'tstart', 'tstop'),
+                        tl_obsids=('year', 'obsid'))
+FILTERS = tables.Filters(complevel=5, complib='zlib')
+
+
+def as_dtype(rows, dtype):
+    """
+    Convert database rows to the fixed-width mirror columns.  NULLs become
+    '' (strings) or 0, and missing or NULL tstart / tstop values are computed
+    from datestart / datestop.
+
+    :param rows: recarray of database rows
+    :param dtype: list of (column, type)
+    :rtype: numpy structured array
+    """
+    out = np.zeros(len(rows), dtype=dtype)
+    if len(rows) == 0:
+        return out
+    for name in out.dtype.names:
+        if name not in rows.dtype.names:
+            continue
+        col = rows[name]
+        if col.dtype.kind == 'O':
+            kind = out.dtype[name].kind
+            fill = '' if kind == 'S' else (np.nan if kind == 'f' else 0)
+            col = [fill if val is None else val for val in col]
+        out[name] = col
+    for name, datecol in (('tstart', 'datestart'), ('tstop', 'datestop')):
+        if name in out.dtype.names:
+            missing = (np.isnan(out[name]) if name in rows.dtype.names
+                       else np.ones(len(out), dtype=bool))
+            if np.any(missing):
+                out[name][missing] = chandra_dates.date2secs(out[datecol][missing])
+    return out
+
+
+def first_mismatch(old, new):
+    """
+    Index of the first row that differs between two structured arrays
+    with the same columns (or the shorter length if one is a prefix of the
+    other).
+
+    :rtype: int
+    """
+    n = min(len(old), len(new))
+    diff = np.zeros(n, dtype=bool)
+    for name in new.dtype.names:
+        diff |= old[name][:n] != new[name][:n]
+    idx = np.flatnonzero(diff)
+    return int(idx[0]) if len(idx) else n
+
+
+def db_checksum(dbh, table, datecol, since):
+    """
+    Checksum of the database rows of a table before a date: the number of
+    rows and the sums of the CHECKSUM_COLUMNS (with times truncated to whole
+    seconds).
+
+    :param dbh: database handle
+    :param table: table name
+    :param datecol: date column
+    :param since: date
+    :rtype: tuple of ints
+    """
+    cols = CHECKSUM_COLUMNS[table]
+    sums = ', '.join('coalesce(sum(cast(%s as bigint)), 0) AS sum_%s' % (col, col) for col in cols)
+    row = dbh.fetchone("SELECT count(*) AS n, %s FROM %s WHERE %s < '%s'"
+                       % (sums, table, datecol, since))
+    return tuple(int(row[name]) for name in ['n'] + ['sum_%s' % col for col in cols])
+
+
+def h5_checksum(h5d, table, stop):
+    """
+    Checksum (as db_checksum) of the mirror rows of a table before an index
+
+    :param h5d: PyTables table
+    :param table: table name
+    :param stop: row index
+    :rtype: tuple of ints
+    """
+    if stop == 0:
+        return (0,) * (len(CHECKSUM_COLUMNS[table]) + 1)
+    return (stop,) + tuple(int(np.sum(h5d.read(stop=stop, field=col).astype(np.int64)))
+                           for col in CHECKSUM_COLUMNS[table])
+
+
+def make_table(h5, table, dtype):
+    return h5.createTable(h5.root, table, np.dtype(dtype), table, filters=FILTERS,
+                          expectedrows=100000)
+
+
+def update_table(h5, dbh, table, since=None):
+    """
+    Update the mirror of one table from the database.
+
+    :param h5: PyTables file handle (opened for appending)
+    :param dbh: database handle
+    :param table: table name
+    :param since: date from which rows may have changed (default=the last
+                  date in the mirror)
+    :rtype: (number of rows truncated, number of rows appended)
+    """
+    datecol, order, dtype = [(datecol, order, dtype) for name, datecol, order, dtype in TABLES
+                             if name == table][0]
+    try:
+        h5d = h5.getNode(h5.root, table)
+    except tables.NoSuchNodeError:
+        h5d = make_table(h5, table, dtype)
+    dates = h5d.col(datecol)
+    if since is None and len(dates):
+        since = dates[-1]
+    i0 = 0
+    if since is not None:
+        i0 = int(np.searchsorted(dates, since, side='left'))
+        if db_checksum(dbh, table, datecol, since) != h5_checksum(h5d, table, i0):
+            since = None
+            i0 = 0
+    if since is None:
+        rows = dbh.fetchall("SELECT * FROM %s ORDER BY %s" % (table, order))
+    else:
+        rows = dbh.fetchall("SELECT * FROM %s WHERE %s >= '%s' ORDER BY %s"
+                            % (table, datecol, since, order))
+    rows = as_dtype(rows, dtype)
+    idx = i0 + first_mismatch(h5d.read(start=i0), rows)
+    n_truncated = h5d.nrows - idx
+    if n_truncated:
+        # (truncating to no rows is not supported by older HDF5 libraries)
+        if idx == 0:
+            h5d.remove()
+            h5d = make_table(h5, table, dtype)
+        else:
+            h5d.truncate(idx)
+    n_appended = len(rows) - (idx - i0)
+    if n_appended:
+        h5d.append(rows[idx - i0:])
+    h5d.flush()
+    return n_truncated, n_appended
+
+
+def update_h5(dbh, h5file, since=None):
+    """
+    Update the HDF5 mirror of the load_segments, timelines and tl_obsids
+    tables (making it if needed).
+
+    :param dbh: database handle
+    :param h5file: HDF5 file name
+    :param since: date from which load_segments and timelines rows may have
+                  changed (default=the last date of each table in the mirror;
+                  tl_obsids is always updated from its last date)
+    :rtype: dict of (number of rows truncated, number of rows appended) by table
+    """
+    h5 = tables.openFile(h5file, mode='a')
+    try:
+        return dict((table, update_table(h5, dbh, table,
+                                         since if table in SINCE_TABLES else None))
+                    for table, datecol, order, dtype in TABLES)
+    finally:
+        h5.close()
+
+
+def read_columns(h5file, table, names=None, datestart=None, datestop=None):
+    """
+    Read columns of a mirrored table, optionally limited to rows with a date
+    from datestart up to (not including) datestop.
+
+    :param h5file: HDF5 file name
+    :param table: table name
+    :param names: list of columns (default=all)
+    :param datestart: start date
+    :param datestop: stop date
+    :rtype: dict of column arrays
+    """
+    datecol = [datecol for name, datecol, order, dtype in TABLES if name == table][0]
+    h5 = tables.openFile(h5file, mode='r')
+    try:
+        h5d = h5.getNode(h5.root, table)
+        start = 0
+        stop = h5d.nrows
+        if datestart is not None or datestop is not None:
+            dates = h5d.col(datecol)
+            if datestart is not None:
+                start = int(np.searchsorted(dates, datestart, side='left'))
+            if datestop is not None:
+                stop = int(np.searchsorted(dates, datestop, side='left'))
+        if names is None:
+            names = h5d.colnames
+        return dict((name, h5d.read(start=start, stop=max(start, stop), field=name))
+                    for name in names)
+    finally:
+        h5.close()
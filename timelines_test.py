@@ -2,6 +2,7 @@ import os
 import sys
 import time
 import re
+import json
 import tempfile
 import difflib
 import shutil
@@ -26,10 +27,26 @@ from Ska.astro import sph_dist
 
 from mica.archive import obspar
 import update_load_seg_db
+import backstop_cache
+import clgps
+import chandra_dates
+import loadseg_fingerprint
+import sqlite_profile
+import migrate_db
+import timeline_index
+import timeline_snapshot
+import timelines_h5
+import stage_checkpoint
+import watch_timelines
 
 err = sys.stderr
 MP_DIR = '/data/mpcrit1/mplogs/'
 SKA = os.environ['SKA']
+# backstop cache shared by all test Scenarios, so that each backstop is only
+# parsed once by parse_cmd_load_gen.pl
+BACKSTOP_CACHE = os.path.abspath('backstop_cache')
+# and likewise a cache of parsed processing summaries
+PARSE_CACHE = os.path.abspath('parse_cache')
 verbose = True
 DBI = 'sybase'
 cleanup = True
@@ -410,12 +427,36 @@ class Scenario(object):
         testdb = self.db_handle()
 
         parse_cmd = os.path.join('./parse_cmd_load_gen.pl')
-        parse_cmd_str = ( '%s %s --touch_file %s --mp_dir %s ' %
-                          ( parse_cmd, db_str, os.path.join( outdir, 'clg_touchfile'), mp_dir))
+        parse_cmd_str = ( '%s %s --touch_file %s --mp_dir %s --backstop_cache %s --parse_cache %s ' %
+                          ( parse_cmd, db_str, os.path.join( outdir, 'clg_touchfile'), mp_dir,
+                            BACKSTOP_CACHE, PARSE_CACHE))
 
         err.write(parse_cmd_str + "\n")
         bash(parse_cmd_str)
 
+        if self.dbi == 'sqlite':
+            # ingest again from the now-warm caches and without the caches,
+            # each into a fresh database, and check the rows match
+            ingest_rows = {}
+            for name, caches in (('cached', (BACKSTOP_CACHE, PARSE_CACHE)),
+                                 ('uncached', ("''", "''"))):
+                ingest_db = os.path.join(outdir, '%s.db3' % name)
+                if os.path.exists(ingest_db):
+                    os.unlink(ingest_db)
+                ingest_dbh = make_test_db(ingest_db)
+                ingest_str = ( '%s --server %s --touch_file %s --mp_dir %s --backstop_cache %s --parse_cache %s ' %
+                               ( parse_cmd, ingest_db, os.path.join( outdir, '%s_touchfile' % name), mp_dir,
+                                 caches[0], caches[1]))
+                err.write(ingest_str + "\n")
+                bash(ingest_str)
+                ingest_rows[name] = dict(
+                    (table, ingest_dbh.fetchall("select * from %s order by %s" % (table, order)).tolist())
+                    for table, order in (('tl_obsids', 'year, dir, load_segment, obsid, date'),
+                                         ('tl_built_loads', 'year, load_segment, file, load_scs')))
+                ingest_dbh.conn.close()
+            assert len(ingest_rows['uncached']['tl_built_loads']) > 0
+            assert ingest_rows['cached'] == ingest_rows['uncached']
+
         update_load_seg = os.path.join('./update_load_seg_db.py')
         load_seg_cmd_str = ( "%s %s --test --loadseg_rdb_dir '%s'" %
                                 ( update_load_seg, db_str, load_seg_dir ))
@@ -726,6 +767,557 @@ def test_weeks_for_load():
         assert new_timelines == update_load_seg_db.weeks_for_load( load, dbh)
 
 
+def test_weeks_for_loads():
+    # the batched resolver should give the same timelines as weeks_for_load
+    dbh = Ska.DBI.DBI(dbi='sybase', user='aca_read', database='aca', numpy=True, verbose=False)
+    loads = dbh.fetchall("""select * from load_segments
+                            where datestart >= '2010:001:00:00:00.000'
+                            and datestart < '2010:180:00:00:00.000'
+                            order by datestart""")
+    err.write("Checking weeks_for_loads \n" )
+    batched = update_load_seg_db.weeks_for_loads(loads, dbh)
+    assert len(batched) == len(loads)
+    for load, timelines in izip(loads, batched):
+        assert timelines == update_load_seg_db.weeks_for_load(load, dbh)
+
+
+def make_test_db(server, cmds=False, migrate=False):
+    """
+    Make a sqlite database with the load_segments, timelines and tl_* tables.
+
+    :param server: sqlite database file name
+    :param cmds: also make cmds, cmd_intpars and cmd_fltpars tables (with
+                 just the id columns that clearing timelines uses)
+    :param migrate: apply the migrate_db.py migrations
+    :rtype: Ska.DBI handle
+    """
+    dbh = Ska.DBI.DBI(dbi='sqlite', server=server, numpy=True)
+    for sqldef in ('load_segments_def.sql', 'timelines_def.sql', 'tl_dep_def.sql'):
+        for cmd in open(sqldef).read().split(';'):
+            if cmd.strip():
+                dbh.execute(cmd)
+    if cmds:
+        dbh.execute("create table cmds (id int, timeline_id int)")
+        for table in ('cmd_intpars', 'cmd_fltpars'):
+            dbh.execute("create table %s (id int, cmd_id int, timeline_id int)" % table)
+    if migrate:
+        migrate_db.migrate(dbh)
+    return dbh
+
+
+def daily_loads():
+    """
+    Ten one-day load segments from 2010:010, alternating SCS 128 and 129.
+
+    :rtype: recarray of load segments
+    """
+    names = ('load_segment', 'year', 'datestart', 'datestop', 'load_scs', 'fixed_by_hand')
+    return np.rec.fromrecords([('CL%03d:0000' % day, 2010, '2010:%03d:00:00:00.000' % day,
+                                '2010:%03d:00:00:00.000' % (day + 1), 128 + day % 2, 0)
+                               for day in range(10, 20)], names=names)
+
+
+def test_migrate_db(tmpdir):
+    dbh = make_test_db(str(tmpdir.join('migrate.db3')), cmds=True)
+    assert not any('INDEX' in detail for detail in dict(migrate_db.explain(dbh))['clear cmds'])
+    # a failed migration leaves no partial schema change, and is not recorded
+    def failing(dbh):
+        migrate_db.add_column(dbh, 'timelines', 'extra', 'int')
+        raise ValueError('failed')
+    migrate_db.MIGRATIONS.append((99, 'failing', failing))
+    try:
+        with pytest.raises(ValueError):
+            migrate_db.migrate(dbh)
+    finally:
+        migrate_db.MIGRATIONS.remove((99, 'failing', failing))
+    assert not migrate_db.has_column(dbh, 'timelines', 'extra')
+    assert 99 not in migrate_db.get_applied(dbh)
+    # the migrations before it were applied, and can be applied again (e.g.
+    # after a failure part way through a non-transactional sybase migration)
+    assert migrate_db.get_applied(dbh) == [version for version, desc, func in migrate_db.MIGRATIONS]
+    dbh.execute("DELETE FROM schema_version")
+    assert migrate_db.migrate(dbh) == [version for version, desc, func in migrate_db.MIGRATIONS]
+    assert migrate_db.has_index(dbh, 'timelines', ('tstart',))
+    assert migrate_db.migrate(dbh) == []
+    # each of the lookup queries uses an index
+    for name, plan in migrate_db.explain(dbh):
+        assert any(re.search(r'USING (COVERING )?INDEX', detail) for detail in plan), name
+
+
+def test_time_triggers(tmpdir):
+    dbh = make_test_db(str(tmpdir.join('triggers.db3')), migrate=True)
+    # a row inserted without the times gets them
+    dbh.insert(dict(id=1, load_segment='CL015:0101', year=2012, load_scs=128, fixed_by_hand=0,
+                    datestart='2012:015:01:00:00.000', datestop='2012:190:12:30:00.500'),
+               'load_segments')
+    # and a hand edit of the dates recomputes them
+    dbh.insert(dict(id=2, load_segment='CL200:0101', year=2012, load_scs=129, fixed_by_hand=0,
+                    datestart='2012:200:00:00:00.000', datestop='2012:210:00:00:00.000',
+                    tstart=0.0, tstop=0.0), 'load_segments')
+    dbh.execute("UPDATE load_segments SET datestop = '2017:001:00:00:01.000' WHERE id = 2")
+    rows = dbh.fetchall("SELECT * FROM load_segments ORDER BY id")
+    assert np.allclose(rows['tstart'], chandra_dates.date2secs(['2012:015:01:00:00.000',
+                                                                '2012:200:00:00:00.000']))
+    assert np.allclose(rows['tstop'], chandra_dates.date2secs(['2012:190:12:30:00.500',
+                                                               '2017:001:00:00:01.000']))
+
+
+def test_lookup_key_fallback(tmpdir):
+    dbh = make_test_db(str(tmpdir.join('keys.db3')))
+    # an unmigrated database is refused
+    with pytest.raises(ValueError):
+        migrate_db.check_schema(dbh)
+    migrate_db.migrate(dbh)
+    migrate_db.check_schema(dbh)
+    # rows added without the lookup keys (e.g. by hand) are still matched by name
+    dbh.insert(dict(year=2010, load_segment='CL052:0101_B', file='C044_2301.sum',
+                    first_cmd_time='2010:052:01:59:26.450', last_cmd_time='2010:052:12:20:06.101',
+                    load_scs=128, sumfile_modtime=1266030114.0), 'tl_built_loads')
+    dbh.insert(dict(year=2010, dir='/2010/FEB1310/oflsb/', file='C044_2301.sum', replan=0,
+                    processing_tstart='2010:044:23:00:00.000',
+                    processing_tstop='2010:052:12:23:00.000',
+                    sumfile_modtime=1266030114.0), 'tl_processing')
+    run_load = dict(year=2010, load_segment='CL052:0101', datestart='2010:052:01:59:26.450')
+    built = update_load_seg_db.get_built_load(run_load, dbh)
+    assert built['file'] == 'C044_2301.sum'
+    resolver = update_load_seg_db.WeekResolver([run_load], dbh)
+    assert resolver.get_built_load(run_load)['file'] == 'C044_2301.sum'
+    for get_replan_dir in (partial(update_load_seg_db.get_replan_dir, dbh=dbh),
+                           resolver.get_replan_dir):
+        assert get_replan_dir('C044:2301', '2010:052:01:59:26.450') == '/2010/FEB1310/oflsb/'
+    # and a newer row with a key is preferred
+    dbh.insert(dict(year=2010, load_segment='CL052:0101_C', file='C045_0001.sum',
+                    first_cmd_time='2010:052:01:59:26.450', last_cmd_time='2010:052:12:20:06.101',
+                    load_scs=128, sumfile_modtime=1266030115.0, load_key='052:0101'),
+               'tl_built_loads')
+    assert update_load_seg_db.get_built_load(run_load, dbh)['file'] == 'C045_0001.sum'
+    resolver = update_load_seg_db.WeekResolver([run_load], dbh)
+    assert resolver.get_built_load(run_load)['file'] == 'C045_0001.sum'
+
+
+def test_find_timeline_changes():
+    names = ['id', 'load_segment_id', 'dir', 'datestart', 'datestop', 'fixed_by_hand']
+    db_timelines = np.rec.fromrecords(
+        [(1, 10, '/2010/A/', '2010:001:00:00:00.000', '2010:002:00:00:00.000', 0),
+         (2, 11, '/2010/A/', '2010:002:00:00:00.000', '2010:003:00:00:00.000', 0),
+         (3, 12, '/2010/A/', '2010:003:00:00:00.000', '2010:004:00:00:00.000', 0),
+         (4, 13, '/2010/A/', '2010:004:00:00:00.000', '2010:005:00:00:00.000', 1)],
+        names=names)
+    timelines = [dict(load_segment_id=10, datestart='2010:001:00:00:00.000',
+                      datestop='2010:002:00:00:00.000'),
+                 # a longer timeline still matches
+                 dict(load_segment_id=11, datestart='2010:002:00:00:00.000',
+                      datestop='2010:003:12:00:00.000'),
+                 # a shorter one does not
+                 dict(load_segment_id=12, datestart='2010:003:00:00:00.000',
+                      datestop='2010:003:12:00:00.000')]
+    i_diff, superseded = update_load_seg_db.find_timeline_changes(timelines, db_timelines)
+    assert i_diff == 2
+    # timeline 4 is fixed by hand
+    assert [tl['id'] for tl in superseded] == [3]
+    i_diff, superseded = update_load_seg_db.find_timeline_changes(timelines[:2], db_timelines)
+    assert i_diff == 2
+    assert superseded == []
+
+
+def test_clear_timelines(tmpdir):
+    dbh = Ska.DBI.DBI(dbi='sqlite', server=str(tmpdir.join('clear.db3')), numpy=True)
+    dbh.execute("""create table timelines (id int, load_segment_id int, datestart text,
+                   datestop text, fixed_by_hand int)""")
+    for table in ('cmds', 'cmd_intpars', 'cmd_fltpars'):
+        dbh.execute("create table %s (id int, timeline_id int)" % table)
+    for id in range(1, 7):
+        dbh.insert(dict(id=id, load_segment_id=10 + id // 3,
+                        datestart='2010:%03d:00:00:00.000' % id,
+                        datestop='2010:%03d:00:00:00.000' % (id + 1),
+                        fixed_by_hand=int(id == 4)), 'timelines')
+        for table in ('cmds', 'cmd_intpars', 'cmd_fltpars'):
+            dbh.insert(dict(id=id, timeline_id=id), table)
+    # commands of a fixed_by_hand timeline are cleared, but not the timeline
+    load_segments = np.rec.fromrecords([(11,)], names=['id'])
+    update_load_seg_db.clear_rel_timelines(load_segments, dbh=dbh)
+    assert [tl['id'] for tl in dbh.fetchall("select id from timelines order by id")] == [1, 2, 4, 6]
+    assert [c['timeline_id'] for c in dbh.fetchall("select * from cmds order by id")] == [1, 2, 6]
+    ids = update_load_seg_db.clear_timelines_after('2010:004:00:00:00.000', dbh=dbh)
+    assert ids == [6]
+    assert [tl['id'] for tl in dbh.fetchall("select id from timelines order by id")] == [1, 2, 4]
+    assert [c['timeline_id'] for c in dbh.fetchall("select * from cmd_fltpars order by id")] == [1, 2]
+    # a dryrun changes nothing
+    update_load_seg_db.clear_timelines([1, 2], dbh=dbh, dryrun=True)
+    assert len(dbh.fetchall("select * from cmd_intpars")) == 2
+
+
+def test_in_memory_delta(tmpdir):
+    # an update computed in an in-memory snapshot and applied as a delta
+    # should give the same tables as the update made directly
+    servers = [str(tmpdir.join(name)) for name in ('direct.db3', 'delta.db3')]
+    dbhs = [make_test_db(server, cmds=True, migrate=True) for server in servers]
+    loads = daily_loads()
+    for dbh in dbhs:
+        update_load_seg_db.update_loads_db(loads[:8], dbh=dbh, test=True)
+        for id in range(1, 9):
+            dbh.insert(dict(id=id, load_segment_id=id, dir='/2010/JAN1010/oflsa/',
+                            datestart=loads[id - 1]['datestart'], datestop=loads[id - 1]['datestop'],
+                            replan=0, incomplete=0, fixed_by_hand=int(id == 6)), 'timelines')
+            dbh.insert(dict(id=id, timeline_id=id), 'cmds')
+        # the timelines without times are backfilled
+        migrate_db.backfill_times(dbh)
+    loads.load_scs[5] = 131
+    update_load_seg_db.update_loads_db(loads[3:], dbh=dbhs[0], test=True)
+    mem, snapshot = update_load_seg_db.snapshot_db(servers[1], loads[3]['datestart'])
+    update_load_seg_db.update_loads_db(loads[3:], dbh=mem, test=True)
+    update_load_seg_db.apply_delta(mem, snapshot, dbhs[1])
+    for table in ('load_segments', 'timelines', 'cmds'):
+        direct, delta = [dbh.fetchall("select * from %s order by id" % table).tolist()
+                         for dbh in dbhs]
+        assert direct == delta
+    db_loads = dbhs[1].fetchall("select * from load_segments")
+    assert np.allclose(db_loads['tstart'], [DateTime(date).secs for date in db_loads['datestart']])
+    tl_loads = dbhs[1].fetchall("select * from timeline_loads")
+    assert np.allclose(tl_loads['tstop'], [DateTime(date).secs for date in tl_loads['datestop']])
+    # the fixed_by_hand timeline is kept, but its commands are cleared
+    assert 6 in [row['id'] for row in dbhs[1].fetchall("select id from timelines")]
+    assert 6 not in [row['timeline_id'] for row in dbhs[1].fetchall("select * from cmds")]
+    # the delta is refused once the database has changed
+    with pytest.raises(ValueError):
+        update_load_seg_db.apply_delta(mem, snapshot, dbhs[1])
+    # including by an edit in place, and then nothing is written
+    mem, snapshot = update_load_seg_db.snapshot_db(servers[1], loads[3]['datestart'])
+    update_load_seg_db.update_loads_db(loads[5:], dbh=mem, test=True)
+    dbhs[1].execute("UPDATE timelines SET datestop = '2010:015:12:00:00.000' WHERE id = 5")
+    before = dbhs[1].fetchall("select * from load_segments order by id").tolist()
+    with pytest.raises(ValueError):
+        update_load_seg_db.apply_delta(mem, snapshot, dbhs[1])
+    assert dbhs[1].fetchall("select * from load_segments order by id").tolist() == before
+
+
+def test_timelines_h5(tmpdir):
+    dbh = make_test_db(str(tmpdir.join('h5.db3')), cmds=True, migrate=True)
+    loads = daily_loads()
+    update_load_seg_db.update_loads_db(loads[:8], dbh=dbh, test=True)
+    for id in range(1, 9):
+        dbh.insert(dict(id=id, load_segment_id=id, dir='/2010/JAN1010/oflsa/',
+                        datestart=loads[id - 1]['datestart'], datestop=loads[id - 1]['datestop'],
+                        replan=0, incomplete=0, fixed_by_hand=0), 'timelines')
+        dbh.insert(dict(year=2010, load_segment=loads[id - 1]['load_segment'],
+                        dir='/2010/JAN1010/oflsa/', obsid=1000 + id,
+                        date=loads[id - 1]['datestart']), 'tl_obsids')
+    migrate_db.backfill_times(dbh)
+    h5file = str(tmpdir.join('timelines.h5'))
+
+    def check_mirror():
+        for table, datecol, order, dtype in timelines_h5.TABLES:
+            sql_rows = timelines_h5.as_dtype(
+                dbh.fetchall("select * from %s order by %s" % (table, order)), dtype)
+            cols = timelines_h5.read_columns(h5file, table)
+            for name in sql_rows.dtype.names:
+                assert cols[name].tolist() == sql_rows[name].tolist()
+
+    changes = timelines_h5.update_h5(dbh, h5file)
+    assert changes['timelines'] == (0, 8)
+    check_mirror()
+    # a replan of the last loads truncates the mirror at the first changed row
+    loads.load_scs[5] = 131
+    update_load_seg_db.update_loads_db(loads[3:], dbh=dbh, test=True)
+    changes = timelines_h5.update_h5(dbh, h5file, since=loads[3]['datestart'])
+    assert changes['load_segments'] == (3, 5)
+    assert changes['tl_obsids'] == (0, 0)
+    check_mirror()
+    # new rows are appended
+    dbh.insert(dict(year=2010, load_segment='CL020:0000', dir='/2010/JAN1010/oflsa/',
+                    obsid=2000, date='2010:020:00:00:00.000'), 'tl_obsids')
+    assert timelines_h5.update_h5(dbh, h5file)['tl_obsids'] == (0, 1)
+    check_mirror()
+    # an edit before the start date that keeps the number of rows rewrites the table
+    n_loads = len(dbh.fetchall("select id from load_segments"))
+    dbh.execute("UPDATE load_segments SET load_scs = 130 WHERE id = 1")
+    changes = timelines_h5.update_h5(dbh, h5file, since=loads[6]['datestart'])
+    assert changes['load_segments'] == (n_loads, n_loads)
+    assert changes['timelines'] == (0, 0)
+    check_mirror()
+    # tl_obsids (from the parsed summaries) is compared from its own last date
+    dbh.insert(dict(year=2010, load_segment='CL019:0000', dir='/2010/JAN1010/oflsa/',
+                    obsid=2001, date='2010:019:12:00:00.000'), 'tl_obsids')
+    changes = timelines_h5.update_h5(dbh, h5file, since='2010:020:00:00:00.000')
+    assert changes['tl_obsids'] == (1, 2)
+    check_mirror()
+    cols = timelines_h5.read_columns(h5file, 'load_segments', ['tstart'],
+                                     datestart='2010:012:00:00:00.000',
+                                     datestop='2010:014:00:00:00.000')
+    assert np.allclose(cols['tstart'], chandra_dates.date2secs(['2010:012:00:00:00.000',
+                                                                '2010:013:00:00:00.000']))
+
+
+def test_stage_checkpoint(tmpdir):
+    class Opt(object):
+        checkpoint = str(tmpdir.join('stage_checkpoint.json'))
+        output = []
+        force = False
+    opt = Opt()
+    opt.server = str(tmpdir.join('stage.db3'))
+    opt.loadseg_rdb_dir = str(tmpdir.join('load_segment'))
+    os.makedirs(opt.loadseg_rdb_dir)
+    open(os.path.join(opt.loadseg_rdb_dir, 'LS_2010001.rdb'), 'w').write('rdb')
+    # a missing database is not made, and the stage is run
+    assert stage_checkpoint.update_inputs(opt) is None
+    assert not os.path.exists(opt.server)
+    dbh = make_test_db(opt.server)
+    # the first run always runs the stage, and later runs only if the inputs change
+    assert stage_checkpoint.run_stage(opt, 'update', ['true']) == 0
+    assert stage_checkpoint.run_stage(opt, 'update', ['false']) == 0
+    dbh.insert(dict(year=2010, load_segment='CL004:0101', dir='/2010/JAN0410/oflsa/',
+                    obsid=1000, date='2010:004:00:00:00.000'), 'tl_obsids')
+    assert stage_checkpoint.run_stage(opt, 'update', ['false']) == 1
+    assert stage_checkpoint.run_stage(opt, 'update', ['true']) == 0
+    # the inputs include the database state recorded by update_load_seg_db.py
+    inputs = stage_checkpoint.update_inputs(opt)
+    state = update_load_seg_db.get_db_state(dbh)
+    assert [[key, inputs[key]] for key, value in state] == state
+    # a missing output runs the stage
+    opt.output = [str(tmpdir.join('timelines.h5'))]
+    assert stage_checkpoint.run_stage(opt, 'update', ['false']) == 1
+
+
+def test_watch_timelines_classify(tmpdir):
+    class FakeInotify(object):
+        def __init__(self):
+            self.watched = []
+
+        def add_watch(self, path):
+            self.watched.append(path)
+
+    class Opt(object):
+        mp_dir = str(tmpdir.join('mp'))
+        loadseg_rdb_dir = str(tmpdir.join('load_segment'))
+    opt = Opt()
+    mps_dir = os.path.join(opt.mp_dir, '2010', 'JAN0410', 'oflsa', 'mps')
+    os.makedirs(mps_dir)
+    os.makedirs(opt.loadseg_rdb_dir)
+    inotify = FakeInotify()
+    classify = partial(watch_timelines.classify, inotify, opt)
+    wt = watch_timelines
+    assert classify([(opt.loadseg_rdb_dir, wt.IN_CLOSE_WRITE, 'LS.rdb')]) == (False, True, False)
+    assert classify([(mps_dir, wt.IN_CLOSE_WRITE, 'C004_0101.sum')]) == (True, False, False)
+    assert classify([(mps_dir, wt.IN_MOVED_TO, 'C004_0101.sum')]) == (True, False, False)
+    # a summary is only complete once it is closed or moved into place
+    assert classify([(mps_dir, wt.IN_CREATE, 'C004_0101.sum')]) == (False, False, False)
+    assert classify([(mps_dir, wt.IN_CLOSE_WRITE, 'C004_0101.log')]) == (False, False, False)
+    # a new week directory is watched (with anything already made in it)
+    week_dir = os.path.join(opt.mp_dir, '2010', 'JAN1110')
+    os.makedirs(os.path.join(week_dir, 'oflsa'))
+    assert (classify([(os.path.dirname(week_dir), wt.IN_CREATE | wt.IN_ISDIR, 'JAN1110')])
+            == (True, False, False))
+    assert inotify.watched == [week_dir, os.path.join(week_dir, 'oflsa')]
+    # a new year, a queue overflow, or a replaced rdb directory rescans
+    assert classify([(opt.mp_dir, wt.IN_CREATE | wt.IN_ISDIR, '2011')])[2]
+    assert classify([(None, wt.IN_Q_OVERFLOW, '')])[2]
+    assert classify([(opt.loadseg_rdb_dir, wt.IN_DELETE_SELF, '')])[2]
+
+
+def test_watch_timelines_schedule():
+    # times are from a fake clock: debounce 10, max_delay 60, poll 600
+    schedule = watch_timelines.Schedule(10, 60, 600, now=0)
+    # without events, both stages are run every poll interval
+    assert schedule.timeout(100) == 500
+    assert schedule.due(599) is None
+    assert schedule.due(600) == (True, True)
+    schedule.ran(605)
+    assert schedule.timeout(605) == 600
+    # an rdb change runs only the update, once quiet for the debounce time
+    schedule.add_event(700, sum_changed=False)
+    assert schedule.timeout(700) == 10
+    schedule.add_event(705, sum_changed=False)
+    assert schedule.due(714) is None
+    assert schedule.due(715) == (False, True)
+    schedule.ran(716)
+    # a burst of summary events runs both stages after at most max_delay
+    for now in range(800, 870, 5):
+        schedule.add_event(now, sum_changed=(now == 800))
+        if now < 860:
+            assert schedule.due(now) is None
+    assert schedule.timeout(865) == 0
+    assert schedule.due(865) == (True, True)
+    schedule.ran(870)
+    # and the poll interval restarts from the last run
+    assert schedule.due(1469) is None
+    assert schedule.due(1470) == (True, True)
+
+
+def test_timeline_index(tmpdir):
+    dbh = make_test_db(str(tmpdir.join('index.db3')), migrate=True)
+    index = timeline_index.TimelineIndex(dbh)
+    empty_times = chandra_dates.date2secs(['2010:002:00:00:00.000', '2010:005:00:00:00.000'])
+    assert index.timeline_for_time('2010:002:00:00:00.000') == -1
+    assert index.timeline_for_time(empty_times).tolist() == [-1, -1]
+    assert index.dir_for_time('2010:002:00:00:00.000') is None
+    assert index.dir_for_time(empty_times).tolist() == ['', '']
+    # a vehicle load (SCS 128) under observing loads (SCS 131)
+    for id, scs, datestart, datestop in ((1, 128, '2010:001:00:00:00.000', '2010:010:00:00:00.000'),
+                                         (2, 131, '2010:001:00:00:00.000', '2010:003:00:00:00.000'),
+                                         (3, 131, '2010:004:00:00:00.000', '2010:006:00:00:00.000')):
+        dbh.insert(dict(id=id, load_segment='CL001:0000', year=2010, datestart=datestart,
+                        datestop=datestop, load_scs=scs, fixed_by_hand=0), 'load_segments')
+        dbh.insert(dict(id=id, load_segment_id=id, dir='/2010/DIR%d/oflsa/' % id,
+                        datestart=datestart, datestop=datestop, replan=0, incomplete=0,
+                        fixed_by_hand=0), 'timelines')
+    migrate_db.backfill_times(dbh)
+    index = timeline_index.TimelineIndex(dbh)
+    assert index.timeline_for_time('2010:002:00:00:00.000') == 2
+    # covered only by the earlier, longer timeline
+    assert index.dir_for_time('2010:003:12:00:00.000') == '/2010/DIR1/oflsa/'
+    assert index.timeline_for_time('2009:365:00:00:00.000') == -1
+    times = chandra_dates.date2secs(['2009:365:00:00:00.000', '2010:002:00:00:00.000',
+                                     '2010:005:00:00:00.000', '2010:008:00:00:00.000',
+                                     '2010:011:00:00:00.000'])
+    assert index.timeline_for_time(times).tolist() == [-1, 2, 3, 1, -1]
+    assert index.loads_between('2010:003:12:00:00.000', '2010:004:12:00:00.000')['id'].tolist() == [1, 3]
+    # new timelines are picked up
+    dbh.insert(dict(id=4, load_segment_id=1, dir='/2010/DIR4/oflsa/',
+                    datestart='2010:010:00:00:00.000', datestop='2010:012:00:00:00.000',
+                    replan=0, incomplete=0, fixed_by_hand=0), 'timelines')
+    migrate_db.backfill_times(dbh)
+    assert index.timeline_for_time(times[-1]) == 4
+
+
+def test_timeline_snapshot(tmpdir):
+    dbh = make_test_db(str(tmpdir.join('snapshot.db3')), migrate=True)
+    filename = str(tmpdir.join('timeline_loads.snap'))
+    assert timeline_snapshot.write_snapshot(dbh, filename) == 0
+    header, cols = timeline_snapshot.read_snapshot(filename)
+    assert header['n_rows'] == 0 and len(cols['tstart']) == 0
+    for id, scs, datestart, datestop in ((1, 128, '2010:001:00:00:00.000', '2010:010:00:00:00.000'),
+                                         (2, 131, '2010:004:00:00:00.000', '2010:006:00:00:00.000'),
+                                         (3, 131, '2010:001:00:00:00.000', '2010:003:00:00:00.000')):
+        dbh.insert(dict(id=id, load_segment='CL001:0000', year=2010, datestart=datestart,
+                        datestop=datestop, load_scs=scs, fixed_by_hand=0), 'load_segments')
+        dbh.insert(dict(id=id, load_segment_id=id, dir='/2010/DIR%d/oflsa/' % (id % 2),
+                        datestart=datestart, datestop=datestop, replan=int(id == 2),
+                        incomplete=0, fixed_by_hand=int(id == 3)), 'timelines')
+    migrate_db.backfill_times(dbh)
+    assert timeline_snapshot.write_snapshot(dbh, filename) == 3
+    header, cols = timeline_snapshot.read_snapshot(filename)
+    assert header['max_id'] == 3
+    assert cols['id'].tolist() == [1, 3, 2]
+    assert cols['scs'].tolist() == [128, 131, 131]
+    assert np.allclose(cols['tstart'], chandra_dates.date2secs(['2010:001:00:00:00.000',
+                                                                '2010:001:00:00:00.000',
+                                                                '2010:004:00:00:00.000']))
+    assert header['dirs'][cols['dir_index']].tolist() == ['/2010/DIR1/oflsa/',
+                                                         '/2010/DIR1/oflsa/',
+                                                         '/2010/DIR0/oflsa/']
+    assert cols['flags'].tolist() == [0, timeline_snapshot.FIXED_BY_HAND, timeline_snapshot.REPLAN]
+    # a mapped snapshot is unchanged when a new one is published
+    dbh.execute("DELETE FROM timelines WHERE id = 2")
+    assert timeline_snapshot.write_snapshot(dbh, filename) == 2
+    assert cols['id'].tolist() == [1, 3, 2]
+    assert timeline_snapshot.read_snapshot(filename)[1]['id'].tolist() == [1, 3]
+
+
+def test_loadseg_fingerprint(tmpdir):
+    old_rows = [['a', '2010:001:00:00:00.000', 'CL001:0000'],
+                ['b', '2010:002:00:00:00.000', 'CL002:0000'],
+                ['c', '2010:003:00:00:00.000', 'CL003:0000']]
+    assert loadseg_fingerprint.first_changed_date(old_rows, old_rows) is None
+    new_rows = old_rows[:1] + [['x', '2010:002:00:00:00.000', 'CL002:0000']] + old_rows[2:]
+    assert loadseg_fingerprint.first_changed_date(old_rows, new_rows) == '2010:002:00:00:00.000'
+    new_rows = old_rows + [['d', '2010:004:00:00:00.000', 'CL004:0000']]
+    assert loadseg_fingerprint.first_changed_date(old_rows, new_rows) == '2010:004:00:00:00.000'
+    assert loadseg_fingerprint.first_changed_date(old_rows, old_rows[:2]) == '2010:003:00:00:00.000'
+    # the rdb is a sliding window: rows dropping out of its start are not changes
+    assert loadseg_fingerprint.first_changed_date(old_rows, old_rows[1:]) is None
+    new_rows = old_rows[2:] + [['d', '2010:004:00:00:00.000', 'CL004:0000']]
+    assert loadseg_fingerprint.first_changed_date(old_rows, new_rows) == '2010:004:00:00:00.000'
+    # and rows are matched by date and name, not by position
+    new_rows = old_rows[1:2] + [['y', '2010:002:12:00:00.000', 'CL002:1200']] + old_rows[2:]
+    assert loadseg_fingerprint.first_changed_date(old_rows, new_rows) == '2010:002:12:00:00.000'
+    filename = str(tmpdir.join('loadseg.fingerprint'))
+    loadseg_fingerprint.write_fingerprint(filename, dict(rows=old_rows, digest='abc'))
+    assert loadseg_fingerprint.read_fingerprint(filename)['rows'] == old_rows
+    # keep two unchanged loads before the first changed one
+    loads = np.rec.fromrecords([('2010:%03d:00:00:00.000' % day,) for day in range(1, 11)],
+                               names=['datestart'])
+    trimmed = update_load_seg_db.loads_since(loads, '2010:005:00:00:00.000')
+    assert trimmed[0]['datestart'] == '2010:003:00:00:00.000'
+    assert len(update_load_seg_db.loads_since(loads, '2010:011:00:00:00.000')) == 4
+    # the database state read with just sqlite3 is the one update_load_seg_db records
+    server = str(tmpdir.join('fingerprint.db3'))
+    script_dir = os.path.dirname(os.path.abspath(update_load_seg_db.__file__))
+    assert loadseg_fingerprint.sqlite_db_state(server, script_dir) is None
+    assert not os.path.exists(server)
+    dbh = make_test_db(server)
+    dbh.insert(dict(id=1, load_segment='CL001:0000', year=2010, datestart='2010:001:00:00:00.000',
+                    datestop='2010:002:00:00:00.000', load_scs=128, fixed_by_hand=0),
+               'load_segments')
+    state = update_load_seg_db.get_db_state(dbh)
+    assert dict(state)['max_load_segment_id'] == 1
+    assert loadseg_fingerprint.sqlite_db_state(server, script_dir) == state
+    # an edit in place of a row in the rdb window is a change of state
+    state = update_load_seg_db.get_db_state(dbh, '2010:001:00:00:00.000')
+    assert loadseg_fingerprint.sqlite_db_state(server, script_dir, '2010:001:00:00:00.000') == state
+    dbh.execute("UPDATE load_segments SET datestop = '2010:001:12:00:00.000' WHERE id = 1")
+    edited = update_load_seg_db.get_db_state(dbh, '2010:001:00:00:00.000')
+    assert edited != state
+    assert loadseg_fingerprint.sqlite_db_state(server, script_dir, '2010:001:00:00:00.000') == edited
+    # but not before it
+    state = update_load_seg_db.get_db_state(dbh, '2010:002:00:00:00.000')
+    dbh.execute("UPDATE load_segments SET load_scs = 129 WHERE id = 1")
+    assert update_load_seg_db.get_db_state(dbh, '2010:002:00:00:00.000') == state
+
+
+def test_sqlite_profile(tmpdir):
+    statements = sqlite_profile.read_profile(busy_timeout=1234)
+    assert not [stmt for stmt in statements if 'journal_mode' in stmt]
+    assert [stmt for stmt in statements if 'busy_timeout' in stmt] == ['PRAGMA busy_timeout = 1234']
+    assert 'PRAGMA synchronous = NORMAL' in sqlite_profile.read_profile(journal_mode='wal')
+    # the journal mode persists in the database, so is only WAL if asked for
+    server = str(tmpdir.join('profile.db3'))
+    dbh = Ska.DBI.DBI(dbi='sqlite', server=server)
+    sqlite_profile.apply_profile(dbh)
+    assert dbh.fetchone('PRAGMA journal_mode')['journal_mode'] == 'delete'
+    sqlite_profile.apply_profile(dbh, journal_mode='WAL')
+    assert dbh.fetchone('PRAGMA journal_mode')['journal_mode'] == 'wal'
+    sqlite_profile.checkpoint(dbh)
+    # and then stays WAL for the scripts that do not set it
+    dbh = Ska.DBI.DBI(dbi='sqlite', server=server)
+    sqlite_profile.apply_profile(dbh)
+    assert dbh.fetchone('PRAGMA journal_mode')['journal_mode'] == 'wal'
+    assert dbh.fetchone('PRAGMA synchronous')['synchronous'] == 1
+    # and never on a network filesystem
+    mounts_file = str(tmpdir.join('mounts'))
+    with open(mounts_file, 'w') as fh:
+        fh.write("/dev/sda1 / ext4 rw 0 0\n")
+        fh.write("server:/export %s nfs4 rw 0 0\n" % tmpdir.join('nfs'))
+    assert sqlite_profile.filesystem_type(server, mounts_file) == 'ext4'
+    nfs_server = str(tmpdir.join('nfs', 'cmd_states.db3'))
+    assert sqlite_profile.filesystem_type(nfs_server, mounts_file) == 'nfs4'
+    sqlite_profile.check_journal_mode(nfs_server, 'DELETE', mounts_file)
+    with pytest.raises(ValueError):
+        sqlite_profile.check_journal_mode(nfs_server, 'WAL', mounts_file)
+
+
+def test_chandra_dates():
+    # match DateTime over the mission, including across leap seconds
+    secs = np.concatenate([np.linspace(DateTime('1999:001').secs, DateTime('2020:001').secs, 5000),
+                           DateTime(['2005:365:23:59:59.000', '2006:001:00:00:00.000',
+                                     '2012:182:23:59:59.500', '2012:183:00:00:00.000',
+                                     '2016:366:23:59:59.999']).secs])
+    dates = DateTime(secs).date
+    assert np.allclose(chandra_dates.date2secs(dates), DateTime(dates).secs, rtol=0, atol=1e-4)
+    assert np.all(chandra_dates.date2year(dates) == [int(d[:4]) for d in dates])
+    for date in dates[:10]:
+        assert abs(chandra_dates.date2secs(date) - DateTime(date).secs) < 1e-4
+    # dates that are not in the full format are converted by DateTime
+    assert abs(chandra_dates.date2secs(['2010:001'])[0] - DateTime('2010:001').secs) < 1e-4
+    assert abs(chandra_dates.durations('2010:001:00:00:00.000', '2010:002:00:00:00.000')
+               - 86400) < 1e-6
+    # the numeric times of rows are used unless one is missing
+    rows = np.rec.fromrecords([('2010:001:00:00:00.000', '2010:002:00:00:00.000', 1.0, 2.0)],
+                              names=['datestart', 'datestop', 'tstart', 'tstop'])
+    assert [t.tolist() for t in chandra_dates.row_times(rows)] == [[1.0], [2.0]]
+    rows['tstop'] = np.nan
+    assert np.allclose(chandra_dates.row_times(rows)[1], DateTime('2010:002').secs)
+
+
 def test_first_sosa_update():
     # for a plain update, sosa or not, nothing should be deleted
     # and new entries should be inserted
@@ -779,6 +1371,110 @@ def test_load_update_sosa_truncate():
     assert to_insert[0]['datestart'] == want_loads[12]['datestart']
 
 
+def test_backstop_cache(tmpdir):
+    backstop = str(tmpdir.join('CR276_0906.backstop'))
+    open(backstop, 'w').write(
+        "2010:276:10:00:00.000 | 1 0 | MP_OBSID | ID= 12345, SCS= 131, STEP= 1\n"
+        "2010:277:10:00:00.000 | 2 0 | COMMAND_SW | TLMSID= AONMMODE, HEX= 8030402\n")
+    cols = dict(time=[DateTime('2010:276:10:00:00.000').secs,
+                      DateTime('2010:277:10:00:00.000').secs],
+                obsid=[12345, -1],
+                date=['2010:276:10:00:00.000', '2010:277:10:00:00.000'],
+                cmd=['MP_OBSID', 'COMMAND_SW'])
+    cache_dir = str(tmpdir)
+    backstop_cache.write_cache(backstop_cache.cache_file(backstop, cache_dir), backstop, cols)
+    cached = backstop_cache.get_backstop_columns(backstop, cache_dir)
+    for col in cols:
+        assert np.all(cached[col] == np.array(cols[col]))
+    # a changed backstop is not read from the cache
+    open(backstop, 'a').write(
+        "2010:278:10:00:00.000 | 3 0 | MP_OBSID | ID= 12346, SCS= 131, STEP= 2\n")
+    assert backstop_cache.get_backstop_columns(backstop, cache_dir) is None
+    # a command name that does not fit in the cache is refused
+    cols['cmd'][1] = 'X' * 33
+    with pytest.raises(ValueError):
+        backstop_cache.write_cache(backstop_cache.cache_file(backstop, cache_dir), backstop, cols)
+
+
+def test_backstop_cache_perl(tmpdir):
+    # the cache written by parse_cmd_load_gen.pl is read by backstop_cache.py
+    backstop = str(tmpdir.join('CR276_0906.backstop'))
+    open(backstop, 'w').write(
+        "2010:276:10:00:00.000 | 1 0 | MP_OBSID | ID= 12345, SCS= 131, STEP= 1\n"
+        "2010:277:10:00:00.000 | 2 0 | COMMAND_SW | TLMSID= AONMMODE, HEX= 8030402\n")
+    cache_dir = str(tmpdir.join('backstop_cache'))
+    bash('./parse_cmd_load_gen.pl --backstop_cache %s --cache_only %s' % (cache_dir, backstop))
+    cached = backstop_cache.get_backstop_columns(backstop, cache_dir)
+    assert cached['obsid'].tolist() == [12345, -1]
+    assert cached['cmd'].tolist() == ['MP_OBSID', 'COMMAND_SW']
+    assert cached['date'].tolist() == ['2010:276:10:00:00.000', '2010:277:10:00:00.000']
+    assert np.allclose(cached['time'], [DateTime('2010:276:10:00:00.000').secs,
+                                        DateTime('2010:277:10:00:00.000').secs])
+
+
+def test_clgps(tmpdir):
+    # the single-pass parser should match parse_clgps field-for-field
+    sumfile = 't/sosa_v2_C276_0906.sum'
+    week, loads = clgps.parse_clgps(sumfile)
+    assert week['replan'] == 0
+    assert week['continuity_cmds'] == 'C270:0407'
+    assert week['planning_tstart'] == '2010:276:09:55:11.417'
+    assert week['year'] == '2010'
+    assert len(loads) == 12
+    assert [l['load_scs'] for l in loads[:2]] == ['128', '131']
+    perl = json.loads('\n'.join(bash('./parse_cmd_load_gen.pl --parse_only %s' % sumfile)))
+    assert week == perl[0]['week']
+    assert loads == perl[0]['loads']
+    # including headers after the banner of the first section or after other
+    # text, and sections with more than one header
+    oddfile = str(tmpdir.join('C001_0000.sum'))
+    with open(oddfile, 'w') as fh:
+        fh.write("""   Command Load Generation Processing Summary
+**************PROCESSING VALUES**************
+EXECUTION BEGIN TIME:2010:001:00:00:00.000
+START TIME:   2010:001:01:00:00.000
+STOP TIME:    2010:008:01:00:00.000
+
+************ note *************** INPUT REPLAN BCF INFORMATION ****
+TOTAL NUMBER OF COMMANDS READ = 42
+***** ACTUAL PLANNING PERIOD START/STOP TIMES *****
+ACTUAL START TIME: 2010:001:02:00:00.000
+ACTUAL STOP  TIME: 2010:008:02:00:00.000
+
+************
+  ****LOAD GENERATED****
+Load name:         CL001:0200
+    SCS Number:                  128 / 131
+    First Command Time:          2010:001:02:00:00.000
+    Last Command Time:           2010:003:02:00:00.000
+""")
+    week, loads = clgps.parse_clgps(oddfile)
+    assert week == {'replan': 0, 'execution_tstart': '2010:001:00:00:00.000',
+                    'processing_tstart': '2010:001:01:00:00.000',
+                    'processing_tstop': '2010:008:01:00:00.000', 'bcf_cmd_count': '42',
+                    'planning_tstart': '2010:001:02:00:00.000',
+                    'planning_tstop': '2010:008:02:00:00.000', 'year': '2010'}
+    assert [l['load_scs'] for l in loads] == ['128', '131']
+    perl = json.loads('\n'.join(bash('./parse_cmd_load_gen.pl --parse_only %s' % oddfile)))
+    assert week == perl[0]['week']
+    assert loads == perl[0]['loads']
+
+
+def test_clgps_parse_cache(tmpdir):
+    cache_dir = str(tmpdir.join('parse_cache'))
+    week, loads = clgps.parse_clgps('t/sosa_v2_C276_0906.sum', cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+    # a copy of the summary (new name and mtime) is read from the cache
+    sumfile = str(tmpdir.join('C276_0906.sum'))
+    shutil.copy('t/sosa_v2_C276_0906.sum', sumfile)
+    assert clgps.parse_clgps(sumfile, cache_dir=cache_dir) == (week, loads)
+    assert len(os.listdir(cache_dir)) == 1
+    # and a changed summary is not
+    open(sumfile, 'a').write('\n')
+    clgps.parse_clgps(sumfile, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 2
+
+
 def test_nsm_2010(outdir='t/nsm_2010', cmd_state_ska=SKA):
 
     # Simulate timelines and cmd_states around day 150 NSM
@@ -7,9 +7,12 @@ first_cmd_time varchar(22),
 last_cmd_time varchar(22),
 load_scs int not null,
 sumfile_modtime float not null,
+load_key varchar(8) null,
 primary key (year, load_segment, file, load_scs, sumfile_modtime)
 );
 
+create index tl_built_loads_load_key on tl_built_loads (year, load_key);
+
 create table tl_processing
 ( 
 year int,
@@ -25,9 +28,14 @@ processing_tstart varchar(22),
 processing_tstop varchar(22),
 execution_tstart varchar(22),
 sumfile_modtime float,
+file_key varchar(8) null,
 primary key (dir, file)
 );
 
+create index tl_processing_file on tl_processing (file, sumfile_modtime);
+create index tl_processing_processing_tstart on tl_processing (processing_tstart);
+create index tl_processing_file_key on tl_processing (file_key);
+
 
 create table tl_obsids
 ( 
@@ -9,12 +9,17 @@ from logging.handlers import SMTPHandler
 import numpy as np
 from itertools import count, izip
 
-import Ska.Table
 from Ska.DBI import DBI
 from Chandra.Time import DateTime
 
 import fix_tl_processing
 import fix_load_segments
+import migrate_db
+from migrate_db import load_key, file_key
+import chandra_dates
+import loadseg_fingerprint
+import sqlite_profile
+import timeline_snapshot
 
 log = logging.getLogger()
 log.setLevel(logging.DEBUG)
@@ -51,6 +56,26 @@ def get_options():
     parser.add_option("--loadseg_rdb_dir",
                       default=os.path.join(os.environ['SKA'], 'data', 'arc', 'iFOT_events', 'load_segment'),
                       help="directory containing iFOT rdb files of load segments")
+    parser.add_option("--busy_timeout",
+                      type='int',
+                      help="sqlite busy timeout (ms) (default=sqlite_profile.sql value)")
+    parser.add_option("--journal_mode",
+                      help="sqlite journal mode to set, which persists in the database "
+                      + "(DELETE, TRUNCATE, PERSIST or WAL; WAL only on a local filesystem) "
+                      + "(default=leave it unchanged)")
+    parser.add_option("--in_memory",
+                      action='store_true',
+                      help="Compute the updates in an in-memory copy of the tables "
+                      + "and then apply them in one short transaction (sqlite only)")
+    parser.add_option("--fingerprint_file",
+                      help="fingerprint of the last rdb file processed, to skip or "
+                      + "shorten updates when it is unchanged (default=not used)")
+    parser.add_option("--timeline_snapshot_file",
+                      help="binary snapshot of the timeline_loads view to write after "
+                      + "each update, for timeline_snapshot.read_snapshot() (default=not used)")
+    parser.add_option("--h5file",
+                      help="HDF5 mirror of the load_segments, timelines and tl_obsids "
+                      + "tables to update after each update (default=not used)")
     
     (opt,args) = parser.parse_args()
     return opt, args
@@ -75,17 +100,28 @@ def get_built_load( run_load, dbh=None):
         if match_like is None:
             raise ValueError("Load name %s is in unknown form, expects /CL\d{3}:\d{4}/" %
                              run_load['load_segment'])
+        # match on the normalized (and indexed) CLddd:hhmm part of the name,
+        # or by name for rows without a load_key (e.g. added by hand)
         like_load = match_like.group(1)
-        built_query = ( """select * from tl_built_loads where load_segment like '%s%s%s' 
-                           and year = %d order by sumfile_modtime desc"""
-                        % ( '%', like_load, '%',run_load['year'] ))
+        built_query = ( """select * from tl_built_loads where year = %d
+                           and (load_key = '%s'
+                                or (load_key is null and load_segment like '%s%s%s'))
+                           order by sumfile_modtime desc"""
+                        % ( run_load['year'], load_key(like_load), '%', like_load, '%' ))
         built = dbh.fetchone( built_query )
         # if a built version *still* hasn't been found
         if built  is None:
             raise ValueError("Unable to find file for %s,%s" % (run_load['year'], run_load['load_segment']))
+        if built['load_key'] is None:
+            warn_missing_key('tl_built_loads', built['load_segment'])
     return built
 
 
+def warn_missing_key(table, name):
+    log.warn("LOAD_SEG WARN: %s row %s has no lookup key and was matched by name; "
+             "set the keys with migrate_db.py --backfill" % (table, name))
+
+
 def get_processing( built, dbh=None ):
     """
     Given an entry from the tl_built_loads table, return the entry for the 
@@ -120,20 +156,164 @@ def get_replan_dir(replan_seg, run_datestart, dbh=None):
     # to be unique across calendar years, so this routine has code to limit to just those files
     # that have start times within 30 days of the new/replanned load.
     # Note that processing_tstart is really a Chandra.Time.date format in the database.
+    # The file name match uses the normalized (and indexed) Cddd*hhmm.sum part
+    # of the file name, or the file name itself for rows without a file_key.
     replan_query = ("""select * from tl_processing
-                       where file like 'C%s%s%s.sum'
+                       where (file_key = '%s:%s'
+                              or (file_key is null and file like 'C%s%s%s.sum'))
                        and processing_tstart > "%s"
                        order by year, processing_tstop desc
-                       """ % (match_like.group(1), '%', match_like.group(2),
+                       """ % (match_like.group(1), match_like.group(2),
+                              match_like.group(1), '%', match_like.group(2),
                               (DateTime(run_datestart) - 30).date))
     replan = dbh.fetchone(replan_query)
     # if a replan directory *still* hasn't been found
     if replan is None:
         raise ValueError("Unable to find file for %s" % (replan_seg))
+    if replan['file_key'] is None:
+        warn_missing_key('tl_processing', replan['file'])
     return replan['dir']
 
 
-def weeks_for_load( run_load, dbh=None, test=False ):
+class WeekResolver(object):
+    """
+    Batched lookups of the built loads, processing summaries, and replan
+    source directories for a list of load segments, for use by
+    weeks_for_load in place of one or more queries per load
+    (get_built_load, get_processing, and get_replan_dir).
+
+    The candidate tl_built_loads and tl_processing rows are fetched in a
+    few queries, with the same orderings as the per-load queries, and
+    indexed by (year, load_segment), (year, load_key), and
+    (file, sumfile_modtime).  Each
+    lookup then takes the first matching row, as the per-load query's
+    fetchone would (including the rows without a lookup key, which are
+    matched by name).
+
+    :param run_loads: load segments (dicts or recarray) to be resolved
+    :param dbh: database handle for tl_built_loads and tl_processing
+    """
+    def __init__(self, run_loads, dbh):
+        self.dbh = dbh
+        years = [int(run_load['year']) for run_load in run_loads]
+        self.built = {}
+        self.built_by_key = {}
+        self.built_without_key = []
+        if len(years):
+            built_rows = dbh.fetch("""select * from tl_built_loads
+                                      where year >= %d and year <= %d
+                                      order by sumfile_modtime desc"""
+                                   % (min(years), max(years)))
+            for built in built_rows:
+                self.built.setdefault((built['year'], built['load_segment']), built)
+                if built['load_key'] is None:
+                    self.built_without_key.append(built)
+                else:
+                    self.built_by_key.setdefault((built['year'], built['load_key']), built)
+
+        # processing entries for the files of the built loads that will be used
+        files = set()
+        for run_load in run_loads:
+            try:
+                files.add(self.get_built_load(run_load)['file'])
+            except ValueError:
+                # raised again, in order, by weeks_for_load
+                pass
+        self.processing = {}
+        files = sorted(files)
+        for i in xrange(0, len(files), 500):
+            processing_rows = dbh.fetch("""select * from tl_processing
+                                           where file in (%s) order by dir desc"""
+                                        % ", ".join("'%s'" % f for f in files[i:i + 500]))
+            for processed in processing_rows:
+                self.processing.setdefault((processed['file'], processed['sumfile_modtime']),
+                                           processed)
+
+        # replan sources are fetched if needed, from 30 days before the first load
+        self.replan_tstart = None
+        if len(run_loads):
+            self.replan_tstart = (DateTime(min(run_load['datestart'] for run_load in run_loads))
+                                  - 30).date
+        self.replan_rows = None
+
+    def get_built_load(self, run_load):
+        """
+        Batched get_built_load
+        """
+        year = int(run_load['year'])
+        built = self.built.get((year, run_load['load_segment']))
+        if built is None:
+            match_like = re.search('(CL\d{3}:\d{4})', run_load['load_segment'])
+            if match_like is None:
+                raise ValueError("Load name %s is in unknown form, expects /CL\d{3}:\d{4}/" %
+                                 run_load['load_segment'])
+            key = load_key(match_like.group(1))
+            built = self.built_by_key.get((year, key))
+            # (the rows without a load_key are also newest first)
+            for unkeyed in self.built_without_key:
+                if unkeyed['year'] == year and load_key(unkeyed['load_segment']) == key:
+                    if built is None or unkeyed['sumfile_modtime'] > built['sumfile_modtime']:
+                        built = unkeyed
+                    break
+            # if a built version *still* hasn't been found
+            if built is None:
+                raise ValueError("Unable to find file for %s,%s" % (run_load['year'], run_load['load_segment']))
+            if built['load_key'] is None:
+                warn_missing_key('tl_built_loads', built['load_segment'])
+        return built
+
+    def get_processing(self, built):
+        """
+        Batched get_processing
+        """
+        processed = self.processing.get((built['file'], built['sumfile_modtime']))
+        if processed is None:
+            raise ValueError("Unable to find processing for built file %s", built['file'])
+        return processed
+
+    def get_replan_dir(self, replan_seg, run_datestart):
+        """
+        Batched get_replan_dir
+        """
+        match_like = re.search('C(\d{3}).?(\d{4})', replan_seg)
+        if match_like is None:
+            raise ValueError("Replan load seg %s is in unknown form, expects /C\d{3}?\d{4}/" %
+                             replan_seg)
+        if self.replan_rows is None:
+            self.replan_rows = list(self.dbh.fetch("""select * from tl_processing
+                                                      where processing_tstart > '%s'
+                                                      order by year, processing_tstop desc
+                                                      """ % self.replan_tstart))
+        key = '%s:%s' % (match_like.group(1), match_like.group(2))
+        tstart = (DateTime(run_datestart) - 30).date
+        for replan in self.replan_rows:
+            if replan['processing_tstart'] <= tstart:
+                continue
+            if replan['file_key'] == key:
+                return replan['dir']
+            if replan['file_key'] is None and file_key(replan['file']) == key:
+                warn_missing_key('tl_processing', replan['file'])
+                return replan['dir']
+        raise ValueError("Unable to find file for %s" % (replan_seg))
+
+
+def weeks_for_loads(run_loads, dbh=None, test=False):
+    """
+    Determine the timeline intervals for each of a list of load segments,
+    as weeks_for_load, but with batched queries (see WeekResolver).
+
+    :param run_loads: load segments (dicts or recarray)
+    :param dbh: database handle for tl_built_loads and tl_processing
+    :param test: test mode option to allow the routine to continue on missing history
+
+    :rtype: list (one per load) of lists of 'timeline' dicts
+    """
+    resolver = WeekResolver(run_loads, dbh)
+    return [weeks_for_load(run_load, dbh=dbh, test=test, resolver=resolver)
+            for run_load in run_loads]
+
+
+def weeks_for_load( run_load, dbh=None, test=False, resolver=None ):
     """ 
     Determine the timeline intervals that exist for a load segment
 
@@ -173,14 +353,19 @@ def weeks_for_load( run_load, dbh=None, test=False ):
     :param run_load: load segment dict
     :param dbh: database handle for tl_built_loads and tl_processing
     :param test: test mode option to allow the routine to continue on missing history
+    :param resolver: WeekResolver to use in place of per-load queries (optional)
 
     :rtype: list of dicts.  Each dict a 'timeline'
 
 
 
     """
-    built = get_built_load( run_load, dbh=dbh )
-    processed = get_processing( built, dbh=dbh )
+    if resolver is not None:
+        built = resolver.get_built_load( run_load )
+        processed = resolver.get_processing( built )
+    else:
+        built = get_built_load( run_load, dbh=dbh )
+        processed = get_processing( built, dbh=dbh )
 
     match_load_pieces = []
 
@@ -201,7 +386,10 @@ def weeks_for_load( run_load, dbh=None, test=False ):
         # if processing covers the end but not the beginning (this one was interruped)
         if (run_load['datestart'] < processed['processing_tstart']
             and run_load['datestop'] <= processed['processing_tstop']):
-            replan_dir = get_replan_dir(processed['replan_cmds'], run_load['datestart'], dbh=dbh )
+            if resolver is not None:
+                replan_dir = resolver.get_replan_dir(processed['replan_cmds'], run_load['datestart'])
+            else:
+                replan_dir = get_replan_dir(processed['replan_cmds'], run_load['datestart'], dbh=dbh )
             log.info("TIMELINES INFO: %s,%s is replan/reopen, using %s dir for imported cmds" % (
                 run_load['year'], run_load['load_segment'], replan_dir ))
             # the end
@@ -214,8 +402,10 @@ def weeks_for_load( run_load, dbh=None, test=False ):
             match_load_pieces.append( match.copy() )
     else:
         # if the run load matches the times of the built load
-        if ( (DateTime(run_load['datestart']).secs >= ( DateTime(built['first_cmd_time']).secs))
-             & (DateTime(run_load['datestop']).secs <= ( DateTime(built['last_cmd_time']).secs))):
+        if ( (chandra_dates.date2secs(run_load['datestart'])
+              >= chandra_dates.date2secs(built['first_cmd_time']))
+             & (chandra_dates.date2secs(run_load['datestop'])
+                <= chandra_dates.date2secs(built['last_cmd_time']))):
             match['incomplete'] = 0
         # append even if incomplete
         match_load_pieces.append(match.copy())
@@ -242,7 +432,54 @@ def get_ref_timelines( datestart, dbh=None, n=10):
     return ref_timelines
 
 
-def update_timelines_db( loads, dbh, max_id, dryrun=False, test=False):
+def find_timeline_changes(timelines, db_timelines):
+    """
+    Find the first of the new timelines that is not already in the database,
+    and the database timelines that will be superseded from there on.
+
+    A new timeline is already in the database if there is an entry that
+    a) has the same datestart
+    b) has the same load_segment
+    c) is shorter or the same length
+    This is a hash join on (datestart, load_segment_id) that keeps the
+    shortest database datestop for each key.
+
+    :param timelines: new timelines, sorted by datestart
+    :param db_timelines: database timelines (recarray or list of dicts)
+    :rtype: (index of the first new timeline that differs, list of the
+             database timelines after the last matching one that are not
+             fixed by hand and are not the same as a new timeline)
+    """
+    db_stops = {}
+    for db_timeline in db_timelines:
+        key = (db_timeline['datestart'], db_timeline['load_segment_id'])
+        if key not in db_stops or db_timeline['datestop'] < db_stops[key]:
+            db_stops[key] = db_timeline['datestop']
+
+    i_diff = 0
+    for timeline in timelines:
+        db_stop = db_stops.get((timeline['datestart'], timeline['load_segment_id']))
+        if db_stop is None or timeline['datestop'] < db_stop:
+            break
+        i_diff += 1
+    if i_diff == len(timelines):
+        return i_diff, []
+
+    # the database timelines that are replaced, i.e. those starting after
+    # the last matching timeline, excluding any that will be inserted again
+    after = timelines[i_diff - 1]['datestart']
+    new = set((timeline['datestart'], timeline['load_segment_id'], timeline['datestop'])
+              for timeline in timelines[i_diff:])
+    superseded = [db_timeline for db_timeline in db_timelines
+                  if (db_timeline['datestart'] > after
+                      and not db_timeline['fixed_by_hand']
+                      and db_timeline['datestart'] <= db_timeline['datestop']
+                      and (db_timeline['datestart'], db_timeline['load_segment_id'],
+                           db_timeline['datestop']) not in new)]
+    return i_diff, superseded
+
+
+def update_timelines_db( loads, dbh, max_id, dryrun=False, test=False, commit=True):
     """
     Given a list of load segments this routine determines the timelines (mission
     planning weeks and loads etc) over the loads and inserts new timelines 
@@ -259,6 +496,7 @@ def update_timelines_db( loads, dbh, max_id, dryrun=False, test=False):
 
     :param loads: dict or recarray of loads 
     :param dryrun: do not update database
+    :param commit: commit the update (otherwise left to the caller)
     :rtype: None
     """
 
@@ -269,10 +507,7 @@ def update_timelines_db( loads, dbh, max_id, dryrun=False, test=False):
              % ( as_run[0]['datestart'], as_run[-1]['datestop']))
 
     timelines = []
-    for run_load in as_run:
-        run_timelines = weeks_for_load( run_load,
-                                        dbh=dbh,
-                                        test=test)
+    for run_load, run_timelines in izip(as_run, weeks_for_loads(as_run, dbh=dbh, test=test)):
         if len(run_timelines) == 0:
             raise ValueError("No timelines found for load %s" % run_load )
         for run_timeline in run_timelines:
@@ -286,22 +521,7 @@ def update_timelines_db( loads, dbh, max_id, dryrun=False, test=False):
                                    order by datestart, load_segment_id 
                                    """ % ( timelines[0]['datestart']))
        
-    if len(db_timelines) > 0:
-        i_diff = 0
-        for timeline in timelines:
-            # if there is an entry in the database already that
-            # a) has the same datestart
-            # b) has the same load_segment
-            # c) is shorter or the same length
-            # then there is a match, and skip along to the next one
-            startmatch = timeline['datestart'] == db_timelines['datestart']
-            lsmatch = timeline['load_segment_id'] == db_timelines['load_segment_id']
-            endmatch = timeline['datestop'] >= db_timelines['datestop']
-            if not any(startmatch & lsmatch & endmatch):
-                break
-            i_diff += 1
-    else:
-       i_diff = 0
+    i_diff, superseded = find_timeline_changes(timelines, db_timelines)
 
     # Mismatch occured at i_diff.  
 
@@ -309,36 +529,51 @@ def update_timelines_db( loads, dbh, max_id, dryrun=False, test=False):
         log.info('TIMELINES INFO: No database update required')
         return
 
+    for db_timeline in superseded:
+        log.info('TIMELINES INFO: superseding timeline %d %s %s %s' % (
+                db_timeline['id'], db_timeline['dir'],
+                db_timeline['datestart'], db_timeline['datestop']))
+
+    # set the numeric times of the new timelines
+    tstarts = chandra_dates.date2secs([t['datestart'] for t in timelines[i_diff:]])
+    tstops = chandra_dates.date2secs([t['datestop'] for t in timelines[i_diff:]])
+    for run_timeline, tstart, tstop in izip(timelines[i_diff:], tstarts.tolist(), tstops.tolist()):
+        run_timeline['tstart'] = tstart
+        run_timeline['tstop'] = tstop
+
     # warn if timeline is shorter than an hour
-    for run_timeline in timelines[i_diff:]:
-        time_length = DateTime(run_timeline['datestop']).secs - DateTime(run_timeline['datestart']).secs
+    time_lengths = tstops - tstarts
+    for run_timeline, time_length in izip(timelines[i_diff:], time_lengths):
         if time_length / 60. < 60:
             log.warn("TIMELINES WARN: short timeline at %s, %d minutes" % ( run_timeline['datestart'],
                                                                             time_length / 60. ))
-    # find all db timelines that start after the last valid one [i_diff-1]
-    findcmd = ("""SELECT id from timelines 
-                  WHERE datestart > '%s'
-                  AND fixed_by_hand = 0
-                  AND datestart <= datestop """
-               % timelines[i_diff-1]['datestart'] )
-    defunct_tl = dbh.fetchall( findcmd )
-    if len(defunct_tl):
-        for id in defunct_tl.id:
-            clear_timeline( id, dbh=dbh, dryrun=dryrun )
-        
-    # Insert new timelines[i_diff:] 
-    log.info('TIMELINES INFO: inserting timelines[%d:%d] to timelines' %
-                  (i_diff, len(timelines)+1))
-    for t_count, timeline in enumerate(timelines[i_diff:]):
-        log.debug('TIMELINES DEBUG: inserting timeline:')
-        insert_string = "\t %s %s %s" % ( timeline['dir'], 
-                                             timeline['datestart'], timeline['datestop'], 
-                                             )
-        log.debug(insert_string)
-        timeline['id'] = max_id + 1 + t_count
-        timeline['fixed_by_hand'] = 0
+    try:
+        # clear all db timelines that start after the last valid one [i_diff-1]
+        clear_timelines_after( timelines[i_diff-1]['datestart'], dbh=dbh, dryrun=dryrun,
+                               commit=False )
+
+        # Insert new timelines[i_diff:] 
+        log.info('TIMELINES INFO: inserting timelines[%d:%d] to timelines' %
+                      (i_diff, len(timelines)+1))
+        names = sorted(set(timelines[i_diff].keys()) | set(['id', 'fixed_by_hand']))
+        rows = []
+        for t_count, timeline in enumerate(timelines[i_diff:]):
+            log.debug('TIMELINES DEBUG: inserting timeline:')
+            insert_string = "\t %s %s %s" % ( timeline['dir'], 
+                                                 timeline['datestart'], timeline['datestop'], 
+                                                 )
+            log.debug(insert_string)
+            timeline['id'] = max_id + 1 + t_count
+            timeline['fixed_by_hand'] = 0
+            rows.append(tuple(timeline[name] for name in names))
+        if not dryrun:
+            insert_rows('timelines', names, rows, dbh=dbh)
+            if commit:
+                dbh.commit()
+    except:
         if not dryrun:
-            dbh.insert(timeline, 'timelines')
+            dbh.conn.rollback()
+        raise
 
 def rdb_to_db_schema( orig_ifot_loads ):
     """
@@ -349,11 +584,11 @@ def rdb_to_db_schema( orig_ifot_loads ):
     :rtype: recarray 
     """
     loads = []
-    for orig_load in orig_ifot_loads:
-        starttime = DateTime(orig_load['TStart (GMT)'])
+    years = chandra_dates.date2year(orig_ifot_loads['TStart (GMT)'])
+    for orig_load, year in izip(orig_ifot_loads, years):
         load = ( 
                  orig_load['LOADSEG.NAME'],
-                 int(starttime.frac_year),
+                 int(year),
                  orig_load['TStart (GMT)'],
                  orig_load['TStop (GMT)'],
                  orig_load['LOADSEG.SCS'],
@@ -377,8 +612,9 @@ def check_load_overlap( loads, max_sep_hours=36):
     :rtype: None
     """
 
-    sep_times = ( DateTime(loads[1:]['datestart']).secs 
-                  - DateTime(loads[:-1]['datestop']).secs )
+    tstarts = chandra_dates.date2secs(loads['datestart'])
+    tstops = chandra_dates.date2secs(loads['datestop'])
+    sep_times = tstarts[1:] - tstops[:-1]
     max_sep = max_sep_hours * 60 * 60
     # check for too much sep
     if (any(sep_times > max_sep )):
@@ -389,13 +625,76 @@ def check_load_overlap( loads, max_sep_hours=36):
                             max_sep_hours ))
     # any SCS overlap
     for scs in (128, 129, 130, 131, 132, 133):
-        scs_loads = loads[ loads['load_scs'] == scs ]
-        scs_times = ( DateTime(scs_loads[1:]['datestart']).secs 
-                      - DateTime(scs_loads[:-1]['datestop']).secs)
+        scs_idx = loads['load_scs'] == scs
+        scs_times = tstarts[scs_idx][1:] - tstops[scs_idx][:-1]
         if (any(scs_times < 0 )):
             log.warn('LOAD_SEG WARN: Same SCS loads overlap')
 
 
+def insert_rows( table, names, rows, dbh=None ):
+    """
+    Insert rows into a table with one executemany (sqlite) without
+    committing.
+
+    :param table: table name
+    :param names: column names
+    :param rows: list of tuples of values in the order of ``names``
+    :param dbh: database handle
+    :rtype: None
+    """
+    if dbh.dbi != 'sqlite':
+        for row in rows:
+            dbh.insert(dict(izip(names, row)), table, commit=False)
+        return
+    cmd = ("INSERT INTO %s (%s) VALUES (%s)"
+           % (table, ', '.join(names), ', '.join('?' for name in names)))
+    dbh.conn.cursor().executemany(cmd, rows)
+
+
+def clear_timelines( ids, dbh=None, dryrun=False, commit=True ):
+    """
+    Clear the commands related to a set of timelines and then delete the
+    timelines (except those that are fixed_by_hand), with a few set-based
+    DELETEs in a single transaction.
+
+    :param ids: unique ids of timelines
+    :param dbh: database handle for cmd_fltpars, cmd_intpars, cmds, and timlines tables
+    :param dryrun: dryrun option/ no cmds are executed
+    :param commit: commit the transaction (otherwise left to the caller)
+    :rtype: None
+    """
+    ids = sorted(set(int(id) for id in ids))
+    if not len(ids):
+        return
+    log.debug('TIMELINES DEBUG: clearing timelines %s' % ', '.join(str(id) for id in ids))
+    try:
+        for i in xrange(0, len(ids), 500):
+            id_list = ', '.join(str(id) for id in ids[i:i + 500])
+            # remove related cmds as if there were a foreign key constraint
+            for table in ('cmd_fltpars', 'cmd_intpars', 'cmds'):
+                cmd = (""" DELETE from %s
+                           WHERE timeline_id IN (%s) """
+                       % ( table, id_list ))
+                log.debug('TIMELINES DEBUG: ' + cmd)
+                if not dryrun:
+                    dbh.execute(cmd, commit=False)
+
+            # remove defunct timelines
+            cmd = ("""DELETE FROM timelines 
+                      WHERE id IN (%s) 
+                      AND fixed_by_hand = 0 """
+                   % id_list)
+            log.debug('TIMELINES DEBUG: ' + cmd)
+            if not dryrun:
+                dbh.execute(cmd, commit=False)
+        if commit and not dryrun:
+            dbh.commit()
+    except:
+        if not dryrun:
+            dbh.conn.rollback()
+        raise
+
+
 def clear_timeline( id, dbh=None, dryrun=False ):
     """
     Clear the commands related to a timeline and then delete the timeline.
@@ -405,45 +704,51 @@ def clear_timeline( id, dbh=None, dryrun=False ):
     :param dryrun: dryrun option/ no cmds are executed
     :rtype: None
     """
+    clear_timelines( [id], dbh=dbh, dryrun=dryrun )
 
-    # remove related cmds as if there were a foreign key constraint
-    for table in ('cmd_fltpars', 'cmd_intpars', 'cmds'):
-        cmd = (""" DELETE from %s
-                   WHERE timeline_id = %s """
-               % ( table, id ))
-        log.debug('TIMELINES DEBUG: ' + cmd)
-        if not dryrun:
-            dbh.execute(cmd)
-    
-    # remove defunct timelines
-    cmd = ("""DELETE FROM timelines 
-              WHERE id = %s 
-              AND fixed_by_hand = 0 """
-           % id)
-    log.debug('TIMELINES DEBUG: ' + cmd)
-    if not dryrun:
-        dbh.execute(cmd)
+
+def clear_timelines_after( datestart, dbh=None, dryrun=False, commit=True ):
+    """
+    Clear the timelines (that are not fixed_by_hand) that start after
+    ``datestart``, and their commands.
+
+    :param datestart: clear timelines with datestart > this date
+    :param dbh: database handle
+    :param dryrun: dryrun option/ no cmds are executed
+    :param commit: commit the transaction (otherwise left to the caller)
+    :rtype: list of the ids of the cleared timelines
+    """
+    findcmd = ("""SELECT id from timelines 
+                  WHERE datestart > '%s'
+                  AND fixed_by_hand = 0
+                  AND datestart <= datestop """
+               % datestart )
+    defunct_tl = dbh.fetchall( findcmd )
+    ids = [tl['id'] for tl in defunct_tl]
+    clear_timelines( ids, dbh=dbh, dryrun=dryrun, commit=commit )
+    return ids
 
 
-def clear_rel_timelines( load_segments, dbh=None, dryrun=False ):
+def clear_rel_timelines( load_segments, dbh=None, dryrun=False, commit=True ):
     """
     Remove timelines related to (fk constrained to) load_segments from the timelines db
 
     :param load_segments: recarray of to-be-deleted load_segments
+    :param commit: commit the transaction (otherwise left to the caller)
     :rtype: None
     """
-    for load in load_segments:
-        db_timelines = dbh.fetchall("SELECT * from timelines where load_segment_id = %i" 
-                                   % ( load['id']))
-        
-        if len(db_timelines) > 0:
-            if (any(db_timelines['fixed_by_hand'])):
-                for timeline in db_timelines[ db_timelines['fixed_by_hand'] == 1]:
-                    log.warn("LOAD_SEG WARN: updating timelines across %i which is fixed_by_hand" 
-                             % (timeline['id']))
+    load_ids = [int(load['id']) for load in load_segments]
+    timeline_ids = []
+    for i in xrange(0, len(load_ids), 500):
+        db_timelines = dbh.fetchall("SELECT * from timelines where load_segment_id IN (%s)"
+                                    % ', '.join(str(id) for id in load_ids[i:i + 500]))
+        for timeline in db_timelines:
+            if timeline['fixed_by_hand']:
+                log.warn("LOAD_SEG WARN: updating timelines across %i which is fixed_by_hand" 
+                         % (timeline['id']))
+            timeline_ids.append(timeline['id'])
 
-            for timeline in db_timelines:
-                clear_timeline( timeline['id'], dbh=dbh, dryrun=dryrun )
+    clear_timelines( timeline_ids, dbh=dbh, dryrun=dryrun, commit=commit )
 
 
 
@@ -467,19 +772,22 @@ def find_load_seg_changes(wants, haves, exclude=[]):
     # Find mismatches:
     match_cols = [x[0] for x in haves.dtype.descr if 'f' not in x[1]]
     [match_cols.remove(col) for col in exclude]
-    # Use explicity increment for i_diff so that it gets set to the 
+    # Compare the overlapping entries column by column and set i_diff to the
     # index of the first not-matching entry, or if wants is longer than
-    # haves (the usual append condition) it gets set to the index of
-    # the first new entry in wants.
-    i_diff = 0
-    for want_entry, have_entry in izip(wants, haves):
-        # does the db load match?
-        if (any(have_entry[x] != want_entry[x] for x in match_cols) ):
-            log.info('LOAD_SEG INFO: Mismatch on these entries:')
-            log.info(want_entry)
-            log.info(have_entry)
-            break                
-        i_diff += 1
+    # haves (the usual append condition) to the index of the first new
+    # entry in wants.
+    n_overlap = min(len(wants), len(haves))
+    mismatch = np.zeros(n_overlap, dtype=bool)
+    for col in match_cols:
+        mismatch |= np.asarray(haves[col][:n_overlap]) != np.asarray(wants[col][:n_overlap])
+    i_mismatch = np.flatnonzero(mismatch)
+    if len(i_mismatch):
+        i_diff = int(i_mismatch[0])
+        log.info('LOAD_SEG INFO: Mismatch on these entries:')
+        log.info(wants[i_diff])
+        log.info(haves[i_diff])
+    else:
+        i_diff = n_overlap
 
     if i_diff == 0:
         raise ValueError("Unexpected mismatch at first database entry in range")
@@ -500,13 +808,14 @@ def find_load_seg_changes(wants, haves, exclude=[]):
 
 
 
-def update_loads_db( ifot_loads, dbh=None, test=False, dryrun=False,):
+def update_loads_db( ifot_loads, dbh=None, test=False, dryrun=False, commit=True):
     """
     Update the load_segments table with the loads from an RDB file.
 
     :param ifot_loads: recarray of ifot run loads 
     :param test: allow writes of < year 2009 data 
     :param dryrun: do not write to the database
+    :param commit: commit the update (otherwise left to the caller)
     :rtype: list of new loads
     """
     
@@ -557,37 +866,267 @@ def update_loads_db( ifot_loads, dbh=None, test=False, dryrun=False,):
         log.info('LOAD_SEG INFO: No database update required')
         return to_insert
 
-    clear_rel_timelines(to_delete, dbh=dbh, dryrun=dryrun)
-    if not dryrun:
+    try:
+        clear_rel_timelines(to_delete, dbh=dbh, dryrun=dryrun, commit=False)
         for load in to_delete:
-            cmd = ("DELETE FROM load_segments WHERE id = %d"
-                   % load['id'] )
-            log.info('LOAD_SEG INFO: ' + cmd)
-            dbh.execute(cmd)
-
-    # check for overlap in the loads... the check_load_overlap just logs warnings
-    check_load_overlap( ifot_loads )    
-
-    # Insert new loads[i_diff:] into load_segments
-    #log.info('LOAD_SEG INFO: inserting load_segs[%d:%d] to load_segments' %
-    #              (i_diff, len(ifot_loads)+1))
-
-    for load_count, load in enumerate(to_insert):
-        log.debug('LOAD_SEG DEBUG: inserting load')
-        insert_string = "\t %s %d %s %s %d" % ( load['load_segment'], load['year'],
-                                             load['datestart'], load['datestop'], load['load_scs'] )
-        log.debug(insert_string)
-        load_dict = dict(zip(load.dtype.names, load))
-        load_dict['id'] = max_id + 1 + load_count;
+            log.info('LOAD_SEG INFO: DELETE FROM load_segments WHERE id = %d' % load['id'])
+        delete_ids = [int(load['id']) for load in to_delete]
+        for i in xrange(0, len(delete_ids), 500):
+            cmd = ("DELETE FROM load_segments WHERE id IN (%s)"
+                   % ', '.join(str(id) for id in delete_ids[i:i + 500]))
+            if not dryrun:
+                dbh.execute(cmd, commit=False)
+
+        # check for overlap in the loads... the check_load_overlap just logs warnings
+        check_load_overlap( ifot_loads )    
+
+        # Insert new loads into load_segments, with ids after max_id
+        for load in to_insert:
+            log.debug('LOAD_SEG DEBUG: inserting load')
+            insert_string = "\t %s %d %s %s %d" % ( load['load_segment'], load['year'],
+                                                 load['datestart'], load['datestop'], load['load_scs'] )
+            log.debug(insert_string)
+        if len(to_insert) and not dryrun:
+            names = [name for name in to_insert.dtype.names
+                     if name not in ('id', 'tstart', 'tstop')]
+            columns = [to_insert[name].tolist() for name in names]
+            columns.append(range(max_id + 1, max_id + 1 + len(to_insert)))
+            # (and the numeric times of the dates, as edited by any repairs)
+            columns.append(chandra_dates.date2secs(to_insert['datestart']).tolist())
+            columns.append(chandra_dates.date2secs(to_insert['datestop']).tolist())
+            insert_rows('load_segments', names + ['id', 'tstart', 'tstop'], zip(*columns), dbh=dbh)
+        if not dryrun and commit:
+            dbh.commit()
+    except:
         if not dryrun:
-            dbh.insert(load_dict, 'load_segments', commit=True)
+            dbh.conn.rollback()
+        raise
     return to_insert
 
     
 
         
+def get_db_state(dbh, datestart=None):
+    """
+    Summarize the state of the tables that determine the load segments and
+    timelines (row counts, max ids or modification times, and a digest of
+    the load segments and timelines from ``datestart``), and the repair
+    scripts, for the rdb fingerprint.
+
+    :param dbh: database handle
+    :param datestart: start of the rows digested (default=all rows)
+    :rtype: list
+    """
+    window_digests = [(table, loadseg_fingerprint.rows_digest(dbh.fetch(query % (datestart or ''))))
+                      for table, query in loadseg_fingerprint.WINDOW_QUERIES]
+    return loadseg_fingerprint.db_state(dbh.fetchone(loadseg_fingerprint.DB_STATE_QUERY),
+                                        fix_script_dir(), window_digests)
+
+
+def fix_script_dir():
+    """
+    Directory of the repair scripts (fix_tl_processing.py and
+    fix_load_segments.py)
+    """
+    return os.path.dirname(os.path.abspath(fix_tl_processing.__file__))
+
+
+def loads_since(ifot_loads, datestart, n_context=2):
+    """
+    Trim a recarray of loads to those that start at or after ``datestart``,
+    keeping ``n_context`` (unchanged) loads before them so that the updates
+    still overlap the database, and at least two loads.
+
+    :param ifot_loads: recarray of loads sorted by datestart
+    :param datestart: date of the first changed load
+    :param n_context: number of earlier loads to keep
+    :rtype: recarray
+    """
+    i_start = np.searchsorted(ifot_loads['datestart'], datestart)
+    i_start = max(0, min(i_start, len(ifot_loads) - 2) - n_context)
+    return ifot_loads[i_start:]
+
+
+def snapshot_windows( datestart, db='' ):
+    """
+    The rows of each table that could be read or changed by an update from
+    ``datestart`` (see snapshot_db()), as (table, where clause) pairs.
+
+    :param datestart: start of the update
+    :param db: database name prefix (e.g. 'disk.') for the subqueries
+    :rtype: tuple of (table, where clause)
+    """
+    year = int(datestart[:4]) - 1
+    return (('load_segments', "datestart >= '%s' OR id = (SELECT max(id) FROM %sload_segments)"
+             % (datestart, db)),
+            ('timelines', "datestop >= '%s' OR id = (SELECT max(id) FROM %stimelines)"
+             % (datestart, db)),
+            ('tl_built_loads', "year >= %d" % year),
+            ('tl_processing', "year >= %d OR year IS NULL" % year),
+            ('cmds', "0"),
+            ('cmd_intpars', "0"),
+            ('cmd_fltpars', "0"))
+
+
+def window_checksum( conn, table, where ):
+    """
+    Row count, max id and digest of the contents of the rows of a table
+    (in any order), to find any insert, delete or edit of the rows.
+
+    :param conn: sqlite3 connection
+    :param table: table name
+    :param where: where clause of the rows
+    :rtype: [count, max id (or None), md5 hex digest]
+    """
+    rows = conn.execute("SELECT * FROM %s WHERE %s" % (table, where)).fetchall()
+    names = [column[0] for column in conn.execute("SELECT * FROM %s LIMIT 0" % table).description]
+    rows = [dict(izip(names, row)) for row in rows]
+    max_id = None
+    if rows and 'id' in names:
+        max_id = max(row['id'] for row in rows)
+    return [len(rows), max_id, loadseg_fingerprint.rows_digest(rows)]
+
+
+def snapshot_db( server, datestart ):
+    """
+    Copy the rows of the tables used by the load segment and timelines
+    updates that could be read or changed by an update from ``datestart``
+    into an in-memory sqlite database: the load segments and timelines
+    from datestart (and the rows with the max ids), and the tl_built_loads
+    and tl_processing rows from the year before.  The cmds tables are made
+    but left empty; their rows are only cleared, by apply_delta().
+
+    :param server: sqlite database file
+    :param datestart: start of the update
+    :rtype: (in-memory database handle, dict of the snapshot ids by table,
+             with the start and the window checksums as 'datestart' and
+             'checksums')
+    """
+    mem = DBI(dbi='sqlite', server=':memory:', numpy=True)
+    mem.execute("ATTACH DATABASE '%s' AS disk" % server)
+    windows = snapshot_windows(datestart, db='disk.')
+    for table, where in windows:
+        mem.execute(mem.fetchone("""SELECT sql FROM disk.sqlite_master
+                                    WHERE type = 'table' AND name = '%s'""" % table)['sql'])
+    # copy the rows in one read transaction, for a consistent snapshot
+    for table, where in windows:
+        mem.execute("INSERT INTO main.%s SELECT * FROM disk.%s WHERE %s" % (table, table, where),
+                    commit=False)
+    mem.commit()
+    for table, where in windows:
+        for index in mem.fetchall("""SELECT sql FROM disk.sqlite_master
+                                     WHERE type = 'index' AND tbl_name = '%s'
+                                     AND sql IS NOT NULL""" % table):
+            mem.execute(index['sql'])
+    mem.execute("DETACH DATABASE disk")
+    snapshot = dict((table, set(row['id'] for row in mem.fetch("SELECT id FROM %s" % table)))
+                    for table in ('load_segments', 'timelines'))
+    # (the copy is the window, before the update changes it)
+    snapshot['datestart'] = datestart
+    snapshot['checksums'] = dict((table, window_checksum(mem.conn, table, "1"))
+                                 for table, where in windows if where != "0")
+    log.debug("LOAD_SEG DEBUG: snapshot of %d load segments and %d timelines from %s"
+              % (len(snapshot['load_segments']), len(snapshot['timelines']), datestart))
+    return mem, snapshot
+
+
+def apply_delta( mem, snapshot, dbh, dryrun=False ):
+    """
+    Apply the changes made to the load segments and timelines of an
+    in-memory snapshot (from snapshot_db()) to the database in one
+    transaction: the timelines of deleted load segments and deleted
+    timelines are cleared (with their commands) and the deleted load
+    segments removed, and then the new rows are inserted.
+
+    :param mem: in-memory database handle
+    :param snapshot: dict of the snapshot ids by table
+    :param dbh: database handle
+    :param dryrun: only log the changes
+    :rtype: None
+    """
+    deleted = {}
+    inserted = {}
+    for table in ('load_segments', 'timelines'):
+        ids = set(row['id'] for row in mem.fetch("SELECT id FROM %s" % table))
+        deleted[table] = sorted(snapshot[table] - ids)
+        inserted[table] = sorted(ids - snapshot[table])
+        log.info("LOAD_SEG INFO: %s: %d rows to delete and %d to insert"
+                 % (table, len(deleted[table]), len(inserted[table])))
+    # fixed_by_hand timelines of deleted loads are kept, but their commands cleared
+    cleared = set(deleted['timelines'])
+    for i in xrange(0, len(deleted['load_segments']), 500):
+        cleared.update(row['id'] for row in mem.fetch(
+                "SELECT id FROM timelines WHERE load_segment_id IN (%s)"
+                % ', '.join(str(id) for id in deleted['load_segments'][i:i + 500])))
+    if dryrun:
+        return
+
+    # take the write lock before checking that nothing else has changed the
+    # snapshot rows (including edits in place, e.g. of fixed_by_hand), so
+    # that nothing can change them between the check and the writes
+    isolation_level = dbh.conn.isolation_level
+    dbh.conn.isolation_level = None
+    try:
+        dbh.conn.execute("BEGIN IMMEDIATE")
+        try:
+            for table, where in snapshot_windows(snapshot['datestart']):
+                if (table in snapshot['checksums']
+                        and window_checksum(dbh.conn, table, where) != snapshot['checksums'][table]):
+                    raise ValueError("LOAD_SEG: %s changed since the snapshot" % table)
+            clear_timelines( cleared, dbh=dbh, commit=False )
+            for i in xrange(0, len(deleted['load_segments']), 500):
+                dbh.execute("DELETE FROM load_segments WHERE id IN (%s)"
+                            % ', '.join(str(id) for id in deleted['load_segments'][i:i + 500]),
+                            commit=False)
+            for table in ('load_segments', 'timelines'):
+                for i in xrange(0, len(inserted[table]), 500):
+                    rows = mem.fetchall("SELECT * FROM %s WHERE id IN (%s)"
+                                        % (table, ', '.join(str(id) for id in inserted[table][i:i + 500])))
+                    insert_rows(table, rows.dtype.names, rows.tolist(), dbh=dbh)
+            dbh.conn.execute("COMMIT")
+        except:
+            dbh.conn.execute("ROLLBACK")
+            raise
+    finally:
+        dbh.conn.isolation_level = isolation_level
+
+
+def write_timeline_snapshot(dbh, filename):
+    """
+    Write the binary snapshot of the timeline_loads view for read-only
+    tools (see timeline_snapshot.py).
+
+    :param dbh: database handle
+    :param filename: snapshot file name
+    :rtype: None
+    """
+    n_rows = timeline_snapshot.write_snapshot(dbh, filename)
+    log.info("LOAD_SEG INFO: wrote %d timelines to %s" % (n_rows, filename))
+
+
+def update_h5(dbh, h5file, since=None):
+    """
+    Update the HDF5 mirror of the load_segments, timelines and tl_obsids
+    tables (see timelines_h5.py).
+
+    :param dbh: database handle
+    :param h5file: HDF5 file name
+    :param since: date from which load_segments and timelines rows may
+                  have changed
+    :rtype: None
+    """
+    # PyTables is only needed for the mirror
+    import timelines_h5
+    changes = timelines_h5.update_h5(dbh, h5file, since=since)
+    for table, (n_truncated, n_appended) in sorted(changes.items()):
+        log.info("LOAD_SEG INFO: %s: truncated %d and appended %d rows of %s"
+                 % (h5file, n_truncated, n_appended, table))
+
+
 def main(loadseg_rdb_dir, dryrun=False, test=False,
-         dbi='sqlite', server='db_base.db3' ,database=None, user=None, verbose=False):
+         dbi='sqlite', server='db_base.db3' ,database=None, user=None, verbose=False,
+         fingerprint_file=None, in_memory=False, busy_timeout=None,
+         timeline_snapshot_file=None, h5file=None, journal_mode=None):
     """
     Command Load Segment Table Updater
     
@@ -603,9 +1142,27 @@ def main(loadseg_rdb_dir, dryrun=False, test=False,
     Note that dryrun mode does not show timelines which *would* be updated,
     as an update to the load_segments table must happen prior to get_timelines()
 
+    With in_memory, the updates are computed in an in-memory copy of the
+    tables (so dryrun mode does show the timelines that would be updated),
+    and only the resulting changes are written to the database, in one
+    short transaction.
+
+    With a fingerprint_file, the update is skipped if the rdb file and the
+    database are unchanged since the last update, and limited to the loads
+    from the first changed row of the rdb if only the rdb has changed.
+
+    With a timeline_snapshot_file, a binary snapshot of the
+    timeline_loads view (see timeline_snapshot.py) is written after the
+    update (and when it is missing).
+
+    With an h5file, the HDF5 mirror of the load_segments, timelines and
+    tl_obsids tables (see timelines_h5.py) is updated from the first
+    changed load segment (and made when it is missing).
+
     """
 
-    dbh = DBI(dbi=dbi, server=server, database=database, user=user, verbose=verbose)
+    if in_memory and dbi != 'sqlite':
+        raise ValueError("LOAD_SEG: in_memory is only available for sqlite")
     ch = logging.StreamHandler()
     ch.setLevel(logging.WARN)
     if verbose:
@@ -618,8 +1175,48 @@ def main(loadseg_rdb_dir, dryrun=False, test=False,
     all_rdb_files = glob.glob(os.path.join(loadseg_dir, "*"))
     rdb_file = max(all_rdb_files)
     log.debug("LOAD_SEG DEBUG: Updating from %s" % rdb_file)
+
+    fingerprint = loadseg_fingerprint.read_fingerprint(fingerprint_file)
+    if fingerprint_file is not None:
+        digest = loadseg_fingerprint.content_digest(rdb_file)
+    # an unchanged rdb and sqlite database (and outputs that are all there)
+    # are found without connecting with the connection profile
+    if (fingerprint is not None and fingerprint['digest'] == digest
+            and fingerprint['server'] == server and dbi == 'sqlite'
+            and (timeline_snapshot_file is None or os.path.exists(timeline_snapshot_file))
+            and (h5file is None or os.path.exists(h5file))):
+        if (loadseg_fingerprint.sqlite_db_state(
+                server, fix_script_dir(), loadseg_fingerprint.window_start(fingerprint['rows']))
+                == fingerprint['db_state']):
+            log.info("LOAD_SEG INFO: %s unchanged since the last update" % rdb_file)
+            log.removeHandler(ch)
+            return
+
+    dbh = DBI(dbi=dbi, server=server, database=database, user=user, verbose=verbose)
+    sqlite_profile.apply_profile(dbh, busy_timeout=busy_timeout, journal_mode=journal_mode)
+    migrate_db.check_schema(dbh, server)
+    if fingerprint is not None:
+        db_state = get_db_state(dbh, loadseg_fingerprint.window_start(fingerprint['rows']))
+        if fingerprint['server'] != server or fingerprint['db_state'] != db_state:
+            log.info("LOAD_SEG INFO: database changed since %s" % fingerprint_file)
+            fingerprint = None
+        elif fingerprint['digest'] == digest:
+            log.info("LOAD_SEG INFO: %s unchanged since the last update" % rdb_file)
+            if (timeline_snapshot_file is not None and not dryrun
+                    and not os.path.exists(timeline_snapshot_file)):
+                write_timeline_snapshot(dbh, timeline_snapshot_file)
+            if h5file is not None and not dryrun and not os.path.exists(h5file):
+                update_h5(dbh, h5file)
+            log.removeHandler(ch)
+            return
+
+    # (only needed once the rdb has to be read)
+    import Ska.Table
     orig_rdb_loads = Ska.Table.read_ascii_table(rdb_file, datastart=3)
     ifot_loads = rdb_to_db_schema( orig_rdb_loads )
+    if fingerprint_file is not None:
+        rows = loadseg_fingerprint.row_digests(orig_rdb_loads)
+    h5_since = None
     if len(ifot_loads):
         # make any scripted edits to the tables of parsed files to override directory
         # mapping
@@ -628,18 +1225,60 @@ def main(loadseg_rdb_dir, dryrun=False, test=False,
         # make any scripted edits to the load segments table
         import fix_load_segments
         ifot_loads = fix_load_segments.repair(ifot_loads)
-        max_timelines_id = dbh.fetchone(
-            'SELECT max(id) AS max_id FROM timelines')['max_id'] or 0
-        if max_timelines_id == 0 and test == False:
-            raise ValueError("TIMELINES: no timelines in database.")
-        update_loads_db( ifot_loads, dbh=dbh, test=test, dryrun=dryrun )    
-        db_loads = dbh.fetchall("""select * from load_segments 
-                                   where datestart >= '%s' order by datestart   
-                                  """ % ( ifot_loads[0]['datestart'] )
-                                )
-        update_timelines_db(loads=db_loads, dbh=dbh, max_id=max_timelines_id,
-                            dryrun=dryrun, test=test)
+        changed = None
+        if fingerprint is not None:
+            changed = loadseg_fingerprint.first_changed_date(fingerprint['rows'], rows)
+            if changed is not None:
+                log.info("LOAD_SEG INFO: first changed load segment at %s" % changed)
+                ifot_loads = loads_since(ifot_loads, changed)
+        if fingerprint is None or changed is not None:
+            h5_since = ifot_loads[0]['datestart']
+            work_dbh = dbh
+            if in_memory:
+                work_dbh, snapshot = snapshot_db(server, ifot_loads[0]['datestart'])
+            max_timelines_id = work_dbh.fetchone(
+                'SELECT max(id) AS max_id FROM timelines')['max_id'] or 0
+            if max_timelines_id == 0 and test == False:
+                raise ValueError("TIMELINES: no timelines in database.")
+            # update the load segments and timelines in one transaction
+            # (of the in-memory copy, if in_memory, which is always updated)
+            work_dryrun = dryrun and not in_memory
+            try:
+                update_loads_db( ifot_loads, dbh=work_dbh, test=test, dryrun=work_dryrun,
+                                 commit=False )
+                db_loads = work_dbh.fetchall("""select * from load_segments 
+                                                where datestart >= '%s' order by datestart   
+                                               """ % ( ifot_loads[0]['datestart'] )
+                                             )
+                update_timelines_db(loads=db_loads, dbh=work_dbh, max_id=max_timelines_id,
+                                    dryrun=work_dryrun, test=test, commit=False)
+                if not work_dryrun:
+                    work_dbh.commit()
+            except:
+                if not work_dryrun:
+                    work_dbh.conn.rollback()
+                raise
+            if in_memory:
+                apply_delta(work_dbh, snapshot, dbh, dryrun=dryrun)
+        else:
+            log.info("LOAD_SEG INFO: No database update required")
 
+    # record what has been processed
+    if fingerprint_file is not None and not dryrun:
+        db_state = get_db_state(dbh, loadseg_fingerprint.window_start(rows))
+        loadseg_fingerprint.write_fingerprint(
+            fingerprint_file, dict(rdb_file=rdb_file, server=server,
+                                   digest=digest,
+                                   rows=rows, db_state=db_state))
+
+    if timeline_snapshot_file is not None and not dryrun:
+        write_timeline_snapshot(dbh, timeline_snapshot_file)
+
+    if h5file is not None and not dryrun:
+        update_h5(dbh, h5file, since=h5_since)
+
+    if not dryrun:
+        sqlite_profile.checkpoint(dbh)
     log.removeHandler(ch)
 
 if __name__ == "__main__":
@@ -648,7 +1287,10 @@ if __name__ == "__main__":
     main(opt.loadseg_rdb_dir, dryrun=opt.dryrun, 
              test=opt.test, dbi=opt.dbi, server=opt.server,
              database=opt.database, user=opt.user,
-             verbose=opt.verbose)
+             verbose=opt.verbose, fingerprint_file=opt.fingerprint_file,
+             in_memory=opt.in_memory, busy_timeout=opt.busy_timeout,
+             timeline_snapshot_file=opt.timeline_snapshot_file, h5file=opt.h5file,
+             journal_mode=opt.journal_mode)
 
 
 
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+"""
+Watch the mission planning summaries and the iFOT load segment rdb files
+with Linux inotify and run the timelines update as soon as they change.
+
+This is an alternative to running parse_cmd_load_gen.pl and
+update_load_seg_db.py from cron.  A new or rewritten ``.sum`` file in the
+recent years of the mp_dir tree runs both stages; a new ``.rdb`` file in
+the loadseg_rdb_dir runs only update_load_seg_db.py.  Events are debounced:
+the stages are run once the watched files have been quiet for
+``--debounce`` seconds (or ``--max_delay`` seconds after the first event of
+a burst).  Both stages are also run every ``--poll`` seconds regardless, to
+pick up anything that inotify missed (e.g. on NFS).
+"""
+
+import os
+import sys
+import time
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+import logging
+import subprocess
+
+log = logging.getLogger()
+log.setLevel(logging.DEBUG)
+MP_DIR = '/data/mpcrit1/mplogs/'
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+EVENT = struct.Struct('iIII')
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+
+
+def get_options():
+    from optparse import OptionParser
+    parser = OptionParser(usage='watch_timelines.py [options]')
+    parser.set_defaults()
+    parser.add_option("--dbi",
+                      default='sqlite',
+                      help="Database interface (sqlite|sybase)")
+    parser.add_option("--server",
+                      default='db_base.db3',
+                      help="DBI server (<filename>|sybase)")
+    parser.add_option("--touch_file",
+                      help="touch file for parse_cmd_load_gen.pl")
+    parser.add_option("--mp_dir",
+                      default=MP_DIR,
+                      help="mission planning directory tree to watch")
+    parser.add_option("--loadseg_rdb_dir",
+                      default=os.path.join(os.environ['SKA'], 'data', 'arc', 'iFOT_events', 'load_segment'),
+                      help="directory containing iFOT rdb files of load segments")
+    parser.add_option("--years",
+                      type='int',
+                      default=2,
+                      help="number of recent mp_dir years to watch")
+    parser.add_option("--debounce",
+                      type='float',
+                      default=10,
+                      help="seconds without events before running the update")
+    parser.add_option("--max_delay",
+                      type='float',
+                      default=60,
+                      help="maximum seconds from the first event to the update")
+    parser.add_option("--poll",
+                      type='float',
+                      default=600,
+                      help="seconds between updates without any events")
+    parser.add_option("--verbose",
+                      action='store_true',
+                      help="verbose")
+    (opt, args) = parser.parse_args()
+    return opt, args
+
+
+class Inotify(object):
+    """
+    Minimal ctypes wrapper of the Linux inotify API.
+    """
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "inotify_init1: %s" % os.strerror(err))
+        self.paths = {}
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """
+        Watch a directory and return the watch descriptor
+        """
+        wd = self._add_watch(self.fd, path.encode('utf-8') if not isinstance(path, bytes) else path,
+                             mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "inotify_add_watch %s: %s" % (path, os.strerror(err)))
+        self.paths[wd] = path
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+        self.paths.pop(wd, None)
+
+    def clear(self):
+        for wd in list(self.paths):
+            self.rm_watch(wd)
+
+    def read_events(self, timeout=None):
+        """
+        Wait up to ``timeout`` seconds for events and return a list of
+        (watched dir, mask, name) tuples
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, 65536)
+        except OSError as exc:
+            if exc.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = EVENT.unpack_from(buf, offset)
+            offset += EVENT.size
+            name = buf[offset:offset + length].rstrip(b'\0').decode('utf-8', 'replace')
+            offset += length
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            events.append((self.paths.get(wd), mask, name))
+        return events
+
+
+def recent_years(mp_dir, n_years):
+    years = sorted(d for d in os.listdir(mp_dir)
+                   if d.isdigit() and os.path.isdir(os.path.join(mp_dir, d)))
+    return years[-n_years:]
+
+
+def watch_tree(inotify, top):
+    """
+    Watch ``top`` and every directory below it.  Directories may be created
+    while this is walking them, so new ones are also picked up by the
+    IN_CREATE events of their parents.
+    """
+    for dirpath, dirnames, filenames in os.walk(top):
+        try:
+            inotify.add_watch(dirpath)
+        except OSError as exc:
+            # removed while walking
+            if exc.errno != errno.ENOENT:
+                raise
+
+
+def set_watches(inotify, opt):
+    inotify.clear()
+    # new year directories
+    inotify.add_watch(opt.mp_dir, IN_CREATE | IN_MOVED_TO)
+    for year in recent_years(opt.mp_dir, opt.years):
+        watch_tree(inotify, os.path.join(opt.mp_dir, year))
+    inotify.add_watch(opt.loadseg_rdb_dir)
+    log.info("TIMELINES INFO: Watching %d directories" % len(inotify.paths))
+
+
+def db_args(opt):
+    args = ['--dbi', opt.dbi, '--server', opt.server]
+    if opt.verbose:
+        args.append('--verbose')
+    return args
+
+
+def run_parse(opt):
+    cmd = [os.path.join(BIN_DIR, 'parse_cmd_load_gen.pl'), '--mp_dir', opt.mp_dir] + db_args(opt)
+    if opt.touch_file:
+        cmd += ['--touch_file', opt.touch_file]
+    return run_stage(cmd)
+
+
+def run_update(opt):
+    cmd = ([os.path.join(BIN_DIR, 'update_load_seg_db.py'),
+            '--loadseg_rdb_dir', opt.loadseg_rdb_dir] + db_args(opt))
+    return run_stage(cmd)
+
+
+def run_stage(cmd):
+    log.info("TIMELINES INFO: Running %s" % ' '.join(cmd))
+    sys.stdout.flush()
+    status = subprocess.call(cmd)
+    if status != 0:
+        log.warn("TIMELINES WARN: %s exited with status %d" % (cmd[0], status))
+    return status
+
+
+def classify(inotify, opt, events):
+    """
+    Add watches for any new directories in ``events`` and return
+    (summary changed, rdb changed, rescan needed).
+    """
+    sum_changed = False
+    rdb_changed = False
+    rescan = False
+    mp_dir = os.path.normpath(opt.mp_dir)
+    rdb_dir = os.path.normpath(opt.loadseg_rdb_dir)
+    for path, mask, name in events:
+        if mask & IN_Q_OVERFLOW or path is None:
+            rescan = True
+            continue
+        path = os.path.normpath(path)
+        if mask & IN_DELETE_SELF:
+            # e.g. the rdb directory replaced by a new one
+            rescan = True
+        elif mask & IN_ISDIR:
+            if path == mp_dir:
+                # a new year
+                rescan = True
+            elif path != rdb_dir:
+                # a new week, ofls, or mps directory, which may already have
+                # summaries in it by the time it is watched
+                watch_tree(inotify, os.path.join(path, name))
+                sum_changed = True
+        elif path == rdb_dir:
+            rdb_changed = True
+        elif name.endswith('.sum') and mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            sum_changed = True
+    return sum_changed, rdb_changed, rescan
+
+
+class Schedule(object):
+    """
+    When to run the stages, given the times of the watched events: once
+    the events have been quiet for ``debounce`` seconds (or ``max_delay``
+    seconds after the first event of a burst), and every ``poll`` seconds
+    without any events.  All times are in seconds (e.g. from time.time()).
+
+    :param debounce: seconds without events before running the stages
+    :param max_delay: maximum seconds from the first event to running the stages
+    :param poll: seconds between runs without any events
+    :param now: time of the last run
+    """
+    def __init__(self, debounce, max_delay, poll, now):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll = poll
+        self.last_run = now
+        self.pending_sum = False
+        self.first_event = None
+        self.last_event = None
+
+    def timeout(self, now):
+        """
+        Seconds to wait for events before the stages may be due
+        """
+        if self.first_event is None:
+            return max(0, self.last_run + self.poll - now)
+        return max(0, min(self.last_event + self.debounce,
+                          self.first_event + self.max_delay) - now)
+
+    def add_event(self, now, sum_changed):
+        """
+        Record a (debounced) change of the summaries or of the rdb files
+        """
+        self.pending_sum = self.pending_sum or sum_changed
+        if self.first_event is None:
+            self.first_event = now
+        self.last_event = now
+
+    def due(self, now):
+        """
+        Stages to run now
+
+        :rtype: None, or (run parse_cmd_load_gen.pl, run update_load_seg_db.py)
+        """
+        if self.first_event is not None:
+            # run once quiet for the debounce time, or after max_delay
+            if (now < self.last_event + self.debounce
+                    and now < self.first_event + self.max_delay):
+                return None
+            return self.pending_sum, True
+        if now >= self.last_run + self.poll:
+            return True, True
+        return None
+
+    def ran(self, now):
+        """
+        Record that the due stages were run (finishing at ``now``)
+        """
+        self.pending_sum = False
+        self.first_event = self.last_event = None
+        self.last_run = now
+
+
+def main():
+    (opt, args) = get_options()
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    if opt.verbose:
+        ch.setLevel(logging.DEBUG)
+    log.addHandler(ch)
+
+    inotify = Inotify()
+    set_watches(inotify, opt)
+
+    # bring everything up to date before waiting for changes
+    run_parse(opt)
+    run_update(opt)
+    schedule = Schedule(opt.debounce, opt.max_delay, opt.poll, time.time())
+
+    while True:
+        events = inotify.read_events(schedule.timeout(time.time()))
+        now = time.time()
+        if events:
+            sum_changed, rdb_changed, rescan = classify(inotify, opt, events)
+            if rescan:
+                set_watches(inotify, opt)
+                sum_changed = True
+            if sum_changed or rdb_changed:
+                log.debug("TIMELINES DEBUG: %d events (summaries %s, rdb %s)"
+                          % (len(events), sum_changed, rdb_changed))
+                schedule.add_event(now, sum_changed)
+
+        stages = schedule.due(now)
+        if stages is None:
+            continue
+        parse, update = stages
+        if parse:
+            run_parse(opt)
+        if update:
+            run_update(opt)
+        schedule.ran(time.time())
+
+
+if __name__ == "__main__":
+    main()